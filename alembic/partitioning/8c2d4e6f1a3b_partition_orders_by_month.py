@@ -0,0 +1,29 @@
+"""partition orders by month
+
+Optional; this revision lives in its own version location and on its
+own ``partitioning`` branch. See alembic/README.
+
+Revision ID: 8c2d4e6f1a3b
+Revises: 
+Create Date: 2026-10-19 11:02:17.604138
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c2d4e6f1a3b'
+down_revision = None
+branch_labels = ('partitioning',)
+depends_on = '3f1c9a2e7b10'
+
+
+def upgrade():
+    from nest.engines.psql.partitioning import partition_orders
+    partition_orders(op.get_bind())
+
+
+def downgrade():
+    from nest.engines.psql.partitioning import unpartition_orders
+    unpartition_orders(op.get_bind())
@@ -0,0 +1,35 @@
+"""keyset pagination indexes
+
+Revision ID: 3f1c9a2e7b10
+Revises: 
+Create Date: 2026-10-19 09:12:41.318502
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a2e7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built concurrently so that large `orders` tables stay writable;
+    # `IF NOT EXISTS` covers databases created with `create_all()`
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_created_id "
+            "ON orders (created, id)"
+        )
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_live_created_id "
+            "ON orders (live, created, id)"
+        )
+
+
+def downgrade():
+    op.drop_index("ix_orders_live_created_id", table_name="orders")
+    op.drop_index("ix_orders_created_id", table_name="orders")
@@ -0,0 +1,42 @@
+"""product sales rollups
+
+Revision ID: 5b7e0d3c9f21
+Revises: 3f1c9a2e7b10
+Create Date: 2026-10-19 13:40:06.912755
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e0d3c9f21'
+down_revision = '3f1c9a2e7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created with `create_all()` already have the table; it
+    # is rebuilt either way, since it starts out empty
+    if 'product_sales' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table('product_sales',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('orders', sa.Integer(), nullable=False),
+        sa.Column('gifts', sa.Integer(), nullable=False),
+        sa.Column('total', sa.DECIMAL(precision=10, scale=2), nullable=False),
+        sa.Column('discount', sa.DECIMAL(precision=10, scale=2), nullable=False),
+        sa.Column('coupons', sa.Integer(), nullable=False),
+        sa.Column('returns', sa.Integer(), nullable=False),
+        sa.Column('returned', sa.DECIMAL(precision=10, scale=2), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id'], onupdate='cascade', ondelete='cascade'),
+        sa.PrimaryKeyConstraint('day', 'product_id')
+        )
+
+    from nest.engines.psql.rollups import rebuild
+    rebuild(op.get_bind())
+
+
+def downgrade():
+    op.drop_table('product_sales')
@@ -0,0 +1,63 @@
+"""case insensitive user emails
+
+Merges users whose emails only differ in case into the oldest of them,
+then adds a unique index on lower(email). Merged users can not be split
+again on downgrade.
+
+Revision ID: 6a9e2c4f8d13
+Revises: d1e7a3c5b9f2
+Create Date: 2026-10-19 19:42:05.118320
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a9e2c4f8d13'
+down_revision = 'd1e7a3c5b9f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        "CREATE TEMPORARY TABLE user_merges ON COMMIT DROP AS "
+        "SELECT id, keeper FROM ("
+        "    SELECT id, first_value(id) OVER ("
+        "        PARTITION BY lower(email) ORDER BY id"
+        "    ) AS keeper FROM users"
+        ") AS duplicates WHERE id <> keeper"
+    )
+
+    # The oldest user takes over the orders and the most generous
+    # state of its duplicates
+    op.execute(
+        "UPDATE orders SET user_id = m.keeper FROM user_merges AS m "
+        "WHERE orders.user_id = m.id"
+    )
+    op.execute(
+        "UPDATE users SET "
+        "    subscribed = users.subscribed OR merged.subscribed, "
+        "    last_token_request = greatest("
+        "        users.last_token_request, merged.last_token_request"
+        "    ) "
+        "FROM ("
+        "    SELECT m.keeper, bool_or(u.subscribed) AS subscribed, "
+        "        max(u.last_token_request) AS last_token_request "
+        "    FROM user_merges AS m JOIN users AS u ON u.id = m.id "
+        "    GROUP BY m.keeper"
+        ") AS merged "
+        "WHERE users.id = merged.keeper"
+    )
+    op.execute("DELETE FROM users USING user_merges AS m WHERE users.id = m.id")
+
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "
+            "ix_users_email_lower ON users (lower(email))"
+        )
+
+
+def downgrade():
+    op.drop_index("ix_users_email_lower", table_name="users")
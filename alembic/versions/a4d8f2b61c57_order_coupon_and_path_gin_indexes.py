@@ -0,0 +1,47 @@
+"""order coupon and path gin indexes
+
+Revision ID: a4d8f2b61c57
+Revises: 5b7e0d3c9f21
+Create Date: 2026-10-19 15:21:50.447031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d8f2b61c57'
+down_revision = '5b7e0d3c9f21'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = {
+    "ix_orders_coupons": "coupons",
+    "ix_orders_paths": "paths",
+}
+
+
+def upgrade():
+    from nest.engines.psql.partitioning import is_partitioned
+
+    # Partitioned tables cannot be indexed concurrently
+    if is_partitioned(op.get_bind()):
+        for name, column in INDEXES.items():
+            op.execute(
+                f"CREATE INDEX IF NOT EXISTS {name} "
+                f"ON orders USING gin ({column})"
+            )
+        return
+
+    with op.get_context().autocommit_block():
+        for name, column in INDEXES.items():
+            op.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                f"ON orders USING gin ({column})"
+            )
+
+
+def downgrade():
+    for name in INDEXES:
+        op.drop_index(name, table_name="orders")
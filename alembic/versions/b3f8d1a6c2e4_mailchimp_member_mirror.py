@@ -0,0 +1,50 @@
+"""mailchimp member mirror
+
+Revision ID: b3f8d1a6c2e4
+Revises: 6a9e2c4f8d13
+Create Date: 2026-10-19 21:16:48.530271
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f8d1a6c2e4'
+down_revision = '6a9e2c4f8d13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created with `create_all()` already have the tables
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'mailchimp_syncs' not in tables:
+        op.create_table('mailchimp_syncs',
+        sa.Column('list_id', sa.Text(), nullable=False),
+        sa.Column('synced', sa.DateTime(), nullable=True),
+        sa.Column('members', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('list_id')
+        )
+    if 'mailchimp_members' not in tables:
+        op.create_table('mailchimp_members',
+        sa.Column('list_id', sa.Text(), nullable=False),
+        sa.Column('id', sa.Text(), nullable=False),
+        sa.Column('email', sa.Text(), nullable=False),
+        sa.Column('status', sa.Text(), nullable=False),
+        sa.Column('merge_fields', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('tags', postgresql.ARRAY(sa.Text(), dimensions=1), nullable=False),
+        sa.Column('last_changed', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('list_id', 'id')
+        )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_mailchimp_members_email_lower "
+        "ON mailchimp_members (lower(email))"
+    )
+
+
+def downgrade():
+    op.drop_index('ix_mailchimp_members_email_lower', table_name='mailchimp_members')
+    op.drop_table('mailchimp_members')
+    op.drop_table('mailchimp_syncs')
@@ -0,0 +1,36 @@
+"""dead letters
+
+Revision ID: d1e7a3c5b9f2
+Revises: a4d8f2b61c57
+Create Date: 2026-10-19 17:08:31.274519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1e7a3c5b9f2'
+down_revision = 'a4d8f2b61c57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created with `create_all()` already have the table
+    if 'dead_letters' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table('dead_letters',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('event_id', sa.Text(), nullable=False),
+        sa.Column('type', sa.Text(), nullable=False),
+        sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('error', sa.Text(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('dead_letters')
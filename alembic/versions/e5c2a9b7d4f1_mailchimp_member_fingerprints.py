@@ -0,0 +1,29 @@
+"""mailchimp member fingerprints
+
+Revision ID: e5c2a9b7d4f1
+Revises: b3f8d1a6c2e4
+Create Date: 2026-10-19 22:41:07.118392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5c2a9b7d4f1'
+down_revision = 'b3f8d1a6c2e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created with `create_all()` already have the column
+    op.execute(
+        "ALTER TABLE mailchimp_members ADD COLUMN IF NOT EXISTS fingerprint text"
+    )
+    # Make the next sync a full one, so that every member gets one
+    op.execute("UPDATE mailchimp_syncs SET synced = NULL")
+
+
+def downgrade():
+    op.drop_column('mailchimp_members', 'fingerprint')
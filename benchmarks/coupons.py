@@ -0,0 +1,130 @@
+"""Benchmark coupon and path lookups on a synthetic orders table.
+
+Fills a scratch database with synthetic orders and compares the plans
+and timings of ``Order.has_coupon``/``Order.has_path`` (``@>``, which
+can use the GIN indexes) against the equivalent ``= ANY()`` filter.
+
+::
+
+    python -m benchmarks.coupons --database bench --orders 1000000
+
+The database is created from the models and **its orders are
+replaced**; never point this at real data.
+"""
+import json
+from argparse import ArgumentParser
+from time import perf_counter
+
+from sqlalchemy import any_, inspect, literal
+
+from nest.engines.psql import PostgreSQLEngine
+from nest.engines.psql.models import Order
+
+# ~10% of orders carry one of 500 coupons, every order has one of 50
+# paths
+FILL = """
+INSERT INTO orders
+    (reference, created, date, live, gift, total, discount, name,
+     coupons, paths)
+SELECT
+    'bench-' || g,
+    now() - g * interval '1 minute',
+    now() - g * interval '1 minute',
+    true,
+    random() < 0.05,
+    round((random() * 300)::numeric, 2),
+    0,
+    'John Doe',
+    CASE WHEN random() < 0.1
+        THEN ARRAY['COUPON-' || (random() * 500)::int]
+        ELSE '{}'::text[]
+    END,
+    ARRAY['path-' || (random() * 50)::int]
+FROM generate_series(1, %(orders)s) AS g
+"""
+
+
+def explain(connection, query):
+    """Run ``EXPLAIN ANALYZE`` on an ORM query and summarize the plan.
+    """
+    compiled = query.statement.compile(dialect=connection.dialect)
+    plan = connection.execute(
+        "EXPLAIN (ANALYZE, FORMAT JSON) " + str(compiled),
+        compiled.params
+    ).scalar()[0]
+
+    nodes, stack = [], [plan["Plan"]]
+    while stack:
+        node = stack.pop()
+        nodes.append(node.get("Index Name") or node["Node Type"])
+        stack.extend(node.get("Plans", []))
+
+    return {
+        "execution_ms": plan["Execution Time"],
+        "rows": plan["Plan"]["Actual Rows"],
+        "nodes": nodes,
+    }
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--username", default="postgres")
+    parser.add_argument("--database", required=True)
+    parser.add_argument("--orders", type=int, default=1000000)
+    parser.add_argument("--coupon", default="COUPON-42")
+    parser.add_argument("--path", default="path-7")
+    args = parser.parse_args()
+
+    engine = PostgreSQLEngine(connection_info={
+        "host": args.host,
+        "port": args.port,
+        "username": args.username,
+        "database": args.database,
+    })
+    session = engine.session()
+
+    # `create_all()` does not add indexes to existing tables
+    existing = inspect(engine).get_indexes("orders")
+    existing = [index["name"] for index in existing]
+    for index in Order.__table__.indexes:
+        if index.name not in existing:
+            index.create(engine)
+
+    results = {"orders": args.orders}
+    with engine.begin() as connection:
+        start = perf_counter()
+        connection.execute("TRUNCATE orders CASCADE")
+        connection.execute(FILL, {"orders": args.orders})
+        results["fill_s"] = perf_counter() - start
+
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level="AUTOCOMMIT"
+        )
+        connection.execute("VACUUM ANALYZE orders")
+
+        queries = {
+            "has_coupon": session.query(Order.id).\
+                filter(Order.has_coupon(args.coupon)),
+            "coupon_any": session.query(Order.id).\
+                filter(literal(args.coupon) == any_(Order.coupons)),
+            "has_path": session.query(Order.id).\
+                filter(Order.has_path(args.path)),
+            "path_any": session.query(Order.id).\
+                filter(literal(args.path) == any_(Order.paths)),
+        }
+        for name, query in queries.items():
+            # First run warms the cache
+            explain(connection, query)
+            results[name] = explain(connection, query)
+
+        start = perf_counter()
+        Order.coupon_usage(session)
+        results["coupon_usage_s"] = perf_counter() - start
+
+    session.close()
+    print(json.dumps(results, indent=4))
+
+if __name__ == "__main__":
+    main()
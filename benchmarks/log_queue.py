@@ -0,0 +1,112 @@
+"""Benchmark synchronous against queued logging under an ingest load.
+
+Parses synthetic FastSpring events with a type hint that most of them
+do not match, so that three out of four log a warning, and logs one
+transaction line per event. Log output goes to a file so that the
+handler does real I/O; ``--write-latency`` adds a delay to every write
+to mimic a slow disk or pipe.
+
+::
+
+    python -m benchmarks.log_queue --events 50000 --write-latency 0.0001
+"""
+import json
+import sys
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from tempfile import TemporaryFile
+from time import perf_counter, sleep
+
+from nest.apis.fastspring.events import EventParser
+from nest.config import Config
+from nest.logging import Logger
+
+TYPES = [
+    "order.completed",
+    "return.created",
+    "subscription.activated",
+    "subscription.deactivated",
+]
+
+MODES = {
+    "sync": {"logQueue": "false"},
+    "queue-drop": {"logQueue": "true", "logQueuePolicy": "drop"},
+    "queue-block": {"logQueue": "true", "logQueuePolicy": "block"},
+}
+
+
+class SlowFile(object):
+    def __init__(self, file, latency):
+        self.file = file
+        self.latency = latency
+
+    def write(self, data):
+        if self.latency:
+            sleep(self.latency)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+def events(count):
+    for i in range(count):
+        yield {
+            "id": f"event-{i}",
+            "type": TYPES[i % len(TYPES)],
+            "live": True,
+            "created": 1577836800000 + i,
+            "data": {"reference": f"REF-{i}"},
+        }
+
+def run(mode, count, queue_size, latency=0):
+    config = Config()
+    config.parser = ConfigParser()
+    config.parser.read_dict({"nest": dict(
+        MODES[mode],
+        errorlogLevel="info",
+        transactionlogLevel="info",
+        logQueueSize=str(queue_size)
+    )})
+    config.reload()
+
+    with TemporaryFile("w") as sink:
+        stderr, sys.stderr = sys.stderr, SlowFile(sink, latency)
+        try:
+            logger = Logger(config)
+
+            start = perf_counter()
+            for event in EventParser(events(count), type_hint=TYPES[0]):
+                logger.transaction("info", f"Processed {event.id}")
+            ingest = perf_counter() - start
+
+            logger.stop()
+            drained = perf_counter() - start
+        finally:
+            sys.stderr = stderr
+
+    return {
+        "ingest_s": ingest,
+        "drained_s": drained,
+        "events_per_s": count / ingest,
+        "dropped": logger.dropped,
+    }
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--write-latency", type=float, default=0)
+    args = parser.parse_args()
+
+    results = {"events": args.events, "write_latency": args.write_latency}
+    for mode in MODES:
+        results[mode] = run(
+            mode,
+            args.events,
+            args.queue_size,
+            args.write_latency
+        )
+    print(json.dumps(results, indent=4))
+
+if __name__ == "__main__":
+    main()
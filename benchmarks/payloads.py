@@ -0,0 +1,228 @@
+"""Synthetic FastSpring and Mailchimp payloads.
+
+Everything is derived from a seeded ``Random`` so that two runs with
+the same seed and scale produce identical data::
+
+    generator = Generator(seed=42)
+    products = generator.products(20)
+    events = generator.events(products, orders=10000, returns=200,
+                              subscriptions=500)
+
+Shapes follow the fields nest reads from the real APIs; fields nest
+ignores are left out.
+"""
+from hashlib import md5
+from random import Random
+
+EPOCH = 1577836800000 # 2020-01-01, in milliseconds
+
+LANGUAGES = ["en", "en", "en", "de", "fr", "ja", "es"]
+COUNTRIES = ["US", "US", "US", "DE", "FR", "JP", "ES", "GB", "CA"]
+SETS = ["ava-ds", "ava-mc", "ava-vs", "ava-lp"]
+
+
+class Generator(object):
+    """Seeded factory of payloads.
+
+    :param seed: Seed of the underlying ``Random``.
+    :param customers: Size of the customer pool orders and
+        subscriptions draw from. Repeat customers make the user lookups
+        of the event parser hit existing rows.
+    :param gift_ratio: Share of orders with a recipient other than the
+        customer.
+    :param coupon_ratio: Share of orders with a coupon.
+    """
+    def __init__(self, seed=0, customers=None, gift_ratio=0.05,
+                 coupon_ratio=0.1):
+        self.random = Random(seed)
+        self.customers = customers
+        self.gift_ratio = gift_ratio
+        self.coupon_ratio = coupon_ratio
+        self.clock = EPOCH
+
+    def tick(self):
+        """Advance the clock by up to a minute, in milliseconds.
+        """
+        self.clock += self.random.randint(1, 60000)
+        return self.clock
+
+    def contact(self, i=None):
+        if i is None:
+            i = self.random.randrange(self.customers or 1000000)
+        return {
+            "email": f"customer-{i}@example.com",
+            "first": f"First{i}",
+            "last": f"Last{i}",
+        }
+
+    def products(self, count=20):
+        """FastSpring ``/products`` entries. Every set gets a current
+        and older versions; each product has a parent alias and one
+        child (upgrade) alias.
+        """
+        products = []
+        for i in range(count):
+            set = SETS[i % len(SETS)]
+            version = i // len(SETS) + 1
+            name = f"{set}-{version}"
+            price = round(self.random.uniform(19, 199), 2)
+            products.append({
+                "product": name,
+                "parent": None,
+                "pricing": {"price": {"USD": price}},
+                "offers": [],
+                "result": "success",
+                "set": set,
+                "version": version,
+            })
+            products.append({
+                "product": f"{name}-upgrade",
+                "parent": name,
+                "pricing": {"price": {"USD": round(price / 2, 2)}},
+                "offers": [],
+                "result": "success",
+            })
+
+        latest = {}
+        for product in products:
+            if "set" in product:
+                latest[product["set"]] = product["product"]
+        for product in products:
+            if "set" in product:
+                product["current"] = latest[product["set"]] == \
+                    product["product"]
+        return products
+
+    def order(self, products, i):
+        """Data of an ``order.completed`` event.
+        """
+        parents = [p for p in products if p.get("parent") is None]
+        items = []
+        for product in self.random.sample(parents, self.random.randint(1, 3)):
+            items.append({
+                "product": product["product"],
+                "driver": {"path": product["product"]},
+                "subtotalInPayoutCurrency":
+                    product["pricing"]["price"]["USD"],
+            })
+
+        total = sum(item["subtotalInPayoutCurrency"] for item in items)
+        total = round(total, 2)
+        coupons = []
+        discount = 0
+        if self.random.random() < self.coupon_ratio:
+            coupons = [f"COUPON-{self.random.randrange(100)}"]
+            discount = round(total * 0.2, 2)
+            total = round(total - discount, 2)
+
+        customer = self.contact()
+        recipient = customer
+        if self.random.random() < self.gift_ratio:
+            recipient = self.contact()
+
+        return {
+            "reference": f"REF-{i:09d}",
+            "live": True,
+            "completed": True,
+            "changedInSeconds": self.clock // 1000,
+            "customer": customer,
+            "recipients": [{"recipient": recipient}],
+            "items": items,
+            "coupons": coupons,
+            "totalInPayoutCurrency": total,
+            "discountInPayoutCurrency": discount,
+            "returns": [],
+        }
+
+    def ret(self, order, i):
+        """Data of a ``return.created`` event for ``order``.
+        """
+        return {
+            "reference": f"RET-{i:09d}",
+            "original": {"reference": order["reference"]},
+            "totalReturnInPayoutCurrency": order["totalInPayoutCurrency"],
+        }
+
+    def subscription(self, active):
+        """Data of a ``subscription.(de)activated`` event.
+        """
+        return {
+            "active": active,
+            "account": {
+                "language": self.random.choice(LANGUAGES),
+                "country": self.random.choice(COUNTRIES),
+            },
+            "contact": self.contact(),
+        }
+
+    def event(self, type, data, i):
+        return {
+            "id": f"event-{i:09d}",
+            "type": type,
+            "live": True,
+            "processed": False,
+            "created": self.tick(),
+            "data": data,
+        }
+
+    def events(self, products, orders=1000, returns=0, subscriptions=0):
+        """Webhook events in chronological order. Returns always refer
+        to an earlier order.
+
+        :param products: Output of
+            :meth:`~benchmarks.payloads.Generator.products`.
+        :param orders: Number of ``order.completed`` events.
+        :param returns: Number of ``return.created`` events.
+        :param subscriptions: Number of subscription events, about
+            three quarters of them activations.
+        """
+        kinds = ["order"] * orders + ["return"] * returns + \
+                ["subscription"] * subscriptions
+        self.random.shuffle(kinds)
+
+        # Make sure there is an order to return
+        if returns and orders:
+            first, order = kinds.index("return"), kinds.index("order")
+            if first < order:
+                kinds[first], kinds[order] = kinds[order], kinds[first]
+
+        events, placed = [], []
+        for i, kind in enumerate(kinds):
+            self.tick()
+            if kind == "order":
+                data = self.order(products, len(placed))
+                placed.append(data)
+                events.append(self.event("order.completed", data, i))
+            elif kind == "return":
+                data = self.ret(self.random.choice(placed), i)
+                events.append(self.event("return.created", data, i))
+            else:
+                active = self.random.random() < 0.75
+                type = "subscription.activated" if active \
+                    else "subscription.deactivated"
+                data = self.subscription(active)
+                events.append(self.event(type, data, i))
+        return events
+
+    def members(self, count=1000):
+        """Mailchimp list members.
+        """
+        members = []
+        for i in range(count):
+            contact = self.contact(i)
+            email = contact["email"]
+            members.append({
+                "id": md5(email.lower().encode()).hexdigest(),
+                "email_address": email,
+                "status": self.random.choice(
+                    ["subscribed", "subscribed", "unsubscribed", "cleaned"]
+                ),
+                "merge_fields": {
+                    "FNAME": contact["first"],
+                    "LNAME": contact["last"],
+                },
+                "language": self.random.choice(LANGUAGES),
+                "tags": [],
+                "last_changed": "2020-01-01T00:00:00+00:00",
+            })
+        return members
@@ -0,0 +1,199 @@
+"""Local stand-ins for the FastSpring and Mailchimp APIs.
+
+Serves generated payloads (see :mod:`benchmarks.payloads`) with the
+same paging behaviour nest relies on, so that sessions can be pointed
+at it through their ``prefix``::
+
+    with StubServer(events=events, products=products) as stub:
+        session = FastSpring(prefix=stub.fastspring)
+        list(session.get_events("unprocessed"))
+
+FastSpring endpoints: ``GET /orders``, ``GET /events/<type>``,
+``POST /events/<id>`` and ``GET /products/<ids>``. Mailchimp endpoints,
+under ``/3.0/``: ``GET lists``, ``GET lists/<id>/members`` and
+``GET lists/<id>/members/<hash>``.
+"""
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method):
+        stub = self.server.stub
+        stub.requests += 1
+        if stub.latency:
+            sleep(stub.latency)
+
+        url = urlsplit(self.path)
+        parts = url.path.split("/")
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+
+        if parts[1:2] == ["3.0"]:
+            return stub.mailchimp_route(method, parts[2:], params)
+        return stub.fastspring_route(method, parts[1:], params)
+
+    def do_GET(self):
+        self.reply(*self.route("GET"))
+
+    def do_POST(self):
+        self.reply(*self.route("POST"))
+
+
+class StubServer(object):
+    """Threaded HTTP server on an ephemeral local port.
+
+    :param orders: Order objects served by ``/orders``.
+    :param events: Webhook events served by ``/events``.
+    :param products: Product entries served by ``/products``.
+    :param members: Members of the single Mailchimp list.
+    :param page_size: Items per page of every paged endpoint, unless
+        the request asks for fewer (``limit``, ``count``).
+    :param latency: Seconds to sleep before answering each request.
+    """
+    LIST_NAME = "Customers"
+    LIST_ID = "b3nch"
+
+    def __init__(self, orders=[], events=[], products=[], members=[],
+                 page_size=100, latency=0):
+        self.orders = orders
+        self.events = events
+        self.products = {p["product"]: p for p in products}
+        self.members = members
+        self.hashes = {m["id"]: m for m in members}
+        self.page_size = page_size
+        self.latency = latency
+        self.requests = 0
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def fastspring(self):
+        """Prefix for :class:`~nest.apis.FastSpring`.
+        """
+        return self.url
+
+    @property
+    def mailchimp(self):
+        """Prefix for :class:`~nest.apis.Mailchimp`.
+        """
+        return f"{self.url}/3.0/"
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def limit(self, params, key):
+        return min(int(params.get(key, self.page_size)), self.page_size)
+
+    def fastspring_route(self, method, parts, params):
+        if parts[0] == "orders":
+            limit = self.limit(params, "limit")
+            page = int(params.get("page", 1))
+            orders = self.orders[(page - 1) * limit:page * limit]
+            more = page * limit < len(self.orders)
+            return {
+                "orders": orders,
+                "page": page,
+                "nextPage": page + 1 if more else None,
+            }, 200
+
+        if parts[0] == "events" and method == "POST":
+            for event in self.events:
+                if event["id"] == parts[1]:
+                    event["processed"] = True
+                    return {"id": event["id"], "processed": True}, 200
+            return {"error": "not found"}, 404
+
+        if parts[0] == "events":
+            processed = parts[1] == "processed"
+            begin = int(params.get("begin", 0))
+            matches = [
+                event for event in self.events
+                if event["processed"] == processed
+                and event["created"] >= begin
+            ]
+            limit = self.limit(params, "limit")
+            return {
+                "events": matches[:limit],
+                "more": len(matches) > limit,
+            }, 200
+
+        if parts[0] == "products":
+            ids = [id for id in "/".join(parts[1:]).split(",") if id]
+            if not(ids):
+                return {
+                    "action": "products.getall",
+                    "result": "success",
+                    "products": list(self.products),
+                }, 200
+
+            products = []
+            for id in ids:
+                products.append(
+                    self.products.get(id, {"product": id, "result": "error"})
+                )
+            return {"products": products}, 200
+
+        return {"error": "not found"}, 404
+
+    def mailchimp_route(self, method, parts, params):
+        if parts == ["lists"]:
+            return {
+                "lists": [{"name": self.LIST_NAME, "id": self.LIST_ID}]
+            }, 200
+
+        if parts[:1] != ["lists"] or parts[1:2] != [self.LIST_ID]:
+            return {"status": 404}, 404
+
+        if parts[2:] == ["members"]:
+            offset = int(params.get("offset", 0))
+            count = self.limit(params, "count")
+            return {
+                "members": self.members[offset:offset + count],
+                "total_items": len(self.members),
+            }, 200
+
+        if parts[2:3] == ["members"] and len(parts) == 4:
+            member = self.hashes.get(parts[3])
+            if member:
+                return member, 200
+
+        return {"status": 404}, 404
@@ -0,0 +1,254 @@
+"""Run the fetch, parse, persist and entitlement benchmarks.
+
+Payloads come from :mod:`benchmarks.payloads`. API calls go to a local
+:class:`~benchmarks.stubs.StubServer`, so no credentials are needed.
+Results are printed (or written with ``--output``) as JSON so that
+runs can be compared across releases::
+
+    python -m benchmarks.suite --database bench --orders 20000 \\
+        --output results.json
+
+The ``persist`` and ``entitlements`` scenarios need ``--database``;
+**its tables are truncated**, never point this at real data.
+``entitlements`` also caches its result in Redis, under keys prefixed
+with ``bench:`` which are deleted afterwards.
+"""
+import json
+import platform
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from time import perf_counter
+
+from nest.apis import FastSpring, Mailchimp
+from nest.apis.fastspring.events import EventParser
+from nest.apis.fastspring.ingest import Writer
+from nest.engines.psql import PostgreSQLEngine
+from nest.engines.psql.models import Base, Product, User
+from nest.engines.redis import RedisEngine
+
+from benchmarks.payloads import SETS, Generator
+from benchmarks.stubs import StubServer
+
+SCENARIOS = ["fetch", "parse", "persist", "entitlements"]
+
+
+def measure(fn, *args, **kwargs):
+    """Time ``fn``, which returns the number of items it processed, or
+    a ``(items, extra results)`` tuple.
+    """
+    start = perf_counter()
+    rv = fn(*args, **kwargs)
+    seconds = perf_counter() - start
+
+    items, extra = rv if isinstance(rv, tuple) else (rv, {})
+    return dict(
+        extra,
+        seconds=seconds,
+        items=items,
+        items_per_s=items / seconds if seconds else None
+    )
+
+def fetch(stub):
+    fastspring = FastSpring(prefix=stub.fastspring)
+    mailchimp = Mailchimp(prefix=stub.mailchimp)
+    mailchimp.default_list = stub.LIST_NAME
+
+    requests = stub.requests
+    results = {
+        "orders": measure(lambda: sum(1 for _ in fastspring.get_orders())),
+        "events": measure(
+            lambda: sum(1 for _ in fastspring.get_events("unprocessed"))
+        ),
+        "products": measure(lambda: len(fastspring.get_products())),
+        "members": measure(
+            lambda: sum(1 for _ in mailchimp.get_members(
+                params={"count": stub.page_size}
+            ))
+        ),
+    }
+    results["requests"] = stub.requests - requests
+    return results
+
+def parse(events):
+    return measure(lambda: sum(1 for _ in EventParser(events)))
+
+def reset(engine):
+    Base.metadata.create_all(engine)
+    tables = ", ".join(table.name for table in Base.metadata.sorted_tables)
+    with engine.begin() as connection:
+        connection.execute(f"TRUNCATE {tables} RESTART IDENTITY CASCADE")
+
+def seed_products(session, products):
+    aliases = {}
+    for product in products:
+        parent = product.get("parent") or product["product"]
+        aliases.setdefault(parent, []).append(product["product"])
+
+    for product in products:
+        if product.get("parent"):
+            continue
+        session.add(Product(
+            name=product["product"],
+            aliases=aliases[product["product"]],
+            price=product["pricing"]["price"]["USD"],
+            set=product["set"],
+            version=product["version"],
+            current=product["current"]
+        ))
+    session.commit()
+
+def persist(engine, events, batch):
+    session = engine.session()
+    writer = Writer(engine)
+
+    def run():
+        count = 0
+        for i in range(0, len(events), batch):
+            stored, _ = writer.write(session, events[i:i + batch])
+            session.commit()
+            count += stored
+        return count
+
+    with engine.profile(threshold=batch + 1) as profiler:
+        results = measure(run)
+    session.close()
+
+    results["statements"] = profiler.count
+    results["statements_per_item"] = profiler.count / max(results["items"], 1)
+    results["top"] = [
+        stat._asdict() for stat in profiler.top(n=5, by="count")
+    ]
+    return results
+
+def entitlements(engine, redis):
+    session = engine.session()
+    columns = [User.id]
+    for set in SETS:
+        columns.append(User.owns_any_in_set(set))
+        columns.append(User.owns_current_in_set(set))
+        columns.append(User.highest_version_in_set(set))
+
+    rows = []
+    def query():
+        rows.extend(session.query(*columns).all())
+        return len(rows)
+
+    results = {"query": measure(query)}
+    session.close()
+
+    def write():
+        pipeline = redis.pipeline(transaction=False)
+        for row in rows:
+            flags = {}
+            for i, set in enumerate(SETS):
+                flags[f"{set}:any"] = int(bool(row[1 + i * 3]))
+                flags[f"{set}:current"] = int(bool(row[2 + i * 3]))
+                flags[f"{set}:version"] = row[3 + i * 3] or 0
+            pipeline.hset(f"bench:entitlements:{row[0]}", mapping=flags)
+        pipeline.execute()
+        return len(rows)
+
+    def read():
+        pipeline = redis.pipeline(transaction=False)
+        for row in rows:
+            pipeline.hgetall(f"bench:entitlements:{row[0]}")
+        return len(pipeline.execute())
+
+    try:
+        results["redis_write"] = measure(write)
+        results["redis_read"] = measure(read)
+    finally:
+        keys = list(redis.scan_iter("bench:*", count=1000))
+        for i in range(0, len(keys), 1000):
+            redis.delete(*keys[i:i + 1000])
+    return results
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--returns", type=int, default=100)
+    parser.add_argument("--subscriptions", type=int, default=500)
+    parser.add_argument("--customers", type=int, default=2000)
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--username", default="postgres")
+    parser.add_argument("--database")
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=0)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"Unknown scenario '{scenario}'")
+        if scenario in ["persist", "entitlements"] and not(args.database):
+            parser.error(f"Scenario '{scenario}' needs --database")
+
+    generator = Generator(seed=args.seed, customers=args.customers)
+    products = generator.products(args.products)
+    events = generator.events(
+        products,
+        orders=args.orders,
+        returns=args.returns,
+        subscriptions=args.subscriptions
+    )
+    orders = [e["data"] for e in events if e["type"] == "order.completed"]
+    members = generator.members(args.members)
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "scenarios": {},
+    }
+
+    if "fetch" in scenarios:
+        with StubServer(orders, events, products, members,
+                        page_size=args.page_size,
+                        latency=args.latency) as stub:
+            results["scenarios"]["fetch"] = fetch(stub)
+
+    if "parse" in scenarios:
+        results["scenarios"]["parse"] = parse(events)
+
+    if args.database:
+        engine = PostgreSQLEngine(connection_info={
+            "host": args.host,
+            "port": args.port,
+            "username": args.username,
+            "database": args.database,
+        })
+
+    if "persist" in scenarios:
+        reset(engine)
+        seed_products(engine.session(), products)
+        results["scenarios"]["persist"] = persist(engine, events, args.batch)
+
+    if "entitlements" in scenarios:
+        redis = RedisEngine(
+            host=args.redis_host,
+            port=args.redis_port,
+            db=args.redis_db
+        )
+        results["scenarios"]["entitlements"] = entitlements(engine, redis)
+
+    output = json.dumps(results, indent=4, default=str)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
-from nest.apis.fastspring import FastSpring
-from nest.apis.mailchimp import Mailchimp
+from nest.types import lazy_attributes
 
-__all__ = ["FastSpring", "Mailchimp"]
\ No newline at end of file
+__all__ = ["FastSpring", "Mailchimp"]
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "FastSpring": "nest.apis.fastspring",
+    "Mailchimp": "nest.apis.mailchimp",
+})
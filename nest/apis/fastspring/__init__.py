@@ -1 +1,6 @@
-from nest.apis.fastspring.session import FastSpring
\ No newline at end of file
+from nest.types import lazy_attributes
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "FastSpring": "nest.apis.fastspring.session",
+    "IncompleteCatalog": "nest.apis.fastspring.session",
+})
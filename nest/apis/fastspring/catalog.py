@@ -0,0 +1,161 @@
+"""Keep the ``products`` table in line with the FastSpring catalog.
+
+The catalog from :meth:`~nest.apis.FastSpring.get_products` is diffed
+against all :class:`~nest.engines.psql.models.Product` rows, which are
+loaded with a single query, and new products, price changes and alias
+changes are written back with a single upsert::
+
+    changes = catalog.sync(session, FastSpring(), blacklist=["bundle"])
+    print(changes)
+
+Products that disappeared from the catalog are reported but never
+deleted, since past orders still refer to them. A catalog that is only
+partly known, because some products could not be fetched, is never
+applied.
+"""
+import logging
+from decimal import Decimal
+
+from sqlalchemy.dialects.postgresql import insert
+
+from nest.apis.fastspring.session import IncompleteCatalog
+from nest.engines.psql.models import Product
+
+
+def _price(value):
+    return Decimal(str(value or 0)).quantize(Decimal("0.01"))
+
+class CatalogDiff(object):
+    """Differences between the FastSpring catalog and the database.
+
+    :var inserted: Dict of new product names to ``(price, aliases)``.
+    :var repriced: Dict of product names to ``(old, new)`` prices.
+    :var realiased: Dict of product names to ``(old, new)`` alias
+        lists.
+    :var missing: Names of products in the database but not in the
+        catalog.
+    """
+    def __init__(self):
+        self.inserted = {}
+        self.repriced = {}
+        self.realiased = {}
+        self.missing = []
+
+    @property
+    def changed(self):
+        """True if anything has to be written.
+        """
+        return any([self.inserted, self.repriced, self.realiased])
+
+    def rows(self, catalog):
+        """Rows to upsert: every new or changed product.
+        """
+        names = set(self.inserted) | set(self.repriced) | set(self.realiased)
+        rows = []
+        for name in sorted(names):
+            info = catalog[name]
+            rows.append({
+                "name": name,
+                "price": _price(info.get("price")),
+                "aliases": sorted(info.get("aliases", [])),
+            })
+        return rows
+
+    def __str__(self):
+        return (f"{len(self.inserted)} new, {len(self.repriced)} repriced, "
+                f"{len(self.realiased)} realiased, "
+                f"{len(self.missing)} missing from catalog")
+
+    def __repr__(self):
+        return f"<CatalogDiff {self}>"
+
+def diff(session, catalog):
+    """Compare a catalog with the ``products`` table.
+
+    :param session: Database session.
+    :param catalog: Output of :meth:`~nest.apis.FastSpring.get_products`,
+        a dict of product names to their price and aliases.
+    """
+    rows = session.query(Product.name, Product.price, Product.aliases).all()
+    existing = {row.name: row for row in rows}
+
+    changes = CatalogDiff()
+    for name, info in catalog.items():
+        price = _price(info.get("price"))
+        aliases = sorted(info.get("aliases", []))
+
+        row = existing.get(name)
+        if row is None:
+            changes.inserted[name] = (price, aliases)
+            continue
+
+        if _price(row.price) != price:
+            changes.repriced[name] = (row.price, price)
+        if sorted(row.aliases or []) != aliases:
+            changes.realiased[name] = (row.aliases, aliases)
+
+    changes.missing = sorted(set(existing) - set(catalog))
+    return changes
+
+def apply(session, catalog, changes):
+    """Write a :class:`~nest.apis.fastspring.catalog.CatalogDiff` in a
+    single ``INSERT ... ON CONFLICT (name) DO UPDATE``. Does not commit.
+
+    :param session: Database session.
+    :param catalog: The catalog ``changes`` was computed from.
+    :param changes: Output of
+        :func:`~nest.apis.fastspring.catalog.diff`.
+    """
+    if not(changes.changed):
+        return
+
+    table = Product.__table__
+    statement = insert(table).values(changes.rows(catalog))
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={
+            "price": statement.excluded.price,
+            "aliases": statement.excluded.aliases,
+        }
+    )
+    session.execute(statement)
+
+def sync(session, fastspring, *args, **kwargs):
+    """Fetch the catalog, diff it against the database, apply and
+    commit the changes. Returns the
+    :class:`~nest.apis.fastspring.catalog.CatalogDiff`.
+
+    An empty catalog (e.g. the request failed) changes nothing. A
+    partial one raises
+    :class:`~nest.apis.fastspring.session.IncompleteCatalog` before
+    anything is written: a product whose details are missing would
+    otherwise be repriced to 0, or lose aliases.
+
+    :param session: Database session.
+    :param fastspring: A :class:`~nest.apis.FastSpring` session.
+    :param args: Passed to :meth:`~nest.apis.FastSpring.get_products`.
+    :param kwargs: Passed to :meth:`~nest.apis.FastSpring.get_products`.
+    """
+    logger = logging.getLogger("nest")
+
+    catalog = fastspring.get_products(*args, **kwargs)
+    if len(catalog) == 0:
+        logger.warning("Catalog is empty, not syncing products.")
+        return CatalogDiff()
+
+    # Aliases of a product whose own details are missing
+    unpriced = sorted(name for name, info in catalog.items()
+                      if "price" not in info)
+    if unpriced:
+        raise IncompleteCatalog(
+            f"No details for {len(unpriced)} products: {unpriced}",
+            products=catalog,
+            failed=unpriced
+        )
+
+    changes = diff(session, catalog)
+    apply(session, catalog, changes)
+    session.commit()
+
+    logger.info(f"Catalog sync: {changes}")
+    return changes
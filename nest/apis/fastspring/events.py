@@ -3,7 +3,11 @@ from abc import abstractmethod, abstractproperty
 from datetime import datetime
 from json import load
 
-from nest.engines.psql import models
+from nest.metrics import increment, timer
+from nest.types import LazyModule
+
+# Parsing without a database session does not need SQLAlchemy
+models = LazyModule("nest.engines.psql.models")
 
 
 class EventParser(object):
@@ -11,35 +15,50 @@ class EventParser(object):
     constructs appropriate WebhookEvent subclasses.
 
     Any session or type hinting passed to this will be forwarded to
-    resulting objects.
+    resulting objects, as will ``users``: a dict of emails to ids of
+    users known to exist (see
+    :func:`~nest.engines.psql.bulk.upsert_users`), which orders are
+    linked to without looking the users up.
     """
-    def __init__(self, generator, session=None, type_hint=None):
+    def __init__(self, generator, session=None, type_hint=None, users=None):
         self.generator = generator
         self.session = session
         self.type_hint = type_hint
+        self.users = users
 
     def __iter__(self):
         for data in self.generator:
-            event = WebhookEvent(
-                data,
-                session=self.session,
-                type_hint=self.type_hint
-            )
+            with timer("events.classify"):
+                event = self.classify(data)
+            increment("events.parsed")
+            yield event
 
-            if event.is_order():
-                yield event.to_order()
+    def classify(self, data):
+        """Construct the ``WebhookEvent`` subclass matching the type of
+        ``data``.
 
-            elif event.is_return():
-                yield event.to_return()
+        :param data: Raw event data.
+        """
+        event = WebhookEvent(
+            data,
+            session=self.session,
+            type_hint=self.type_hint
+        )
 
-            elif event.is_subscription_activated():
-                yield event.to_subscription(True)
+        if event.is_order():
+            event = event.to_order()
 
-            elif event.is_subscription_deactivated():
-                yield event.to_subscription(False)
+        elif event.is_return():
+            event = event.to_return()
 
-            else:
-                yield event
+        elif event.is_subscription_activated():
+            event = event.to_subscription(True)
+
+        elif event.is_subscription_deactivated():
+            event = event.to_subscription(False)
+
+        event.users = self.users
+        return event
 
 class WebhookEvent(object):
     """Base class for all webhook events of a FastSpring API Webhook
@@ -64,6 +83,7 @@ class WebhookEvent(object):
         self.raw = data
         self.data = data.get("data", {})
         self.session = session
+        self.users = None
 
         if type_hint and not(self.type == type_hint):
             self.logger.warning(
@@ -157,9 +177,12 @@ class Order(WebhookEvent):
             user = None
             if self.session:
                 email = customer.get("email", "")
-                query = self.session.query(models.User).filter_by(email=email)
+                query = self.session.query(models.User).\
+                    filter(models.User.normalized_email ==
+                           models.User.normalize(email))
 
-                user = query.first()
+                with timer("events.order.customer"):
+                    user = query.first()
                 if not(user):
                     user = models.User(
                         email=email,
@@ -186,7 +209,8 @@ class Order(WebhookEvent):
                 email = info.get("email", "")
                 if self.session:
                     query = self.session.query(models.User).\
-                        filter_by(email=email)
+                        filter(models.User.normalized_email ==
+                               models.User.normalize(email))
                     user = query.first()
                     if user:
                         recipients[i] = user
@@ -201,10 +225,27 @@ class Order(WebhookEvent):
             self._recipients = recipients
         return self._recipients
 
+    @property
+    def user_id(self):
+        """Id of the intended recipient's user, if it is in ``users``.
+        """
+        recipients = self.data.get("recipients", [])
+        if self.users and recipients:
+            email = recipients[0].get("recipient", {}).get("email")
+            return self.users.get(models.User.normalize(email))
+        return None
+
     @property
     def gift(self):
         """True if the intended recipient is not the purchaser.
         """
+        recipients = self.data.get("recipients", [])
+        if self.users is not None and len(recipients) == 1:
+            customer = self.data.get("customer", {}).get("email")
+            recipient = recipients[0].get("recipient", {}).get("email")
+            return models.User.normalize(customer) != \
+                models.User.normalize(recipient)
+
         if len(self.recipients) > 1:
             self.logger.warning(
                 "Cannot determine gift with multiple recipients."
@@ -234,7 +275,8 @@ class Order(WebhookEvent):
             if self.session:
                 op = models.Product.aliases.overlap(products)
                 query = self.session.query(models.Product).filter(op)
-                products = query.all()
+                with timer("events.order.products"):
+                    products = query.all()
             self._products = products
         return self._products
 
@@ -282,7 +324,10 @@ class Order(WebhookEvent):
             if self.session:
                 # @ToDo -> Handle multiple gift recipients
                 args["products"] = self.products
-                args["user"] = self.recipients[0]
+                if self.user_id is not None:
+                    args["user_id"] = self.user_id
+                else:
+                    args["user"] = self.recipients[0]
             self._model = models.Order(**args)
         return self._model
 
@@ -353,13 +398,15 @@ class SubscriptionActivated(WebhookEvent):
             user = None
             if self.session:
                 email = contact.get("email")
-                query = self.session.query(models.User).filter_by(email=email)
+                query = self.session.query(models.User).\
+                    filter(models.User.normalized_email ==
+                           models.User.normalize(email))
                 user = query.first()
 
             user = user or models.User(**args)
             user.subscribed = self.data.get("active", False)
             self._user = user
-        return user
+        return self._user
 
 class SubscriptionDeactivated(WebhookEvent):
     def __init__(self, data={}, session=None):
@@ -386,7 +433,9 @@ class SubscriptionDeactivated(WebhookEvent):
             user = None
             if self.session:
                 email = contact.get("email")
-                query = self.session.query(models.User).filter_by(email=email)
+                query = self.session.query(models.User).\
+                    filter(models.User.normalized_email ==
+                           models.User.normalize(email))
                 user = query.first()
 
             user = user or models.User(**args)
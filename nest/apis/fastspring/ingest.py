@@ -0,0 +1,365 @@
+"""Write raw FastSpring events to the database in batches.
+
+Whatever delivers the events (the webhook receiver in
+:mod:`nest.apis.fastspring.webhooks`, or :meth:`~nest.apis.FastSpring.get_events`)
+hands lists of raw event dicts to a
+:class:`~nest.apis.fastspring.ingest.Writer`, which parses them with
+:class:`~nest.apis.fastspring.events.EventParser` and commits each list
+in one transaction::
+
+    writer = Writer(PostgreSQLEngine())
+    writer(list(FastSpring().get_events("unprocessed")))
+
+A bad event does not fail its batch: it is set aside as a dead letter
+and can be replayed once whatever broke it is fixed::
+
+    writer.replay()
+"""
+import logging
+from collections import namedtuple
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError
+from sqlalchemy.orm import selectinload
+
+from nest.apis.fastspring.events import (
+    EventParser,
+    Order,
+    Return,
+    SubscriptionActivated,
+    SubscriptionDeactivated
+)
+from nest.engines.psql import models, rollups
+from nest.engines.psql.bulk import update_from_values, upsert_users
+from nest.engines.psql.models import DeadLetter, User
+from nest.metrics import increment, timer
+
+# Errors that fail a whole batch rather than a single event
+CONNECTION_ERRORS = (DisconnectionError, InterfaceError, OperationalError)
+
+
+def store(session, event):
+    """Add the database objects of a parsed event to ``session``.
+    Returns False if the event has nothing to store, e.g. a return of
+    an unknown order or an unhandled event type.
+
+    :param session: Database session.
+    :param event: A :class:`~nest.apis.fastspring.events.WebhookEvent`
+        parsed with ``session``.
+    """
+    if isinstance(event, Order):
+        session.add(event.model)
+    elif isinstance(event, Return):
+        if event.order is None:
+            return False
+        model = event.model
+        model.order = event.order
+        session.add(model)
+    elif isinstance(event, (SubscriptionActivated, SubscriptionDeactivated)):
+        session.add(event.user)
+    else:
+        return False
+    return True
+
+# What rollups.record needs of a return inserted without the ORM
+Returned = namedtuple("Returned", ["order", "amount"])
+
+def _email(event):
+    if isinstance(event, (SubscriptionActivated, SubscriptionDeactivated)):
+        return User.normalize(event.data.get("contact", {}).get("email"))
+
+def recipients(batch):
+    """Contacts of the intended recipients of the raw order events in
+    ``batch``, for :func:`~nest.engines.psql.bulk.upsert_users`.
+
+    :param batch: List of raw event dicts.
+    """
+    contacts = []
+    for data in batch:
+        if data.get("type") != "order.completed":
+            continue
+        for recipient in data.get("data", {}).get("recipients", [])[:1]:
+            info = recipient.get("recipient", {})
+            if info.get("email"):
+                contacts.append({
+                    "email": info["email"],
+                    "first": info.get("first", "John"),
+                    "last": info.get("last", "Doe"),
+                })
+    return contacts
+
+def coalesce(events):
+    """Reduce subscription events to the latest one per email, by
+    ``created``; of events created at the same time, the last one
+    wins. Returns a dict of normalized emails (see
+    :meth:`~nest.engines.psql.models.User.normalize`) to those events.
+
+    Other events, and subscription events without an email, are left
+    out.
+
+    :param events: Parsed events.
+    """
+    latest = {}
+    for event in events:
+        email = _email(event)
+        if not(email):
+            continue
+        if email not in latest or event.created >= latest[email].created:
+            latest[email] = event
+    return latest
+
+def apply_subscriptions(session, events):
+    """Set the subscription state of the users of ``events``, one
+    event per email (see :func:`~nest.apis.fastspring.ingest.coalesce`),
+    with two statements: an ``INSERT ... ON CONFLICT DO NOTHING`` for
+    unknown users and an ``UPDATE ... FROM (VALUES ...)`` for the
+    others. Users already in that state are not rewritten. Returns the
+    number of users inserted or updated.
+
+    Objects already loaded in ``session`` are not refreshed.
+
+    :param session: Database session.
+    :param events: Subscription events.
+    """
+    rows = []
+    for event in events:
+        account = event.data.get("account", {})
+        contact = event.data.get("contact", {})
+        rows.append({
+            "email": contact.get("email"),
+            "first": contact.get("first", "John"),
+            "last": contact.get("last", "Doe"),
+            "language_code": account.get("language", "en"),
+            "country_code": account.get("country", "US"),
+            "subscribed": bool(event.data.get("active", False)),
+        })
+    if len(rows) == 0:
+        return 0
+
+    table = User.__table__
+    statement = insert(table).values(rows).on_conflict_do_nothing(
+        index_elements=[User.normalized_email]
+    )
+    with timer("ingest.subscriptions"):
+        inserted = session.execute(statement).rowcount
+        updated = update_from_values(session, table, "email", [
+            {"email": row["email"], "subscribed": row["subscribed"]}
+            for row in rows
+        ], ignore_case=True)
+    return inserted + updated
+
+def apply_returns(session, events):
+    """Store return events with one query for their original orders
+    and one ``INSERT`` for the returns. Returns of unknown orders are
+    skipped. Returns the number of returns stored.
+
+    The rollups are updated if ``session`` is tracked by
+    :func:`~nest.engines.psql.rollups.track`.
+
+    :param session: Database session.
+    :param events: :class:`~nest.apis.fastspring.events.Return` events.
+    """
+    references = {
+        event.data.get("original", {}).get("reference") for event in events
+    }
+    references.discard(None)
+    if len(references) == 0:
+        return 0
+
+    tracked = rollups.tracking(session)
+    query = session.query(models.Order).\
+        filter(models.Order.reference.in_(references))
+    if tracked:
+        query = query.options(selectinload(models.Order.products))
+
+    with timer("ingest.returns.orders"):
+        orders = {order.reference: order for order in query}
+
+    rows, returns = [], []
+    for event in events:
+        reference = event.data.get("original", {}).get("reference")
+        order = orders.get(reference)
+        if order is None:
+            continue
+
+        amount = event.data.get("totalReturnInPayoutCurrency", 0)
+        rows.append({
+            "reference": event.data.get("reference"),
+            "amount": amount,
+            "order_id": order.id,
+        })
+        returns.append(Returned(order, amount))
+    if len(rows) == 0:
+        return 0
+
+    with timer("ingest.returns.insert"):
+        session.execute(insert(models.Return.__table__).values(rows))
+    for order in set(ret.order for ret in returns):
+        session.expire(order, ["returns"])
+    if tracked:
+        rollups.record(session, returns=returns)
+    return len(rows)
+
+class Writer(object):
+    """Callable that parses and commits a batch of raw events, using a
+    new session per batch. Returns the number of events stored.
+
+    A batch is first written in one go. If that fails, it is written
+    again with a ``SAVEPOINT`` around each event, so that the good
+    events are still committed. The events that fail on their own are
+    stored as :class:`~nest.engines.psql.DeadLetter` rows, in
+    the same transaction, and can be retried with
+    :meth:`~nest.apis.fastspring.ingest.Writer.replay`.
+
+    Connection errors are raised for the whole batch instead.
+
+    :param engine: A :class:`~nest.engines.psql.PostgreSQLEngine`.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.logger = logging.getLogger("nest")
+
+    def __call__(self, batch):
+        session = self.engine.session()
+        try:
+            count, failed = self.write(session, batch)
+            for _, data, error in failed:
+                session.add(DeadLetter(
+                    event_id=str(data.get("id", "")),
+                    type=str(data.get("type", "")),
+                    payload=data,
+                    error=repr(error)
+                ))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        increment("ingest.stored", count)
+        increment("ingest.dead_letters", len(failed))
+        self.logger.debug(f"Stored {count} of {len(batch)} events")
+        return count
+
+    def write(self, session, batch):
+        """Add a batch of raw events to ``session`` and flush it,
+        isolating events that fail. Does not commit. Returns the number
+        of events stored and a list of ``(index, event, error)`` tuples
+        of the events that failed.
+
+        The users orders belong to are upserted up front with
+        :func:`~nest.engines.psql.bulk.upsert_users`, so orders are
+        linked to them without lookups. Returns are stored in bulk with
+        :func:`~nest.apis.fastspring.ingest.apply_returns`. Subscription
+        events are coalesced to the latest state per email and applied
+        in bulk with
+        :func:`~nest.apis.fastspring.ingest.apply_subscriptions`; the
+        events that were superseded count as stored.
+
+        :param session: Database session.
+        :param batch: List of raw event dicts.
+        """
+        try:
+            with timer("ingest.batch"):
+                users = upsert_users(session, recipients(batch))
+                parser = EventParser(batch, session=session, users=users)
+                events = list(parser)
+                returns = [e for e in events if isinstance(e, Return)]
+                count = len(events) - len(returns)
+                for event in events:
+                    if isinstance(event, Return) or _email(event):
+                        continue
+                    if not(store(session, event)):
+                        count -= 1
+                session.flush()
+
+                count += apply_returns(session, returns)
+                apply_subscriptions(session, coalesce(events).values())
+            return count, []
+        except CONNECTION_ERRORS:
+            raise
+        except Exception as ex:
+            session.rollback()
+            self.logger.warning(
+                f"Batch of {len(batch)} events failed, retrying them "
+                f"one by one: {ex}"
+            )
+
+        # The upserted users were rolled back, look them up instead
+        parser = EventParser(batch, session=session)
+
+        def stage(event):
+            if isinstance(event, Return):
+                return apply_returns(session, [event])
+            if _email(event):
+                apply_subscriptions(session, [event])
+                return 1
+            return int(store(session, event))
+
+        count, failed, events = 0, [], {}
+        with timer("ingest.isolate"):
+            for i, data in enumerate(batch):
+                try:
+                    events[i] = parser.classify(data)
+                except Exception as ex:
+                    self.logger.error(
+                        f"Could not parse event {data.get('id')}: {ex}"
+                    )
+                    failed.append((i, data, ex))
+
+            latest = {id(e) for e in coalesce(events.values()).values()}
+            for i, event in events.items():
+                if _email(event) and id(event) not in latest:
+                    count += 1
+                    continue
+                try:
+                    with session.begin_nested():
+                        stored = stage(event)
+                    count += stored
+                except CONNECTION_ERRORS:
+                    raise
+                except Exception as ex:
+                    self.logger.error(
+                        f"Could not store event {event.id}: {ex}"
+                    )
+                    failed.append((i, batch[i], ex))
+        return count, sorted(failed, key=lambda failure: failure[0])
+
+    def replay(self, limit=100):
+        """Retry storing dead letters, oldest first. Letters that are
+        stored now are deleted, the others have their error and number
+        of attempts updated. Returns the number of events stored.
+
+        :param limit: Maximum number of letters to retry.
+        """
+        session = self.engine.session()
+        try:
+            letters = session.query(DeadLetter).\
+                order_by(DeadLetter.id).\
+                limit(limit).\
+                all()
+            ids = [letter.id for letter in letters]
+            payloads = [letter.payload for letter in letters]
+
+            count, failed = self.write(session, payloads)
+            errors = {ids[i]: repr(error) for i, _, error in failed}
+
+            # The letters may have been expired by a rollback
+            query = session.query(DeadLetter).\
+                filter(DeadLetter.id.in_(ids))
+            for letter in query:
+                if letter.id in errors:
+                    letter.error = errors[letter.id]
+                    letter.attempts += 1
+                else:
+                    session.delete(letter)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self.logger.info(f"Replayed {count} of {len(ids)} dead letters")
+        return count
@@ -1,18 +1,43 @@
 import logging
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONDecodeError
 from os import environ
 from urllib.parse import urljoin
 
-from requests import Session
+from requests import RequestException, Session
 
-from nest.apis.utils import protect
+from nest.apis.utils import decode, paginate, protect, retry
+from nest.metrics import timer
+
+
+class IncompleteCatalog(Exception):
+    """Raised when part of the product catalog could not be fetched, so
+    that a partial catalog is never mistaken for the whole one.
+
+    :var products: The products that were fetched.
+    :var failed: Ids of the products that were not.
+    """
+    def __init__(self, message, products={}, failed=[]):
+        super().__init__(message)
+        self.products = products
+        self.failed = failed
 
 
 class FastSpring(Session):
     """A custom ``Session`` to interact with FastSpring's API.
+
+    :param auth: ``(user, password)`` tuple. Defaults to the
+        ``FS_AUTH_USER`` and ``FS_AUTH_PASS`` environment variables.
+    :param hooks: Request hooks.
+    :param prefix: Overrides :class:`~nest.apis.FastSpring.prefix`,
+        e.g. to point at a local stand-in of the API.
     """
-    def __init__(self, auth=None, hooks={}):
+    DEFAULT_PREFIX = "https://api.fastspring.com"
+
+    def __init__(self, auth=None, hooks={}, prefix=None):
         super().__init__()
+        self._prefix = prefix or self.DEFAULT_PREFIX
         self.logger = logging.getLogger("nest")
         self.hooks = hooks
         self.auth = auth or (
@@ -23,11 +48,12 @@ class FastSpring(Session):
     @property
     def prefix(self):
         """URL to prefix on all requests. Since this is dedicated to
-        FastSpring, it is (currently): 'https://api.fastspring.com'.
+        FastSpring, it is (currently): 'https://api.fastspring.com',
+        unless another prefix was given to the constructor.
 
         This property is *read-only* and has no setter.
         """
-        return "https://api.fastspring.com"
+        return self._prefix
 
     def request(self, method, suffix, *args, **kwargs):
         """A normal request except that the
@@ -40,10 +66,12 @@ class FastSpring(Session):
         :param kwargs: Other keyword arguments passed to request.
         """
         endpoint = urljoin(self.prefix, suffix)
-        return super().request(method, endpoint, *args, **kwargs)
+        with timer("fastspring.request"):
+            return super().request(method, endpoint, *args, **kwargs)
 
     @protect(default={})
-    def get_products(self, filter=[], blacklist=[], *args, **kwargs):
+    def get_products(self, filter=[], blacklist=[], *args, chunk_size=50,
+                     workers=4, attempts=3, backoff=0.5, **kwargs):
         """Yields product name, price, and alias information. Useful
         for updating the corresponding database model.
 
@@ -55,30 +83,91 @@ class FastSpring(Session):
                 blacklist=["bundles"]
             )
 
+        Product details are requested in chunks of ``chunk_size`` ids,
+        ``workers`` chunks at a time, and each chunk is retried on
+        its own (see :func:`~nest.apis.utils.retry`). If a chunk still
+        fails, :class:`~nest.apis.fastspring.session.IncompleteCatalog`
+        is raised once the other chunks are done.
+
         :param filter: Whitelisted product ids.
         :param blacklist: Blacklisted product
         :param args: Other positional arguments passed to each ``GET``
             request.
+        :param chunk_size: Maximum number of product ids per request.
+        :param workers: Maximum number of concurrent requests.
+        :param attempts: Maximum number of attempts per chunk.
+        :param backoff: Initial delay between attempts, in seconds.
         :param kwargs: Other keyword arguments passed to each ``GET``
             request.
         """
-        # Endpoint accepts comma-seperated list of product names
-        joined_ids = ",".join(filter)
-        res = self.get(f"products/{joined_ids}", *args, **kwargs)
+        ids = list(filter)
+
+        # No `filter`, so get the list of all product ids first
+        if len(ids) == 0:
+            ids = retry(
+                self._get_product_ids,
+                *args,
+                attempts=attempts,
+                backoff=backoff,
+                **kwargs
+            )
+
+        chunks = []
+        for i in range(0, len(ids), chunk_size):
+            chunks.append(ids[i:i + chunk_size])
+
+        products, failed = defaultdict(dict), []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for chunk in chunks:
+                futures.append(executor.submit(
+                    retry,
+                    self._get_product_chunk,
+                    chunk,
+                    *args,
+                    attempts=attempts,
+                    backoff=backoff,
+                    **kwargs
+                ))
+
+            # Stitch chunks together as they arrive, in request order
+            for chunk, future in zip(chunks, futures):
+                try:
+                    infos = future.result()
+                except (RequestException, JSONDecodeError) as error:
+                    self.logger.error(
+                        f"Could not get products {chunk[0]}...{chunk[-1]}: "
+                        f"{error}"
+                    )
+                    failed.extend(chunk)
+                    continue
+                self._stitch_products(products, infos, blacklist)
+
+        if failed:
+            raise IncompleteCatalog(
+                f"Could not get {len(failed)} of {len(ids)} products",
+                products=products,
+                failed=failed
+            )
+        return products
+
+    def _get_product_ids(self, *args, **kwargs):
+        res = self.get("products/", *args, **kwargs)
         res.raise_for_status()
-        data = res.json()
+        return decode(res).get("products", [])
 
-        # `Filter` must've been empty, do the same request with the
-        # list of product ids in response
-        if len(data) > 1:
-            joined_ids = ",".join(data.get("products", []))
-            res = self.get(f"products/{joined_ids}", *args, **kwargs)
-            res.raise_for_status()
-            data = res.json()
+    def _get_product_chunk(self, ids, *args, **kwargs):
+        joined_ids = ",".join(ids)
+        res = self.get(f"products/{joined_ids}", *args, **kwargs)
+        res.raise_for_status()
+        return decode(res).get("products", [])
 
-        # Stitch together the information
-        products = defaultdict(dict)
-        for info in data.get("products", []):
+    @classmethod
+    def _stitch_products(cls, products, infos, blacklist=[]):
+        """Merge product details into ``products``, a dict of parent
+        product names to their price and aliases.
+        """
+        for info in infos:
             if info.get("result") != "success":
                 continue
 
@@ -104,75 +193,77 @@ class FastSpring(Session):
                 info["aliases"] = info.get("aliases", [])
                 info["aliases"].append(alias)
 
-        return products
-
     @protect(default=[])
-    def get_events(self, type, *args, **kwargs):
+    def get_events(self, type, *args, cursor=None, attempts=3, backoff=0.5,
+                   **kwargs):
         """Yields processed or unprocessed event data.
 
+        Each page is retried on transient errors. Pass a
+        :class:`~nest.apis.utils.Cursor` to resume the listing after it
+        was interrupted.
+
         :param type: Event type. Either ``'processed'`` or
             ``'unprocessed'``.
         :param args: Other positional arguments passed to each ``GET``
             request.
+        :param cursor: Position to start from and advance. Its
+            position is the ``begin`` timestamp of the next page.
+        :param attempts: Maximum number of attempts per page.
+        :param backoff: Initial delay between attempts, in seconds.
         :param kwargs: Other keyword arguments passed to each ``GET``
             request.
         """
-        res = self.get(f"events/{type}", *args, **kwargs)
-        res.raise_for_status()
-        data = res.json()
-
-        for event in data.get("events", []):
-            yield event
-
-        # Drop the 'days' param from params - it breaks the next
-        # request
-        kwargs["params"] = kwargs.get("params", {})
-        kwargs["params"].pop("days", None)
+        params = kwargs.pop("params", {})
 
-        while data.get("more"):
-            # Change "begin" param to the last order timestamp
-            events = data.get("events", [{}])
-            timestamp = events[-1].get("created")
-            if not(timestamp):
-                break
-
-            kwargs["params"].update(begin=timestamp+1)
-            res = self.get(f"events/{type}", *args, **kwargs)
+        def fetch(position):
+            query = dict(params, **position)
+            # The 'days' param breaks requests with a 'begin' param
+            if "begin" in position:
+                query.pop("days", None)
 
+            res = self.get(f"events/{type}", *args, params=query, **kwargs)
             res.raise_for_status()
-            data = res.json()
+            data = decode(res)
+
+            # Next page starts after the last event timestamp
+            events = data.get("events", [])
+            timestamp = events[-1].get("created") if events else None
+            if data.get("more") and timestamp:
+                return events, {"begin": timestamp + 1}
+            return events, None
 
-            for event in data.get("events", []):
-                yield event
+        yield from paginate(fetch, cursor, attempts, backoff)
 
     @protect(default=[])
-    def get_orders(self, *args, **kwargs):
+    def get_orders(self, *args, cursor=None, attempts=3, backoff=0.5,
+                   **kwargs):
         """Yields order data.
 
+        Each page is retried on transient errors. Pass a
+        :class:`~nest.apis.utils.Cursor` to resume the listing after it
+        was interrupted.
+
         :param args: Other positional arguments passed to each ``GET``
             request.
+        :param cursor: Position to start from and advance. Its
+            position is the next ``page``.
+        :param attempts: Maximum number of attempts per page.
+        :param backoff: Initial delay between attempts, in seconds.
         :param kwargs: Other keyword arguments passed to each ``GET``
             request.
         """
-        res = self.get("orders", *args, **kwargs)
-        res.raise_for_status()
-        data = res.json()
+        params = kwargs.pop("params", {})
 
-        for order in data.get("orders", []):
-            yield order
-
-        kwargs["params"] = kwargs.get("params", {})
+        def fetch(position):
+            query = dict(params, **position)
+            res = self.get("orders", *args, params=query, **kwargs)
+            res.raise_for_status()
+            data = decode(res)
 
-        while data.get("nextPage"):
             page = data.get("nextPage")
-            kwargs["params"].update(page=page)
-            res = self.get("orders", **kwargs)
-
-            res.raise_for_status()
-            data = res.json()
+            return data.get("orders", []), {"page": page} if page else None
 
-            for order in data.get("orders", []):
-                yield order
+        yield from paginate(fetch, cursor, attempts, backoff)
 
     @protect(default={})
     def update_event(self, id, *args, **kwargs):
@@ -193,4 +284,4 @@ class FastSpring(Session):
         """
         res = self.post(f"events/{id}", *args, **kwargs)
         res.raise_for_status()
-        return res.json()
+        return decode(res)
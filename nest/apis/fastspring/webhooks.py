@@ -0,0 +1,331 @@
+"""Receive FastSpring webhook deliveries instead of polling for them.
+
+:class:`~nest.apis.fastspring.webhooks.WebhookReceiver` is a small
+asyncio HTTP server. Every delivery is checked against its
+``X-FS-Signature`` header, its events are put in a bounded buffer and
+the request is acknowledged right away. The buffer is drained in
+micro-batches of up to ``batch_size`` events, or whatever arrived
+within ``linger`` seconds, which are handed to ``handler`` in a worker
+thread, e.g. a :class:`~nest.apis.fastspring.ingest.Writer`::
+
+    receiver = WebhookReceiver(Writer(PostgreSQLEngine()), port=8080)
+    asyncio.run(receiver.serve_forever())
+
+When the handler falls behind and the buffer is full, deliveries wait
+up to ``timeout`` seconds for room and are then answered with a
+``503``, so that FastSpring delivers them again later. A delivery is
+either buffered whole or not at all.
+
+Buffered events were already acknowledged, and FastSpring will not
+deliver them again. A batch the handler fails on is therefore retried
+with backoff, and then handed to ``fallback``, e.g. the ``add`` of an
+:class:`~nest.engines.redis.streams.EventStream`, to be written later::
+
+    receiver = WebhookReceiver(writer, fallback=stream.add)
+"""
+import asyncio
+import hmac
+import json
+import logging
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from http import HTTPStatus
+from os import environ
+
+from nest.metrics import increment
+
+
+def sign(secret, body):
+    """FastSpring's signature of a webhook body: the base64 encoded
+    HMAC-SHA256 of the body, keyed with the webhook secret.
+
+    :param secret: Webhook HMAC secret.
+    :param body: Raw request body.
+    """
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return b64encode(hmac.new(secret, body, sha256).digest()).decode()
+
+class WebhookReceiver(object):
+    """Asyncio HTTP server for FastSpring webhooks.
+
+    :param handler: Called with each batch of raw event dicts, in a
+        worker thread. Batches are handled one at a time, in order.
+    :param secret: Webhook HMAC secret. Defaults to the
+        ``FASTSPRING_WEBHOOK_SECRET`` environment variable, which must
+        then be set. ``False`` accepts unsigned deliveries.
+    :param host: Address to listen on.
+    :param port: Port to listen on. ``0`` picks a free port, see
+        :class:`~nest.apis.fastspring.webhooks.WebhookReceiver.port`.
+    :param path: Only deliveries to this path are accepted.
+    :param buffer_size: Maximum number of buffered events.
+    :param batch_size: Maximum number of events per batch.
+    :param linger: Seconds to wait for more events before handing a
+        partial batch over.
+    :param timeout: Seconds a delivery waits for room in a full buffer
+        before it is refused.
+    :param max_body: Largest accepted request body, in bytes.
+    :param attempts: Maximum number of times a batch is handed to
+        ``handler``. The handler must leave nothing behind when it
+        fails, as a :class:`~nest.apis.fastspring.ingest.Writer` does.
+    :param backoff: Initial delay between attempts, in seconds.
+    :param fallback: Called with a batch the handler kept failing on,
+        in the same worker thread. If there is none, or it fails too,
+        the batch is logged in full.
+    """
+    def __init__(self, handler, secret=None, host="127.0.0.1", port=8080,
+                 path="/", buffer_size=1000, batch_size=100, linger=0.1,
+                 timeout=1.0, max_body=10485760, attempts=3, backoff=0.5,
+                 fallback=None):
+        self.handler = handler
+        self.secret = secret if secret is not None else environ.get(
+            "FASTSPRING_WEBHOOK_SECRET", ""
+        )
+        if self.secret is not False and not(self.secret):
+            raise ValueError(
+                "No webhook secret: set FASTSPRING_WEBHOOK_SECRET, or pass "
+                "secret=False to accept unsigned deliveries."
+            )
+        self.host = host
+        self._port = port
+        self.path = path
+        self.batch_size = batch_size
+        self.linger = linger
+        self.timeout = timeout
+        self.max_body = max_body
+        self.attempts = attempts
+        self.backoff = backoff
+        self.fallback = fallback
+        self.logger = logging.getLogger("nest")
+
+        self.buffer = None
+        self.buffer_size = buffer_size
+        self._space = None
+        self._server = None
+        self._drainer = None
+        self._executor = None
+
+    @property
+    def port(self):
+        """Port the server listens on, once started.
+        """
+        if self._server and self._server.sockets:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    @property
+    def pending(self):
+        """Number of buffered events.
+        """
+        return self.buffer.qsize() if self.buffer else 0
+
+    def verify(self, body, signature):
+        """True if ``signature`` is FastSpring's signature of ``body``,
+        or if signatures are not checked.
+
+        :param body: Raw request body.
+        :param signature: Value of the ``X-FS-Signature`` header.
+        """
+        if self.secret is False:
+            return True
+        if not(signature):
+            return False
+        return hmac.compare_digest(sign(self.secret, body), signature)
+
+    async def start(self):
+        """Start listening and draining the buffer.
+        """
+        if self.secret is False:
+            self.logger.warning(
+                "Signatures are not checked, accepting unsigned webhooks."
+            )
+
+        self.buffer = asyncio.Queue(maxsize=self.buffer_size)
+        self._space = asyncio.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._drainer = asyncio.create_task(self._drain())
+        self._server = await asyncio.start_server(
+            self._serve,
+            self.host,
+            self._port
+        )
+        self.logger.info(f"Receiving webhooks on {self.host}:{self.port}")
+
+    async def stop(self):
+        """Stop accepting deliveries and wait for the buffered events to
+        be handled.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        await self.buffer.join()
+
+        self._drainer.cancel()
+        try:
+            await self._drainer
+        except (asyncio.CancelledError):
+            pass
+        self._executor.shutdown(wait=True)
+
+    async def serve_forever(self):
+        """Start, then serve until cancelled.
+        """
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def enqueue(self, events):
+        """Buffer all of ``events``, waiting up to ``timeout`` seconds
+        for room. Returns False, buffering nothing, if there is none.
+        Never succeeds if there are more events than ``buffer_size``.
+
+        :param events: List of raw event dicts.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        async with self._space:
+            while self.buffer.maxsize - self.buffer.qsize() < len(events):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(self._space.wait(), remaining)
+                except (asyncio.TimeoutError):
+                    return False
+
+            for event in events:
+                self.buffer.put_nowait(event)
+        return True
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.buffer.get()]
+            deadline = loop.time() + self.linger
+            while len(batch) < self.batch_size:
+                if self.buffer.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        event = await asyncio.wait_for(
+                            self.buffer.get(),
+                            remaining
+                        )
+                    except (asyncio.TimeoutError):
+                        break
+                else:
+                    event = self.buffer.get_nowait()
+                batch.append(event)
+
+            async with self._space:
+                self._space.notify_all()
+            try:
+                await self._handle(batch)
+            finally:
+                for _ in batch:
+                    self.buffer.task_done()
+
+    async def _handle(self, batch):
+        loop = asyncio.get_running_loop()
+        ids = [event.get("id") for event in batch]
+        for attempt in range(self.attempts):
+            try:
+                await loop.run_in_executor(self._executor, self.handler, batch)
+                increment("webhooks.handled", len(batch))
+                return
+            except Exception as ex:
+                error = ex
+            if attempt + 1 < self.attempts:
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning(
+                    f"Retrying events {ids} in {delay:.2f}s after: {error}"
+                )
+                await asyncio.sleep(delay)
+
+        self.logger.error(f"Could not handle events {ids}: {error}")
+        increment("webhooks.failed", len(batch))
+        if self.fallback is not None:
+            try:
+                await loop.run_in_executor(
+                    self._executor,
+                    self.fallback,
+                    batch
+                )
+                increment("webhooks.fallback", len(batch))
+                return
+            except Exception as ex:
+                self.logger.error(f"Fallback failed for events {ids}: {ex}")
+
+        # Last resort, so that the events can still be recovered
+        self.logger.error(f"Lost events: {json.dumps(batch)}")
+        increment("webhooks.lost", len(batch))
+
+    async def _serve(self, reader, writer):
+        try:
+            status = await self._receive(reader)
+        except (asyncio.IncompleteReadError, ValueError):
+            status = HTTPStatus.BAD_REQUEST
+
+        headers = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            "Content-Length: 0",
+            "Connection: close",
+        ]
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            headers.append(f"Retry-After: {max(int(self.timeout), 1)}")
+
+        try:
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode())
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _receive(self, reader):
+        line = await reader.readuntil(b"\r\n")
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", 0))
+        if length > self.max_body:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        body = await reader.readexactly(length)
+
+        if target.split("?")[0] != self.path:
+            return HTTPStatus.NOT_FOUND
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED
+        if not(self.verify(body, headers.get("x-fs-signature"))):
+            self.logger.warning("Refused webhook with a bad signature")
+            increment("webhooks.refused")
+            return HTTPStatus.UNAUTHORIZED
+
+        try:
+            events = json.loads(body).get("events", [])
+        except (ValueError, AttributeError):
+            return HTTPStatus.BAD_REQUEST
+        if len(events) > self.buffer_size:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+        if not(await self.enqueue(events)):
+            increment("webhooks.throttled")
+            return HTTPStatus.SERVICE_UNAVAILABLE
+
+        increment("webhooks.received", len(events))
+        return HTTPStatus.ACCEPTED
@@ -1 +1,5 @@
-from nest.apis.mailchimp.session import Mailchimp
\ No newline at end of file
+from nest.types import lazy_attributes
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "Mailchimp": "nest.apis.mailchimp.session",
+})
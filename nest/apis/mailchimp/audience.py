@@ -0,0 +1,283 @@
+"""Keep Mailchimp members in line with what users own.
+
+An :class:`~nest.apis.mailchimp.audience.Audience` describes which
+merge fields and tags follow from a user, e.g. the highest version
+owned of a set or "owns the current version of a set". Rather than
+fetching every member to see whether it is out of date, the users'
+entitlements (see :func:`~nest.engines.psql.entitlements.entitlements`)
+are compared with the member mirror kept by
+:mod:`~nest.apis.mailchimp.sync`, and only the members that differ are
+sent::
+
+    sync_members(session, mailchimp)
+    audience = Audience(
+        versions={"Ozone": "OZONE_VER"},
+        current={"Ozone": "Owns Current Ozone"},
+        paid="Owns Any Paid",
+        demo="Demo Only"
+    )
+    audience.push(session, mailchimp)
+    audience.push_tags(session, mailchimp)
+
+Tags are sent per tag, with up to 500 members added and 500 removed
+per request.
+
+Only members already in the mirror are updated; users are never added
+to a list. The mirror catches up with the pushed changes on its next
+sync.
+"""
+import logging
+from collections import namedtuple
+from time import perf_counter
+
+from sqlalchemy import and_, func
+
+from nest.apis.mailchimp.sync import fingerprint
+from nest.engines.psql.entitlements import entitlements
+from nest.engines.psql.models import MailchimpMember, User
+from nest.metrics import increment, timer
+
+# The result of pushing tags: members whose tags changed, members added
+# to and removed from tags, requests sent, and how long it all took
+Tagged = namedtuple(
+    "Tagged",
+    ["members", "added", "removed", "requests", "seconds", "rate"]
+)
+
+class Audience(object):
+    """How users map onto the merge fields and tags of list members.
+    Any field or tag can be left out by setting its name to ``None``.
+    Tags that are not part of the audience are left alone.
+
+    :param versions: Dict of set names to the merge field holding the
+        highest version owned of that set, or ``""`` if none is.
+    :param sets: Merge field listing the names of the sets owned,
+        comma separated.
+    :param subscribed: Merge field holding ``"yes"`` or ``"no"`` for
+        :class:`~nest.engines.psql.models.User.subscribed`.
+    :param current: Dict of set names to the tag of users who own the
+        current version of that set.
+    :param paid: Tag of users who own any paid product.
+    :param demo: Tag of users who own nothing but demos.
+    """
+    def __init__(self, versions={}, sets="SETS", subscribed="MEMBER",
+                 current={}, paid=None, demo=None):
+        self.versions = dict(versions)
+        self.sets = sets
+        self.subscribed = subscribed
+        self.current = dict(current)
+        self.paid = paid
+        self.demo = demo
+        self.logger = logging.getLogger("nest")
+
+    @property
+    def managed(self):
+        """Names of the tags of this audience.
+        """
+        tags = set(self.current.values()) | {self.paid, self.demo}
+        tags.discard(None)
+        return tags
+
+    def merge_fields(self, user):
+        """The merge fields that follow from a user.
+
+        :param user: A row of
+            :func:`~nest.engines.psql.entitlements.entitlements`.
+        """
+        fields = {}
+        if self.sets:
+            fields[self.sets] = ", ".join(sorted(user.versions))
+        if self.subscribed:
+            fields[self.subscribed] = "yes" if user.subscribed else "no"
+        for name, field in self.versions.items():
+            fields[field] = user.versions.get(name, "")
+        return fields
+
+    def tags(self, user):
+        """Names of the tags that follow from a user.
+
+        :param user: A row of
+            :func:`~nest.engines.psql.entitlements.entitlements`.
+        """
+        tags = {
+            tag for name, tag in self.current.items()
+            if name in user.current
+        }
+        if user.paid:
+            tags.add(self.paid)
+        if user.demo:
+            tags.add(self.demo)
+        tags.discard(None)
+        return tags
+
+    def members(self, session, list_id, batch_size=1000):
+        """Query of :func:`~nest.engines.psql.entitlements.entitlements`
+        joined to the mirrored members of a list, by email and
+        case-insensitively. Adds the member's ``address``, ``current``
+        merge fields, ``tags`` and ``fingerprint``.
+
+        :param session: Database session.
+        :param list_id: Mailchimp list id.
+        :param batch_size: Rows fetched from the database at a time.
+        """
+        return entitlements(session).\
+            join(MailchimpMember, and_(
+                MailchimpMember.list_id == list_id,
+                func.lower(MailchimpMember.email) == User.normalized_email
+            )).\
+            add_columns(
+                MailchimpMember.email.label("address"),
+                MailchimpMember.merge_fields.label("current_fields"),
+                MailchimpMember.tags,
+                MailchimpMember.fingerprint
+            ).\
+            yield_per(batch_size)
+
+    def changes(self, session, list_id, batch_size=1000):
+        """Yields the members of a list whose merge fields differ from
+        what their user implies, as dicts for
+        :meth:`~nest.apis.Mailchimp.update_members`. Users and members
+        are matched by email, case-insensitively.
+
+        Merge fields that are not part of the audience are left as they
+        are, and do not count as differences.
+
+        :param session: Database session.
+        :param list_id: Mailchimp list id.
+        :param batch_size: Rows fetched from the database at a time.
+        """
+        for row in self.members(session, list_id, batch_size):
+            fields = self.merge_fields(row)
+            expected = dict(row.current_fields, **fields)
+            if fingerprint(expected, row.tags) != row.fingerprint:
+                yield {"email_address": row.address, "merge_fields": fields}
+
+    def push(self, session, mailchimp, list=None, chunk_size=500):
+        """Send the :meth:`changes` of a list to Mailchimp in bulk.
+        Returns the number of members updated.
+
+        :param session: Database session.
+        :param mailchimp: A :class:`~nest.apis.Mailchimp` session.
+        :param list: Name of the list. Defaults to
+            :class:`~nest.apis.Mailchimp.default_list`.
+        :param chunk_size: Maximum number of members per request.
+        """
+        name = list or mailchimp.default_list
+        list_id = mailchimp.lists.get(name)
+        if not(list_id):
+            raise ValueError(f"Unknown Mailchimp list: {name}")
+
+        with timer("mailchimp.audience.diff"):
+            members = [member for member in self.changes(session, list_id)]
+        if len(members) == 0:
+            return 0
+
+        with timer("mailchimp.audience.push"):
+            updated = mailchimp.update_members(
+                members,
+                list=list_id,
+                chunk_size=chunk_size
+            )
+
+        increment("mailchimp.audience.updated", updated)
+        self.logger.info(
+            f"Updated {updated} of {len(members)} changed members of {name}"
+        )
+        return updated
+
+    def tag_changes(self, session, list_id, batch_size=1000):
+        """The tags of a list whose members differ from what their users
+        imply. Returns a dict of tag names to ``(add, remove)`` tuples
+        of lists of emails.
+
+        :param session: Database session.
+        :param list_id: Mailchimp list id.
+        :param batch_size: Rows fetched from the database at a time.
+        """
+        managed = self.managed
+        changes = {}
+        for row in self.members(session, list_id, batch_size):
+            expected = self.tags(row)
+            actual = managed.intersection(row.tags)
+            for tag in expected - actual:
+                changes.setdefault(tag, ([], []))[0].append(row.address)
+            for tag in actual - expected:
+                changes.setdefault(tag, ([], []))[1].append(row.address)
+        return changes
+
+    def push_tags(self, session, mailchimp, list=None, chunk_size=500):
+        """Send the :meth:`tag_changes` of a list to Mailchimp in bulk,
+        creating tags that do not exist yet. Progress is logged after
+        every request. Returns a
+        :class:`~nest.apis.mailchimp.audience.Tagged` report.
+
+        :param session: Database session.
+        :param mailchimp: A :class:`~nest.apis.Mailchimp` session.
+        :param list: Name of the list. Defaults to
+            :class:`~nest.apis.Mailchimp.default_list`.
+        :param chunk_size: Maximum number of members added, and removed,
+            per request.
+        """
+        start = perf_counter()
+        name = list or mailchimp.default_list
+        list_id = mailchimp.lists.get(name)
+        if not(list_id):
+            raise ValueError(f"Unknown Mailchimp list: {name}")
+
+        with timer("mailchimp.audience.tags.diff"):
+            changes = self.tag_changes(session, list_id)
+        members = {
+            email for add, remove in changes.values() for email in add + remove
+        }
+        total = sum(len(add) + len(remove) for add, remove in changes.values())
+
+        segments = {}
+        if total > 0:
+            params = {"type": "static", "count": 1000}
+            for segment in mailchimp.get_segments(list=list_id, params=params):
+                segments[segment["name"]] = segment["id"]
+
+        added, removed, requests, done = 0, 0, 0, 0
+        for tag in sorted(changes):
+            add, remove = changes[tag]
+            if tag not in segments:
+                if not(add):
+                    continue
+                segments[tag] = mailchimp.create_segment(tag, list=list_id)
+
+            for i in range(0, max(len(add), len(remove)), chunk_size):
+                chunk = (add[i:i + chunk_size], remove[i:i + chunk_size])
+                with timer("mailchimp.audience.tags.push"):
+                    counts = mailchimp.update_segment(
+                        segments[tag],
+                        *chunk,
+                        list=list_id
+                    )
+                added += counts[0]
+                removed += counts[1]
+                requests += 1
+                done += len(chunk[0]) + len(chunk[1])
+
+                elapsed = perf_counter() - start
+                self.logger.info(
+                    f"Tagged {done} of {total} changes of {name}, "
+                    f"{done / elapsed:.0f}/s"
+                )
+
+        seconds = perf_counter() - start
+        increment("mailchimp.audience.tagged", added)
+        increment("mailchimp.audience.untagged", removed)
+        report = Tagged(
+            members=len(members),
+            added=added,
+            removed=removed,
+            requests=requests,
+            seconds=seconds,
+            rate=(added + removed) / seconds if seconds > 0 else 0.0
+        )
+        self.logger.info(
+            f"Tagged {report.members} members of {name}: {added} added, "
+            f"{removed} removed in {requests} requests, "
+            f"{seconds:.1f}s ({report.rate:.0f}/s)"
+        )
+        return report
@@ -5,14 +5,26 @@ from urllib.parse import urljoin
 
 from requests import Session
 
-from nest.apis.utils import protect
+from nest.apis.utils import decode, paginate, protect
+from nest.metrics import timer
 
 
 class Mailchimp(Session):
     """A custom ``Session`` to interact with Mailchimp's API.
+
+    :param auth: ``(user, token)`` tuple. Defaults to the
+        ``MAILCHIMP_AUTH_USER`` and ``MAILCHIMP_AUTH_TOKEN``
+        environment variables.
+    :param hooks: Request hooks.
+    :param prefix: Overrides :class:`~nest.apis.Mailchimp.prefix`,
+        e.g. to point at a local stand-in of the API. Must end with a
+        slash.
     """
-    def __init__(self, auth=None, hooks={}):
+    DEFAULT_PREFIX = "https://us14.api.mailchimp.com/3.0/"
+
+    def __init__(self, auth=None, hooks={}, prefix=None):
         super().__init__()
+        self._prefix = prefix or self.DEFAULT_PREFIX
         self.logger = logging.getLogger("nest")
         self.hooks = hooks
         self.auth = auth or (
@@ -31,7 +43,7 @@ class Mailchimp(Session):
             url = urljoin(self.prefix, "lists")
             res = super().request("GET", url)
             res.raise_for_status()
-            data = res.json()
+            data = decode(res)
 
             for info in data.get("lists", []):
                 name = info.get("name")
@@ -44,11 +56,12 @@ class Mailchimp(Session):
     def prefix(self):
         """URL to prefix on all requests. Since this is dedicated to
         Mailchimp, it is (currently):
-        'https://us14.api.mailchimp.com/3.0/'.
+        'https://us14.api.mailchimp.com/3.0/', unless another prefix was
+        given to the constructor.
 
         This property is *read-only* and has no setter.
         """
-        return "https://us14.api.mailchimp.com/3.0/"
+        return self._prefix
 
     @property
     def default_list(self):
@@ -67,12 +80,14 @@ class Mailchimp(Session):
 
     @classmethod
     def md5(cls, message):
-        """Hash a message with md5.
+        """Hash a message with md5, after lowercasing it. For an email,
+        this is Mailchimp's subscriber hash, so it matches whatever the
+        case of the email.
         """
         if isinstance(message, bytes):
-            return md5(message).hexdigest()
+            return md5(message.lower()).hexdigest()
         elif isinstance(message, str):
-            return md5(message.encode()).hexdigest()
+            return md5(message.lower().encode()).hexdigest()
 
     @classmethod
     def multijoin(cls, url, *parts, seperator="/"):
@@ -95,6 +110,7 @@ class Mailchimp(Session):
 
         :param method: HTTP Request method.
         :param suffix: Joined to :class:`~nest.apis.Mailchimp.prefix`.
+            Empty for the list itself.
         :param args: Other positional arguments passed to request.
         :param kwargs: Other keyword arguments passed to request. If
             ``list`` is included in kwargs, it will popped and used in
@@ -104,39 +120,44 @@ class Mailchimp(Session):
             "list",
             self.lists.get(self.default_list, "")
         )
-        endpoint = self.multijoin(self.prefix, "lists", id, suffix)
-        return super().request(method, endpoint, *args, **kwargs)
+        parts = ["lists", id] + ([suffix] if suffix else [])
+        endpoint = self.multijoin(self.prefix, *parts)
+        with timer("mailchimp.request"):
+            return super().request(method, endpoint, *args, **kwargs)
 
     @protect(default=[])
-    def get_members(self, *args, **kwargs):
+    def get_members(self, *args, cursor=None, attempts=3, backoff=0.5,
+                    **kwargs):
         """Yields members of a list.
 
+        Each page is retried on transient errors. Pass a
+        :class:`~nest.apis.utils.Cursor` to resume the listing after it
+        was interrupted.
+
         :param args: Other positional arguments passed to each ``GET``
             request.
+        :param cursor: Position to start from and advance. Its
+            position is the ``offset`` of the next page.
+        :param attempts: Maximum number of attempts per page.
+        :param backoff: Initial delay between attempts, in seconds.
         :param kwargs: Other keyword arguments passed to each ``GET``
             request.
         """
-        res = self.get("members", *args, **kwargs)
+        params = kwargs.pop("params", {})
 
-        res.raise_for_status()
-        data = res.json()
-
-        members = data.get("members", [])
-        for member in members:
-            yield member
-
-        total = data.get("total_items", 0)
-        offset = len(members)
-        kwargs["params"] = kwargs.get("params", {})
-        while offset < total:
-            kwargs["params"].update(offset=offset)
-            res = self.get("members", *args, **kwargs)
+        def fetch(position):
+            query = dict(params, **position)
+            res = self.get("members", *args, params=query, **kwargs)
             res.raise_for_status()
-            data = res.json()
+            data = decode(res)
+
             members = data.get("members", [])
-            for member in members:
-                yield member
-            offset += len(members)
+            offset = position.get("offset", 0) + len(members)
+            if len(members) > 0 and offset < data.get("total_items", 0):
+                return members, {"offset": offset}
+            return members, None
+
+        yield from paginate(fetch, cursor, attempts, backoff)
 
     @protect(default={})
     def get_member(self, email, *args, **kwargs):
@@ -150,5 +171,109 @@ class Mailchimp(Session):
         """
         res = self.get(f"members/{self.md5(email)}", *args, **kwargs)
         res.raise_for_status()
-        data = res.json()
+        data = decode(res)
         return data
+
+    def update_members(self, members, *args, chunk_size=500, **kwargs):
+        """Update existing members of a list in bulk, ``chunk_size``
+        members per request (Mailchimp accepts up to 500). Returns the
+        number of members updated.
+
+        Members Mailchimp refuses are logged and skipped.
+
+        :param members: Dicts with an ``email_address`` and whatever
+            should change, e.g. ``merge_fields``.
+        :param chunk_size: Maximum number of members per request.
+        :param args: Other positional arguments passed to each ``POST``
+            request.
+        :param kwargs: Other keyword arguments passed to each ``POST``
+            request.
+        """
+        updated = 0
+        for i in range(0, len(members), chunk_size):
+            body = {
+                "members": members[i:i + chunk_size],
+                "update_existing": True,
+            }
+            res = self.post("", *args, json=body, **kwargs)
+            res.raise_for_status()
+            data = decode(res)
+
+            updated += data.get("total_updated", 0)
+            for error in data.get("errors", []):
+                self.logger.error(
+                    f"Could not update member: {error.get('error')}"
+                )
+        return updated
+
+    @protect(default=[])
+    def get_segments(self, *args, cursor=None, attempts=3, backoff=0.5,
+                     **kwargs):
+        """Yields segments of a list, including tags, which Mailchimp
+        keeps as static segments. Paginated like
+        :meth:`~nest.apis.Mailchimp.get_members`.
+
+        :param args: Other positional arguments passed to each ``GET``
+            request.
+        :param cursor: Position to start from and advance.
+        :param attempts: Maximum number of attempts per page.
+        :param backoff: Initial delay between attempts, in seconds.
+        :param kwargs: Other keyword arguments passed to each ``GET``
+            request.
+        """
+        params = kwargs.pop("params", {})
+
+        def fetch(position):
+            query = dict(params, **position)
+            res = self.get("segments", *args, params=query, **kwargs)
+            res.raise_for_status()
+            data = decode(res)
+
+            segments = data.get("segments", [])
+            offset = position.get("offset", 0) + len(segments)
+            if len(segments) > 0 and offset < data.get("total_items", 0):
+                return segments, {"offset": offset}
+            return segments, None
+
+        yield from paginate(fetch, cursor, attempts, backoff)
+
+    def create_segment(self, name, *args, **kwargs):
+        """Create an empty static segment, i.e. a tag. Returns its id.
+
+        :param name: Name of the segment.
+        :param args: Other positional arguments passed to ``POST``
+            request.
+        :param kwargs: Other keyword arguments passed to ``POST``
+            request.
+        """
+        body = {"name": name, "static_segment": []}
+        res = self.post("segments", *args, json=body, **kwargs)
+        res.raise_for_status()
+        return decode(res).get("id")
+
+    def update_segment(self, segment_id, add=[], remove=[], *args,
+                       **kwargs):
+        """Add and remove members of a static segment, i.e. tag and
+        untag them, in one request. Mailchimp accepts up to 500 emails
+        of each. Returns the number of members added and removed.
+
+        Members Mailchimp refuses are logged and skipped.
+
+        :param segment_id: Id of the segment.
+        :param add: Emails to add.
+        :param remove: Emails to remove.
+        :param args: Other positional arguments passed to ``POST``
+            request.
+        :param kwargs: Other keyword arguments passed to ``POST``
+            request.
+        """
+        body = {"members_to_add": add, "members_to_remove": remove}
+        res = self.post(f"segments/{segment_id}", *args, json=body, **kwargs)
+        res.raise_for_status()
+        data = decode(res)
+
+        for error in data.get("errors", []):
+            self.logger.error(
+                f"Could not update segment {segment_id}: {error.get('error')}"
+            )
+        return data.get("total_added", 0), data.get("total_removed", 0)
@@ -0,0 +1,209 @@
+"""Mirror the members of a Mailchimp list in PostgreSQL.
+
+:func:`~nest.apis.mailchimp.sync.sync_members` remembers when each list
+was last synced, in :class:`~nest.engines.psql.models.MailchimpSync`,
+and only asks Mailchimp for the members changed since then
+(``since_last_changed``). They are merged into
+:class:`~nest.engines.psql.models.MailchimpMember` with bulk upserts::
+
+    session = PostgreSQLEngine().session()
+    mailchimp = Mailchimp()
+    mailchimp.default_list = "Customers"
+
+    sync_members(session, mailchimp)             # the whole list
+    sync_members(session, mailchimp)             # only what changed since
+
+Members deleted from the list are not returned by Mailchimp, and stay
+in the mirror; archived and unsubscribed members are updated.
+"""
+import json
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from hashlib import md5
+
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+
+from nest.apis.utils import Cursor
+from nest.engines.psql.models import MailchimpMember, MailchimpSync
+from nest.metrics import increment, timer
+
+# Only what the mirror stores is requested
+FIELDS = ",".join([
+    "members.id",
+    "members.email_address",
+    "members.status",
+    "members.merge_fields",
+    "members.tags",
+    "members.last_changed",
+    "total_items",
+])
+
+# The result of a sync: members received, members inserted or changed
+# in the mirror, and whether the listing ran to completion
+Synced = namedtuple("Synced", ["received", "upserted", "complete"])
+
+
+def parse_time(value):
+    """Turn one of Mailchimp's ISO 8601 timestamps into a naive UTC
+    ``datetime``, like the other ``DateTime`` columns. Returns None for
+    an empty value.
+
+    :param value: e.g. ``"2020-01-01T12:00:00+00:00"``.
+    """
+    if not(value):
+        return None
+    time = datetime.fromisoformat(value)
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
+
+def fingerprint(merge_fields, tags):
+    """Digest of a member's merge fields and tags, to tell whether they
+    changed without comparing them. The order of either does not
+    matter.
+
+    :param merge_fields: Dict of merge field names to values.
+    :param tags: Tag names.
+    """
+    content = json.dumps(
+        {"merge_fields": merge_fields, "tags": sorted(tags)},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str
+    )
+    return md5(content.encode()).hexdigest()
+
+def member_row(list_id, member):
+    """Turn a member from Mailchimp's API into a row of
+    :class:`~nest.engines.psql.models.MailchimpMember`.
+
+    :param list_id: Mailchimp list id.
+    :param member: Member dict.
+    """
+    merge_fields = member.get("merge_fields") or {}
+    tags = sorted(tag["name"] for tag in member.get("tags") or [])
+    return {
+        "list_id": list_id,
+        "id": member["id"],
+        "email": member.get("email_address", ""),
+        "status": member.get("status", ""),
+        "merge_fields": merge_fields,
+        "tags": tags,
+        "fingerprint": fingerprint(merge_fields, tags),
+        "last_changed": parse_time(member.get("last_changed")),
+    }
+
+def upsert_members(bind, rows):
+    """Insert or update mirrored members with a single
+    ``INSERT ... ON CONFLICT (list_id, id) DO UPDATE``. Members whose
+    ``last_changed`` and ``fingerprint`` did not change are not
+    rewritten. Returns the
+    number of members inserted or updated.
+
+    :param bind: Session or connection to execute on.
+    :param rows: List of :func:`~nest.apis.mailchimp.sync.member_row`
+        dicts. Of rows with the same key, the last one is used.
+    """
+    rows = {(row["list_id"], row["id"]): row for row in rows}
+    if len(rows) == 0:
+        return 0
+
+    table = MailchimpMember.__table__
+    statement = insert(table).values([rows[key] for key in sorted(rows)])
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.list_id, table.c.id],
+        set_={
+            name: statement.excluded[name]
+            for name in ("email", "status", "merge_fields", "tags",
+                         "fingerprint", "last_changed")
+        },
+        where=or_(
+            table.c.last_changed.is_distinct_from(
+                statement.excluded.last_changed
+            ),
+            table.c.fingerprint.is_distinct_from(
+                statement.excluded.fingerprint
+            )
+        )
+    )
+    return bind.execute(statement).rowcount
+
+def sync_members(session, mailchimp, list=None, full=False, page_size=1000,
+                 overlap=timedelta(minutes=5)):
+    """Bring the mirror of a list up to date. Returns a
+    :class:`~nest.apis.mailchimp.sync.Synced` tuple.
+
+    The members are committed a page at a time. The time of the sync is
+    only recorded once every member was received, so a sync that was
+    interrupted is picked up again by the next one.
+
+    :param session: Database session.
+    :param mailchimp: A :class:`~nest.apis.Mailchimp` session.
+    :param list: Name of the list. Defaults to
+        :class:`~nest.apis.Mailchimp.default_list`.
+    :param full: Fetch every member, not just the ones changed since
+        the last sync. Lists that were never synced are always fetched
+        in full.
+    :param page_size: Members requested, and upserted, at a time.
+    :param overlap: How far before the last sync to look for changes,
+        to allow for clock skew between Mailchimp and this host.
+    """
+    logger = logging.getLogger("nest")
+    name = list or mailchimp.default_list
+    list_id = mailchimp.lists.get(name)
+    if not(list_id):
+        raise ValueError(f"Unknown Mailchimp list: {name}")
+
+    state = session.query(MailchimpSync).get(list_id)
+    if state is None:
+        state = MailchimpSync(list_id=list_id, members=0)
+        session.add(state)
+
+    started = datetime.utcnow()
+    params = {"count": page_size, "fields": FIELDS}
+    if state.synced is not None and not(full):
+        since = state.synced - overlap
+        params["since_last_changed"] = since.replace(
+            tzinfo=timezone.utc
+        ).isoformat()
+
+    cursor = Cursor()
+    received, upserted, buffer = 0, 0, []
+
+    def flush():
+        nonlocal upserted
+        with timer("mailchimp.sync.upsert"):
+            upserted += upsert_members(session, buffer)
+        session.commit()
+        buffer.clear()
+
+    members = mailchimp.get_members(list=list_id, params=params,
+                                    cursor=cursor)
+    for member in members:
+        buffer.append(member_row(list_id, member))
+        received += 1
+        if len(buffer) >= page_size:
+            flush()
+    flush()
+
+    if cursor.done:
+        state = session.query(MailchimpSync).get(list_id)
+        state.synced = started
+        state.members = session.query(MailchimpMember).\
+            filter(MailchimpMember.list_id == list_id).\
+            count()
+        session.commit()
+    else:
+        logger.warning(
+            f"Mailchimp sync of {name} was interrupted after "
+            f"{received} members"
+        )
+
+    increment("mailchimp.sync.received", received)
+    increment("mailchimp.sync.upserted", upserted)
+    logger.info(
+        f"Synced {received} members of {name}, {upserted} changed"
+    )
+    return Synced(received, upserted, cursor.done)
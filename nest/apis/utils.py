@@ -1,9 +1,70 @@
+import json
 import logging
 from functools import wraps
+from inspect import isgeneratorfunction
 from json import JSONDecodeError
+from time import sleep
 
-from requests import HTTPError
+from requests import ConnectionError, HTTPError, RequestException, Timeout
 
+from nest.metrics import timer
+
+
+# Statuses worth retrying besides 5XX
+RETRY_STATUSES = [408, 429]
+
+def is_transient(error):
+    """True if ``error`` is a request error that may go away on retry:
+    connection errors, timeouts, 5XX and the statuses in
+    ``RETRY_STATUSES``.
+
+    :param error: A ``requests`` exception.
+    """
+    if isinstance(error, (ConnectionError, Timeout)):
+        return True
+    if isinstance(error, HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status in RETRY_STATUSES
+    return False
+
+def retry(fn, *args, attempts=3, backoff=0.5, **kwargs):
+    """Call ``fn`` and retry it on transient request errors (see
+    :func:`~nest.apis.utils.is_transient`), sleeping
+    ``backoff * 2 ** n`` seconds before the n-th retry. The last error
+    is raised if all attempts fail.
+
+    :param fn: The function to call.
+    :param args: Positional arguments passed to ``fn``.
+    :param attempts: Maximum number of calls.
+    :param backoff: Initial delay in seconds.
+    :param kwargs: Keyword arguments passed to ``fn``.
+    """
+    logger = logging.getLogger("nest")
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except (RequestException) as error:
+            if attempt + 1 >= attempts or not(is_transient(error)):
+                raise
+            delay = backoff * 2 ** attempt
+            logger.warning(f"Retrying in {delay:.2f}s after: {error}")
+            sleep(delay)
+
+def decode(response):
+    """Parse the JSON body of ``response``, timed as ``api.decode``.
+
+    :param response: A ``requests.Response``.
+    """
+    with timer("api.decode"):
+        return response.json()
+
+def _log_error(error):
+    logger = logging.getLogger("nest")
+    if isinstance(error, HTTPError):
+        url = error.response.url
+        logger.error(f"Could not get {url}: {error}")
+    else:
+        logger.error(f"Could not decode response JSON: {error}")
 
 def protect(default=None):
     """This decorator can be used on any method the requests some
@@ -16,22 +77,116 @@ def protect(default=None):
     catch these errors (HTTPError and JSONDecodeError) and return
     the ``default`` value.
 
+    Generator methods are only protected while they are iterated if
+    they were given a :class:`~nest.apis.utils.Cursor`: an error is
+    logged and ends the iteration, and the cursor tells that it did not
+    complete. Without a cursor the error is raised, so that a listing
+    is never silently cut short.
+
         :param default=None: Default value to return if exceptions are
         raised.
     """
     def wrapper(fn, *args, **kwargs):
+        if isgeneratorfunction(fn):
+            @wraps(fn)
+            def generator(self, *args, **kwargs):
+                try:
+                    yield from fn(self, *args, **kwargs)
+                except (HTTPError, JSONDecodeError) as error:
+                    _log_error(error)
+                    if kwargs.get("cursor") is None:
+                        raise
+            return generator
+
         @wraps(fn)
         def wrapped(self, *args, **kwargs):
-            logger = logging.getLogger("nest")
-
             rv = None
             try:
                 rv = fn(self, *args, **kwargs)
-            except (HTTPError) as error:
-                url = error.response.url
-                logger.error(f"Could not get {url}: {error}")
-            except (JSONDecodeError) as error:
-                logger.error(f"Could not decode response JSON: {error}")
+            except (HTTPError, JSONDecodeError) as error:
+                _log_error(error)
             return rv or default
         return wrapped
     return wrapper
+
+class Cursor(object):
+    """Position of a paginated listing, e.g.
+    :meth:`~nest.apis.FastSpring.get_orders`. Pass one in to be able
+    to resume the listing later::
+
+        cursor = Cursor()
+        for order in session.get_orders(cursor=cursor):
+            ...
+
+        if not(cursor.done):
+            saved = cursor.dumps()
+            ...
+            cursor = Cursor.loads(saved)
+            for order in session.get_orders(cursor=cursor):
+                ...
+
+    The cursor only advances once every item of a page was consumed,
+    so a resumed listing may repeat items of the page it stopped in,
+    but never skips any.
+
+    :param position: Query params of the next page, e.g. ``page``,
+        ``begin`` or ``offset``. Empty for the first page.
+
+    :var done: True once the last page was consumed.
+    :var error: The error that stopped the listing, if any.
+    """
+    def __init__(self, position=None):
+        self.position = position or {}
+        self.done = False
+        self.error = None
+
+    def dumps(self):
+        """Serialize the cursor to a JSON string.
+        """
+        return json.dumps({"position": self.position, "done": self.done})
+
+    @classmethod
+    def loads(cls, data):
+        """Restore a cursor from :meth:`~nest.apis.utils.Cursor.dumps`.
+        """
+        data = json.loads(data)
+        cursor = cls(data.get("position"))
+        cursor.done = data.get("done", False)
+        return cursor
+
+    def __repr__(self):
+        return f"<Cursor position={self.position} done={self.done}>"
+
+def paginate(fetch, cursor=None, attempts=3, backoff=0.5):
+    """Yields the items of every page of a listing, retrying each page
+    on transient errors (see :func:`~nest.apis.utils.retry`).
+
+    :param fetch: Called with the position of a page, returns that
+        page's items and the position of the next page, or ``None``
+        after the last page.
+    :param cursor: A :class:`~nest.apis.utils.Cursor` to start from and
+        advance.
+    :param attempts: Maximum number of attempts per page.
+    :param backoff: Initial delay between attempts, in seconds.
+    """
+    cursor = cursor or Cursor()
+    while not(cursor.done):
+        try:
+            items, position = retry(
+                fetch,
+                dict(cursor.position),
+                attempts=attempts,
+                backoff=backoff
+            )
+        except (RequestException, JSONDecodeError) as error:
+            cursor.error = error
+            raise
+
+        for item in items:
+            yield item
+
+        cursor.error = None
+        if position is None:
+            cursor.done = True
+        else:
+            cursor.position = position
@@ -1,10 +1,18 @@
 import logging
+import os
+from copy import deepcopy
 from pathlib import Path
-from configparser import ConfigParser
+from configparser import ConfigParser, Error
+from threading import Event, Lock, Thread
 
 class Config(object):
     def __init__(self, path=None):
         self.path = path or Path("./config.cfg")
+        self._subscribers = []
+        self._lock = Lock()
+        self._stopped = Event()
+        self._watcher = None
+        self._signature = None
 
         self.parser = ConfigParser()
         self.parser.read(self.path)
@@ -23,6 +31,84 @@ class Config(object):
             fallback="info"
         )
 
+        self.transactionlogFormat = self.parser.get(
+            "nest",
+            "transactionlogFormat",
+            fallback="text"
+        )
+
+        self.transactionlogFile = self.parser.get(
+            "nest",
+            "transactionlogFile",
+            fallback=None
+        )
+
+        self.transactionlogMaxBytes = self.parser.getint(
+            "nest",
+            "transactionlogMaxBytes",
+            fallback=0
+        )
+
+        self.transactionlogWhen = self.parser.get(
+            "nest",
+            "transactionlogWhen",
+            fallback=None
+        )
+
+        self.transactionlogBackupCount = self.parser.getint(
+            "nest",
+            "transactionlogBackupCount",
+            fallback=7
+        )
+
+        self.transactionlogCompress = self.parser.getboolean(
+            "nest",
+            "transactionlogCompress",
+            fallback=False
+        )
+
+        self.transactionlogBuffer = self.parser.getint(
+            "nest",
+            "transactionlogBuffer",
+            fallback=1
+        )
+
+        self.logQueue = self.parser.getboolean(
+            "nest",
+            "logQueue",
+            fallback=False
+        )
+
+        self.logQueueSize = self.parser.getint(
+            "nest",
+            "logQueueSize",
+            fallback=10000
+        )
+
+        self.logQueuePolicy = self.parser.get(
+            "nest",
+            "logQueuePolicy",
+            fallback="drop"
+        )
+
+        self.metrics = self.parser.getboolean(
+            "nest",
+            "metrics",
+            fallback=False
+        )
+
+        self.metricsFile = self.parser.get(
+            "nest",
+            "metricsFile",
+            fallback=None
+        )
+
+        self.metricsFormat = self.parser.get(
+            "nest",
+            "metricsFormat",
+            fallback="prometheus"
+        )
+
         fs_auth_user = self.parser.get("nest", "FS_AUTH_USER", fallback="foo")
         fs_auth_pass = self.parser.get("nest", "FS_AUTH_PASS", fallback="bar")
         self.fastspring_auth = (fs_auth_user, fs_auth_pass)
@@ -31,6 +117,13 @@ class Config(object):
         mc_auth_token = self.parser.get("nest", "MC_AUTH_TOKEN", fallback="bar")
         self.mailchimp_auth = (mc_auth_user, mc_auth_token)
 
+        self.postgres_pool_options = {}
+        pool_keys = ["pool_size", "max_overflow", "pool_timeout", "pool_recycle"]
+        for key in pool_keys:
+            value = self.parser.getint("nest:postgresql", key, fallback=None)
+            if value is not None:
+                self.postgres_pool_options.update({key:value})
+
         self.postgres_connection_info = {}
         for key in ["host", "port", "username", "password", "database"]:
             value = self.parser.get("nest:postgresql", key, fallback=None)
@@ -71,3 +164,118 @@ class Config(object):
                         node_info.update({key: value})
             if len(node_info) > 0:
                 self.redis_node_list.append(node_info)
+
+    def values(self):
+        """A copy of all config values, keyed by attribute name.
+        """
+        values = {}
+        for key, value in vars(self).items():
+            if key in ["path", "parser"] or key.startswith("_"):
+                continue
+            values[key] = deepcopy(value)
+        return values
+
+    def subscribe(self, callback):
+        """Call ``callback(config, changes)`` whenever
+        :meth:`~nest.config.Config.refresh` changes any value.
+        ``changes`` maps attribute names to ``(old, new)`` tuples.
+
+        ::
+
+            config.subscribe(logger.reconfigure)
+            config.subscribe(engine.reconfigure)
+            config.watch()
+
+        :param callback: The subscriber.
+        """
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop notifying ``callback`` of changes.
+        """
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def refresh(self):
+        """Re-read the config file, re-parse it and notify subscribers
+        of the values that changed. If the file cannot be parsed, all
+        values are kept as they are.
+
+        Returns the changes, see
+        :meth:`~nest.config.Config.subscribe`.
+        """
+        logger = logging.getLogger("nest")
+        with self._lock:
+            old, parser = self.values(), self.parser
+            try:
+                self.parser = ConfigParser()
+                self.parser.read(self.path)
+                self.reload()
+            except (Error, ValueError) as ex:
+                logger.error(f"Could not reload {self.path}: {ex}")
+                self.parser = parser
+                self.reload()
+                return {}
+            new = self.values()
+
+            changes = {}
+            for key in set(old) | set(new):
+                if old.get(key) != new.get(key):
+                    changes[key] = (old.get(key), new.get(key))
+
+            if len(changes) > 0:
+                for callback in list(self._subscribers):
+                    try:
+                        callback(self, changes)
+                    except (Exception) as ex:
+                        logger.error(f"Config subscriber failed: {ex}")
+        return changes
+
+    def signature(self):
+        """Modification time, size and inode of the config file, or
+        ``None`` if it does not exist. Cheap enough to poll.
+        """
+        try:
+            stat = os.stat(self.path)
+        except (OSError):
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def watch(self, interval=1.0):
+        """Poll the config file for changes in a background thread and
+        :meth:`~nest.config.Config.refresh` when it changed.
+
+        The thread sleeps on an ``Event`` between polls, so it costs a
+        single ``stat()`` per ``interval`` and stops promptly with
+        :meth:`~nest.config.Config.unwatch`.
+
+        :param interval: Seconds between polls.
+        """
+        if self._watcher and self._watcher.is_alive():
+            return
+
+        self._stopped.clear()
+        self._signature = self.signature()
+        self._watcher = Thread(
+            target=self._watch,
+            args=(interval,),
+            name="nest-config-watch",
+            daemon=True
+        )
+        self._watcher.start()
+
+    def _watch(self, interval):
+        while not(self._stopped.wait(interval)):
+            signature = self.signature()
+            if signature != self._signature:
+                self._signature = signature
+                self.refresh()
+
+    def unwatch(self):
+        """Stop watching the config file.
+        """
+        self._stopped.set()
+        if self._watcher:
+            self._watcher.join()
+            self._watcher = None
@@ -1,4 +1,10 @@
-from nest.engines.psql import PostgreSQLEngine
-from nest.engines.redis import RedisEngine, LockFactory
+from nest.types import lazy_attributes
 
-__all__ = ["PostgreSQLEngine", "RedisEngine", "LockFactory"]
\ No newline at end of file
+__all__ = ["PostgreSQLEngine", "RedisEngine", "LockFactory"]
+
+# SQLAlchemy, redis and redlock are only imported when needed
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "PostgreSQLEngine": "nest.engines.psql",
+    "RedisEngine": "nest.engines.redis",
+    "LockFactory": "nest.engines.redis",
+})
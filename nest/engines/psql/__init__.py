@@ -1 +1,5 @@
-from nest.engines.psql.engine import PostgreSQLEngine
\ No newline at end of file
+from nest.types import lazy_attributes
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "PostgreSQLEngine": "nest.engines.psql.engine",
+})
@@ -0,0 +1,134 @@
+"""Set-based writes, for batches that would otherwise take one ORM
+round trip per row.
+
+SQLAlchemy 1.3 has no ``VALUES`` construct, so the statements are
+assembled here from the table definition, with every value bound::
+
+    update_from_values(session, User.__table__, "email", [
+        {"email": "jane@example.com", "subscribed": True},
+        {"email": "john@example.com", "subscribed": False},
+    ])
+
+    users = upsert_users(session, [{"email": "jane@example.com"}])
+"""
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
+
+from nest.engines.psql.models import User
+
+USER_DEFAULTS = {"first": "John", "last": "Doe"}
+
+
+def update_from_values(bind, table, key, rows, only_changed=True,
+                       ignore_case=False):
+    """Update many rows of ``table`` in a single
+    ``UPDATE ... FROM (VALUES ...)`` statement. Returns the number of
+    rows updated.
+
+    :param bind: Session or connection to execute on.
+    :param table: The ``Table`` to update.
+    :param key: Name of the column rows are matched on.
+    :param rows: List of dicts of column names to new values. Every
+        dict must have the same keys, including ``key``.
+    :param only_changed: Skip rows whose values are already up to
+        date, so that they are not rewritten.
+    :param ignore_case: Match ``key`` on ``lower()`` of both sides,
+        e.g. to use the ``lower(email)`` index of ``users``.
+    """
+    if len(rows) == 0:
+        return 0
+
+    dialect = postgresql.dialect()
+    names = list(rows[0])
+    columns = [name for name in names if name != key]
+    types = {
+        name: table.c[name].type.compile(dialect=dialect) for name in names
+    }
+
+    params, values = {}, []
+    for i, row in enumerate(rows):
+        binds = []
+        for j, name in enumerate(names):
+            params[f"v{i}_{j}"] = row[name]
+            # Casting the first row types the whole VALUES list
+            if i == 0:
+                binds.append(f"CAST(:v{i}_{j} AS {types[name]})")
+            else:
+                binds.append(f":v{i}_{j}")
+        values.append(f"({', '.join(binds)})")
+
+    match = f"{table.name}.{key} = v.{key}"
+    if ignore_case:
+        match = f"lower({table.name}.{key}) = lower(v.{key})"
+
+    assignments = ", ".join(f"{name} = v.{name}" for name in columns)
+    statement = (
+        f"UPDATE {table.name} SET {assignments} "
+        f"FROM (VALUES {', '.join(values)}) AS v ({', '.join(names)}) "
+        f"WHERE {match}"
+    )
+    if only_changed:
+        old = ", ".join(f"{table.name}.{name}" for name in columns)
+        new = ", ".join(f"v.{name}" for name in columns)
+        statement += f" AND ({old}) IS DISTINCT FROM ({new})"
+
+    return bind.execute(text(statement), params).rowcount
+
+def _default(column):
+    default = column.default
+    if default is None:
+        return None
+    if default.is_callable:
+        return default.arg(None)
+    return default.arg
+
+def upsert_users(bind, contacts, update=[]):
+    """Make sure a user exists for every contact, with a single
+    ``INSERT ... ON CONFLICT (email) DO UPDATE ... RETURNING``. Returns
+    a dict of emails to user ids.
+
+    Emails are matched case-insensitively and the returned dict is
+    keyed by normalized emails (see
+    :meth:`~nest.engines.psql.models.User.normalize`). Contacts are
+    written in that order, so that concurrent upserts of overlapping
+    batches lock rows in the same order. Of contacts with the same
+    email, the last one is used.
+
+    :param bind: Session or connection to execute on.
+    :param contacts: List of dicts with at least an ``email``, and any
+        other :class:`~nest.engines.psql.models.User` columns. Names
+        default to "John Doe", like in
+        :mod:`~nest.apis.fastspring.events`.
+    :param update: Columns to overwrite on existing users. By default
+        existing users are left as they are.
+    """
+    rows = {}
+    for contact in contacts:
+        if contact.get("email"):
+            email = User.normalize(contact["email"])
+            rows[email] = dict(USER_DEFAULTS, **contact)
+    if len(rows) == 0:
+        return {}
+
+    table = User.__table__
+    names = set(name for row in rows.values() for name in row)
+    values = []
+    for email in sorted(rows):
+        row = rows[email]
+        values.append({
+            name: row[name] if name in row else _default(table.c[name])
+            for name in names
+        })
+
+    # Updating something is what makes existing rows returned
+    statement = insert(table).values(values)
+    statement = statement.on_conflict_do_update(
+        index_elements=[User.normalized_email],
+        set_={name: statement.excluded[name] for name in update} or {
+            "email": table.c.email
+        }
+    ).returning(table.c.email, table.c.id)
+
+    rows = bind.execute(statement).fetchall()
+    return {User.normalize(email): id for email, id in rows}
@@ -8,8 +8,11 @@ from sqlalchemy.event import contains, listen, remove
 from sqlalchemy.exc import (InvalidRequestError, OperationalError,
                             SQLAlchemyError)
 from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from nest.engines.psql.models import Base
+from nest.engines.psql.profiling import QueryProfiler
+from nest.metrics import instrument
 from nest.types import Singleton
 
 
@@ -26,7 +29,16 @@ class SelfDestructingSession(Session):
         self.factory.remove()
 
 class PostgreSQLEngine(Engine):
-    """An ``Engine`` connected a PostgreSQL database"""
+    """An ``Engine`` connected a PostgreSQL database
+
+    :param url: Database URL. Built from ``connection_info`` if not
+        given.
+    :param lazy: Defer the connection probe and schema creation until
+        the first connection is made.
+    :param create_schema: Create any missing tables. Disable this when
+        the schema is managed by Alembic.
+    :param kwargs: Passed to ``create_engine()``.
+    """
     DEFAULT_CONNECTION_INFO = {
         "drivername": "postgresql",
         "host": "localhost",
@@ -35,35 +47,119 @@ class PostgreSQLEngine(Engine):
         "password": "",
         "database": None,
     }
-    def __init__(self, url=None, **kwargs):
+    def __init__(self, url=None, lazy=False, create_schema=True, **kwargs):
         self.error_logger = logging.getLogger("nest")
         self.transaction_logger = logging.getLogger("nest.transaction")
 
         if not(url):
-            connection_info = kwargs.pop("connection_info", {})
-            connection_info.pop("drivername", None)
-            self.DEFAULT_CONNECTION_INFO.update(connection_info)
+            connection_info = dict(self.DEFAULT_CONNECTION_INFO)
+            connection_info.update(kwargs.pop("connection_info", {}))
+            connection_info["drivername"] = "postgresql"
+            url = URL(**connection_info)
 
         try:
-            meta = create_engine(
-                url or URL(**self.DEFAULT_CONNECTION_INFO),
-                **kwargs
-            )
+            meta = create_engine(url, **kwargs)
             self.__dict__.update(meta.__dict__)
         except (SQLAlchemyError) as ex:
             self.error_logger.error(f"Could not create engine: {ex}")
 
-        try:
-            with self.connect():
-                self.connected = True
-        except (OperationalError) as ex:
-            self.connected = False
-            self.error_logger.error(f"Cannot connect to database: {ex}")
+        self._connected = None
+        self.schema_on_connect = create_schema
 
         self.session_factory = sessionmaker(bind=self)
         self.scoped_session_factory = scoped_session(self.session_factory)
+        instrument(self.session_factory)
+
+        if lazy:
+            self.add_listener("engine_connect", self._first_connect, once=True)
+        elif create_schema and self.connected:
+            self.create_schema()
 
-        Base.metadata.create_all(self)
+    def _first_connect(self, connection, branch):
+        """``engine_connect`` callback for lazy engines. Runs the
+        deferred startup work on the first real connection.
+        """
+        self._connected = True
+        if self.schema_on_connect:
+            self.create_schema(connection)
+
+    @property
+    def connected(self):
+        """True if the database is reachable. The database is only
+        probed the first time this is read (or, for lazy engines,
+        when the first connection is made).
+        """
+        if self._connected is None:
+            try:
+                with self.connect():
+                    self._connected = True
+            except (OperationalError) as ex:
+                self.error_logger.error(f"Cannot connect to database: {ex}")
+                return False
+        return self._connected
+
+    def create_schema(self, bind=None):
+        """Create any tables defined in
+        :mod:`~nest.engines.psql.models` that do not exist yet.
+
+        This is done by the constructor unless ``create_schema`` is
+        ``False``. Deployments managed by Alembic should skip it and
+        run their migrations instead.
+
+        :param bind: Engine or connection to use. Defaults to this
+            engine.
+        """
+        Base.metadata.create_all(bind or self)
+
+    def resize_pool(self, pool_size=None, max_overflow=None,
+                    pool_timeout=None, pool_recycle=None):
+        """Swap the connection pool for one with new settings, e.g.
+        after a config change. Options left as ``None`` keep their
+        current value. Idle connections are closed; checked out ones
+        keep working until they are returned.
+
+        :param pool_size: See ``create_engine()``.
+        :param max_overflow: See ``create_engine()``.
+        :param pool_timeout: See ``create_engine()``.
+        :param pool_recycle: See ``create_engine()``.
+        """
+        if not(isinstance(self.pool, QueuePool)):
+            self.error_logger.error(
+                f"Cannot resize {type(self.pool).__name__}"
+            )
+            return
+
+        # The old pool is only read from. Its dialect and events, e.g.
+        # the dialect's `connect` listeners, carry over
+        old = self.pool
+        pool = QueuePool(
+            old._creator,
+            pool_size=old.size() if pool_size is None else pool_size,
+            max_overflow=(
+                old._max_overflow if max_overflow is None else max_overflow
+            ),
+            timeout=old.timeout() if pool_timeout is None else pool_timeout,
+            recycle=old._recycle if pool_recycle is None else pool_recycle,
+            pre_ping=old._pre_ping,
+            use_lifo=old._pool.use_lifo,
+            echo=old.echo,
+            logging_name=old._orig_logging_name,
+            reset_on_return=old._reset_on_return,
+            dialect=old._dialect,
+            _dispatch=old.dispatch
+        )
+        self.pool = pool
+        old.dispose()
+
+    def reconfigure(self, cfg, changes):
+        """:meth:`~nest.config.Config.subscribe` callback that applies
+        changed ``[nest:postgresql]`` pool options.
+
+        :param cfg: The :class:`~nest.config.Config`.
+        :param changes: Changed values.
+        """
+        if "postgres_pool_options" in changes:
+            self.resize_pool(**cfg.postgres_pool_options)
 
     def add_listener(self, event, func, *args, **kwargs):
         """Adds event callback function. Class instance is passed to
@@ -95,6 +191,17 @@ class PostgreSQLEngine(Engine):
                 message = f"Cannot remove listener from `{event}`: {ex}"
                 self.error_logger.error(message)
 
+    def profile(self, **kwargs):
+        """Create a
+        :class:`~nest.engines.psql.profiling.QueryProfiler` for this
+        engine. Use it as a context manager, or call ``start()`` and
+        ``stop()``.
+
+        :param kwargs: Passed to
+            :class:`~nest.engines.psql.profiling.QueryProfiler`.
+        """
+        return QueryProfiler(self, **kwargs)
+
     def session(self, **kwargs):
         """Create a ``Session`` for querying the database.
 
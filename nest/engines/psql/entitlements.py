@@ -0,0 +1,124 @@
+"""What every user owns, in one query.
+
+The :class:`~nest.engines.psql.models.User` hybrids, e.g.
+:meth:`~nest.engines.psql.models.User.highest_version_in_set` or
+:meth:`~nest.engines.psql.models.User.owns_current_in_set`, answer for
+one user and one set at a time. To export them for all users at
+once, :func:`~nest.engines.psql.entitlements.entitlements` aggregates
+the products of every order that was not returned, per user and set::
+
+    for user in entitlements(session):
+        print(user.email, user.versions)
+"""
+from sqlalchemy import (
+    and_,
+    false,
+    func,
+    literal_column,
+    not_,
+    or_,
+    select
+)
+
+from nest.engines.psql.models import (
+    Order,
+    OrderProductAssociation,
+    Product,
+    Return,
+    User
+)
+
+
+def owned():
+    """Subquery of the sets each user owns products of, with:
+
+    - ``user_id`` and ``set``.
+    - ``version``: the highest version owned of the set, like
+      :meth:`~nest.engines.psql.models.User.highest_version_in_set`,
+      or NULL if only demos of the set are owned.
+    - ``current``: whether the current version is owned, like
+      :meth:`~nest.engines.psql.models.User.owns_current_in_set`.
+    - ``paid``: whether a product with a price is owned, like
+      :class:`~nest.engines.psql.models.User.owns_any_paid`.
+    - ``demo``: whether only demos of the set are owned.
+
+    Orders are left out when they were returned, in the sense of
+    :class:`~nest.engines.psql.models.Order.returned`.
+    """
+    returned = select([
+        Return.order_id,
+        func.sum(Return.amount).label("amount")
+    ]).group_by(Return.order_id).alias("returned")
+
+    version = func.max(Product.version).filter(not_(Product.demo))
+    statement = select([
+        Order.user_id,
+        Product.set,
+        version.label("version"),
+        func.bool_or(and_(Product.current, not_(Product.demo))).\
+            label("current"),
+        func.bool_or(Product.price > 0).label("paid"),
+        func.bool_and(Product.demo).label("demo"),
+    ]).select_from(
+        Order.__table__.\
+            join(
+                OrderProductAssociation.__table__,
+                OrderProductAssociation.order_id == Order.id
+            ).\
+            join(
+                Product.__table__,
+                Product.id == OrderProductAssociation.product_id
+            ).\
+            outerjoin(returned, returned.c.order_id == Order.id)
+    ).where(
+        and_(
+            Order.user_id != None,
+            or_(returned.c.amount == None, returned.c.amount < Order.total)
+        )
+    ).group_by(Order.user_id, Product.set)
+    return statement.alias("owned")
+
+def entitlements(session):
+    """Query of every user, ordered by id, with what they own. Each row
+    has the user's ``id``, ``email``, ``first``, ``last`` and
+    ``subscribed``, and:
+
+    - ``versions``: a dict of set names to the highest version owned,
+      without sets of which only demos are owned.
+    - ``current``: names of the sets whose current version is owned.
+    - ``paid``: whether any product with a price is owned.
+    - ``demo``: whether products are owned, but only demos.
+
+    The query can be narrowed or joined further like any other.
+
+    :param session: Database session.
+    """
+    sets = owned()
+    versions = func.jsonb_object_agg(sets.c.set, sets.c.version).\
+        filter(sets.c.version != None)
+    current = func.array_agg(sets.c.set).filter(sets.c.current)
+    per_user = select([
+        sets.c.user_id,
+        versions.label("versions"),
+        current.label("current"),
+        func.bool_or(sets.c.paid).label("paid"),
+        func.bool_and(sets.c.demo).label("demo"),
+    ]).group_by(sets.c.user_id).alias("per_user")
+
+    return session.query(
+        User.id,
+        User.email,
+        User.first,
+        User.last,
+        User.subscribed,
+        func.coalesce(
+            per_user.c.versions,
+            literal_column("'{}'::jsonb")
+        ).label("versions"),
+        func.coalesce(
+            per_user.c.current,
+            literal_column("'{}'::text[]")
+        ).label("current"),
+        func.coalesce(per_user.c.paid, false()).label("paid"),
+        func.coalesce(per_user.c.demo, false()).label("demo")
+    ).outerjoin(per_user, per_user.c.user_id == User.id).order_by(User.id)
@@ -4,8 +4,10 @@ from hashlib import md5
 from sqlalchemy import (
     Boolean,
     Column,
+    Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     Text,
     and_,
@@ -14,16 +16,19 @@ from sqlalchemy import (
     func,
     not_,
     select,
+    text,
     DECIMAL
 )
 
-from sqlalchemy.dialects.postgresql import array_agg
+from sqlalchemy.dialects.postgresql import JSONB, array_agg
 from sqlalchemy.dialects.postgresql.array import ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Sequence
 
+from nest.engines.psql.pagination import keyset
+
 PRICE = DECIMAL(10, 2)
 
 Base = declarative_base()
@@ -66,8 +71,14 @@ class User(Base):
     :var subscribed: Plugged-In Membership status.
 
     :var orders: List of orders belonging to this user.
+
+    Emails are matched case-insensitively, see
+    :class:`~nest.engines.psql.models.User.normalized_email`.
     """
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_email_lower", func.lower(text("email")), unique=True),
+    )
 
     id                 = Column(Integer, primary_key=True)
     email              = Column(Text, unique=True, nullable=False)
@@ -94,9 +105,41 @@ class User(Base):
     )
 
     def __repr__(self):
-        _hash = md5(self.email.encode()).hexdigest()
+        _hash = md5(self.normalized_email.encode()).hexdigest()
         return f"<User hash='{_hash}'>"
 
+    @classmethod
+    def normalize(cls, email):
+        """The form emails are compared in: lowercase. Empty emails are
+        returned as they are.
+        """
+        return email.lower() if email else email
+
+    @hybrid_property
+    def normalized_email(self):
+        """The email in the form used for comparisons (see
+        :meth:`~nest.engines.psql.models.User.normalize`). As an
+        expression, ``lower(email)``, which is uniquely indexed::
+
+            query.filter(User.normalized_email == User.normalize(email))
+        """
+        return self.normalize(self.email)
+
+    @normalized_email.expression
+    def normalized_email(cls):
+        return func.lower(cls.email)
+
+    @classmethod
+    def page(cls, session, after=None, limit=100):
+        """A :class:`~nest.engines.psql.pagination.Page` of users
+        ordered by ``id``.
+
+        :param session: Database session.
+        :param after: Cursor of the previous page.
+        :param limit: Maximum number of users per page.
+        """
+        return keyset(session.query(cls), [cls.id], after, limit)
+
     @hybrid_property
     def products(self):
         """Products belonging to this user.
@@ -168,7 +211,7 @@ class User(Base):
                             Product.id == OrderProductAssociation.product_id
                         ).\
                         where(Product.price > 0)
-        return statement.label("any-paid")
+        return statement.limit(1).label("any-paid")
 
     @hybrid_method
     def owns_any_in_set(self, value):
@@ -195,7 +238,7 @@ class User(Base):
                     where(Order.id == OrderProductAssociation.order_id).\
                     where(Product.id == OrderProductAssociation.product_id).\
                     where(and_(Product.set == value, not_(Product.demo)))
-        return statement.label(f"owns-any-{value}")
+        return statement.limit(1).label(f"owns-any-{value}")
 
     @hybrid_method
     def owns_current_in_set(self, value):
@@ -230,7 +273,7 @@ class User(Base):
                                 not_(Product.demo)
                             )
                         )
-        return statement.label(f"any-current-{value}")
+        return statement.limit(1).label(f"any-current-{value}")
 
     @hybrid_method
     def highest_version_in_set(self, value):
@@ -282,6 +325,12 @@ class Order(Base):
     :var returns: Returns belonging to this order.
     """
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_created_id", "created", "id"),
+        Index("ix_orders_live_created_id", "live", "created", "id"),
+        Index("ix_orders_coupons", "coupons", postgresql_using="gin"),
+        Index("ix_orders_paths", "paths", postgresql_using="gin"),
+    )
 
     id        = Column(Integer, primary_key=True)
     reference = Column(Text, unique=True, nullable=False)
@@ -342,6 +391,106 @@ class Order(Base):
                             >= cls.total
         return statement.label("order-returned")
 
+    @hybrid_method
+    def has_coupon(self, value):
+        """True if the given coupon was applied to this order.
+
+        :param value: The coupon code.
+        """
+        return value in (self.coupons or [])
+
+    @has_coupon.expression
+    def has_coupon(cls, value):
+        # `@>` can use the GIN index, `= ANY()` cannot
+        return cls.coupons.contains([value])
+
+    @hybrid_method
+    def has_path(self, value):
+        """True if any item of this order was triggered by the given
+        product path.
+
+        :param value: The product path or id.
+        """
+        return value in (self.paths or [])
+
+    @has_path.expression
+    def has_path(cls, value):
+        return cls.paths.contains([value])
+
+    @classmethod
+    def coupon_usage(cls, session, begin=None, end=None, live=None):
+        """Number of orders, and the sum of their totals and
+        discounts, per coupon; most used first.
+
+        :param session: Database session.
+        :param begin: Only orders created at or after this date.
+        :param end: Only orders created before this date.
+        :param live: Only live (or test) orders, if not ``None``.
+        """
+        return cls._array_usage(session, cls.coupons, begin, end, live)
+
+    @classmethod
+    def path_usage(cls, session, begin=None, end=None, live=None):
+        """Number of orders, and the sum of their totals and
+        discounts, per product path; most used first.
+
+        :param session: Database session.
+        :param begin: Only orders created at or after this date.
+        :param end: Only orders created before this date.
+        :param live: Only live (or test) orders, if not ``None``.
+        """
+        return cls._array_usage(session, cls.paths, begin, end, live)
+
+    @classmethod
+    def _array_usage(cls, session, column, begin, end, live):
+        value = func.unnest(column).label("value")
+        query = session.query(value, cls.total, cls.discount)
+        if begin is not None:
+            query = query.filter(cls.created >= begin)
+        if end is not None:
+            query = query.filter(cls.created < end)
+        if live is not None:
+            query = query.filter(cls.live == live)
+
+        unnested = query.subquery()
+        orders = func.count().label("orders")
+        statement = session.query(
+            unnested.c.value,
+            orders,
+            func.sum(unnested.c.total).label("total"),
+            func.sum(unnested.c.discount).label("discount")
+        ).group_by(unnested.c.value).order_by(orders.desc(), unnested.c.value)
+        return statement.all()
+
+    @classmethod
+    def page(cls, session, after=None, limit=100, live=None, gift=None,
+             returned=None):
+        """A :class:`~nest.engines.psql.pagination.Page` of orders
+        ordered by ``(created, id)``.
+
+        :param session: Database session.
+        :param after: Cursor of the previous page.
+        :param limit: Maximum number of orders per page.
+        :param live: Only live (or test) orders, if not ``None``.
+        :param gift: Only gifted (or non-gifted) orders, if not
+            ``None``.
+        :param returned: Only returned (or non-returned) orders, if
+            not ``None``.
+        """
+        query = session.query(cls)
+        if live is not None:
+            query = query.filter(cls.live == live)
+        if gift is not None:
+            query = query.filter(cls.gift == gift)
+        if returned is not None:
+            if returned:
+                query = query.filter(cls.returned)
+            else:
+                query = query.filter(
+                    or_(cls.returned == None, not_(cls.returned))
+                )
+        return keyset(query, [cls.created, cls.id], after, limit)
+
     def __repr__(self):
         return f"<Order reference='{self.reference}'>"
 
@@ -432,3 +581,122 @@ class Product(Base):
 
     def __repr__(self):
         return f"<Product name='{self.name}'>"
+
+class ProductSales(Base):
+    """Daily sales statistics of a product, maintained by
+    :mod:`~nest.engines.psql.rollups`.
+
+    Orders count towards every product in them, the same as joining
+    orders to products would. Returns count towards the day and
+    products of their original order.
+
+    :var day: Day the orders were created.
+    :var orders: Number of orders.
+    :var gifts: Number of gifted orders.
+    :var total: Sum of order totals in USD.
+    :var discount: Sum of order discounts in USD.
+    :var coupons: Number of orders with at least one coupon applied.
+    :var returns: Number of returns.
+    :var returned: Sum of return amounts in USD.
+
+    :var product_id: ``Product.id`` foreign-key.
+    :var product: The product these statistics belong to.
+    """
+    __tablename__ = "product_sales"
+
+    day      = Column(Date, primary_key=True)
+    orders   = Column(Integer, nullable=False, default=0)
+    gifts    = Column(Integer, nullable=False, default=0)
+    total    = Column(PRICE, nullable=False, default=0)
+    discount = Column(PRICE, nullable=False, default=0)
+    coupons  = Column(Integer, nullable=False, default=0)
+    returns  = Column(Integer, nullable=False, default=0)
+    returned = Column(PRICE, nullable=False, default=0)
+
+    product_id = Column(
+        Integer,
+        ForeignKey(
+            "products.id",
+            onupdate="cascade",
+            ondelete="cascade"
+        ),
+        primary_key=True
+    )
+
+    product = relationship("Product")
+
+    def __repr__(self):
+        return f"<ProductSales day='{self.day}' product='{self.product_id}'>"
+
+class DeadLetter(Base):
+    """A raw webhook event that could not be stored, kept for replay
+    by :class:`~nest.apis.fastspring.ingest.Writer`.
+
+    :var id: Primary key.
+    :var event_id: FastSpring event id.
+    :var type: Event type.
+    :var payload: The raw event.
+    :var error: The error raised while storing it.
+    :var attempts: Number of times storing it failed.
+    :var created: When it first failed.
+    """
+    __tablename__ = "dead_letters"
+
+    id       = Column(Integer, primary_key=True)
+    event_id = Column(Text, nullable=False, default="")
+    type     = Column(Text, nullable=False, default="")
+    payload  = Column(JSONB, nullable=False)
+    error    = Column(Text, nullable=False, default="")
+    attempts = Column(Integer, nullable=False, default=1)
+    created  = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DeadLetter event_id='{self.event_id}' type='{self.type}'>"
+
+class MailchimpSync(Base):
+    """When a Mailchimp list was last mirrored, see
+    :mod:`~nest.apis.mailchimp.sync`.
+
+    :var list_id: Mailchimp list id.
+    :var synced: When the last complete sync started.
+    :var members: Number of members in the mirror after it.
+    """
+    __tablename__ = "mailchimp_syncs"
+
+    list_id = Column(Text, primary_key=True)
+    synced  = Column(DateTime)
+    members = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<MailchimpSync list='{self.list_id}' synced='{self.synced}'>"
+
+class MailchimpMember(Base):
+    """Local mirror of a member of a Mailchimp list, kept up to date by
+    :mod:`~nest.apis.mailchimp.sync`.
+
+    :var list_id: Mailchimp list id.
+    :var id: Subscriber hash, see :meth:`~nest.apis.Mailchimp.md5`.
+    :var email: Email address.
+    :var status: Subscription status, e.g. ``subscribed``.
+    :var merge_fields: Merge field names to values.
+    :var tags: Names of the member's tags.
+    :var fingerprint: Digest of ``merge_fields`` and ``tags``, see
+        :func:`~nest.apis.mailchimp.sync.fingerprint`.
+    :var last_changed: When the member last changed in Mailchimp.
+    """
+    __tablename__ = "mailchimp_members"
+    __table_args__ = (
+        Index("ix_mailchimp_members_email_lower", func.lower(text("email"))),
+    )
+
+    list_id      = Column(Text, primary_key=True)
+    id           = Column(Text, primary_key=True)
+    email        = Column(Text, nullable=False)
+    status       = Column(Text, nullable=False, default="")
+    merge_fields = Column(JSONB, nullable=False, default={})
+    tags         = Column(ARRAY(Text, dimensions=1), nullable=False, default=[])
+    fingerprint  = Column(Text)
+    last_changed = Column(DateTime)
+
+    def __repr__(self):
+        return f"<MailchimpMember list='{self.list_id}' hash='{self.id}'>"
@@ -0,0 +1,69 @@
+from collections import namedtuple
+
+from sqlalchemy import tuple_
+
+Page = namedtuple("Page", ["items", "cursor"])
+Page.__doc__ = """A page of query results.
+
+:var items: The rows of this page.
+:var cursor: Keyset values of the last row, to be passed as ``after``
+    for the next page. ``None`` if this is the last page.
+"""
+
+
+def keyset(query, columns, after=None, limit=100):
+    """Fetch one page of ``query`` using keyset (seek) pagination.
+
+    Rather than skipping rows with ``OFFSET``, the query is ordered by
+    ``columns`` and filtered to rows strictly after the ``after``
+    cursor. With an index on ``columns`` every page costs the same no
+    matter how deep it is.
+
+    ::
+
+        page = keyset(session.query(Order), [Order.created, Order.id])
+        while page.cursor:
+            page = keyset(
+                session.query(Order),
+                [Order.created, Order.id],
+                after=page.cursor
+            )
+
+    :param query: The query to paginate.
+    :param columns: Columns that uniquely and stably order the rows.
+    :param after: Cursor of the previous page.
+    :param limit: Maximum number of rows per page.
+    """
+    if after is not None:
+        query = query.filter(tuple_(*columns) > tuple_(*after))
+
+    items = query.order_by(*columns).limit(limit).all()
+
+    cursor = None
+    if len(items) == limit:
+        cursor = tuple(getattr(items[-1], column.key) for column in columns)
+    return Page(items, cursor)
+
+def walk(fn, *args, after=None, **kwargs):
+    """Yields every row of successive pages returned by ``fn``.
+
+    ::
+
+        for order in walk(Order.page, session, live=True):
+            pass
+
+    :param fn: A callable returning a
+        :class:`~nest.engines.psql.pagination.Page`, such as
+        :meth:`~nest.engines.psql.models.Order.page`.
+    :param args: Positional arguments passed to ``fn``.
+    :param after: Cursor to resume from.
+    :param kwargs: Other keyword arguments passed to ``fn``.
+    """
+    while True:
+        page = fn(*args, after=after, **kwargs)
+        for item in page.items:
+            yield item
+
+        if page.cursor is None:
+            break
+        after = page.cursor
@@ -0,0 +1,229 @@
+"""Monthly range partitioning of the ``orders`` table.
+
+Orders are only ever appended and almost every query filters them by
+date, so large histories can be split into one partition per month of
+``Order.created``. Queries over a recent window, and vacuum, then only
+touch the hot partitions.
+
+The ORM models are unaffected, with two caveats that come from
+PostgreSQL itself:
+
+* Primary and unique keys of a partitioned table must include the
+  partition key, so they become ``(id, created)`` and
+  ``(reference, created)``. Ids still come from the same sequence.
+  References stay unique across partitions through the
+  ``order_references`` table, which a trigger keeps in step with
+  ``orders``: a duplicate reference violates its primary key.
+* Foreign keys cannot reference ``orders(id)`` alone anymore. The
+  foreign keys from ``returns`` and ``order_product_associations`` are
+  dropped and their ``ON DELETE CASCADE`` is kept by a trigger.
+
+Partitions must exist before orders for that month arrive. Anything
+outside of the created partitions falls into ``orders_default``, so
+run :func:`~nest.engines.psql.partitioning.create_partitions` ahead of
+time (e.g. from a monthly cron job).
+"""
+from datetime import datetime
+
+DEFAULT_PARTITION = "orders_default"
+
+CASCADE_FUNCTION = """
+CREATE OR REPLACE FUNCTION orders_delete_cascade() RETURNS trigger AS $$
+BEGIN
+    -- Moving an order to another partition deletes it from the old one
+    IF NOT EXISTS (SELECT 1 FROM orders WHERE id = OLD.id) THEN
+        DELETE FROM order_product_associations WHERE order_id = OLD.id;
+        DELETE FROM returns WHERE order_id = OLD.id;
+    END IF;
+    RETURN OLD;
+END
+$$ LANGUAGE plpgsql
+"""
+
+CASCADE_TRIGGER = """
+CREATE TRIGGER orders_delete_cascade AFTER DELETE ON orders
+    FOR EACH ROW EXECUTE FUNCTION orders_delete_cascade()
+"""
+
+REFERENCES_TABLE = """
+CREATE TABLE order_references (reference text PRIMARY KEY)
+"""
+
+REFERENCES_FUNCTION = """
+CREATE OR REPLACE FUNCTION orders_unique_reference() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM order_references WHERE reference = OLD.reference;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO order_references (reference) VALUES (NEW.reference);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+REFERENCES_TRIGGER = """
+CREATE TRIGGER orders_unique_reference
+    AFTER INSERT OR DELETE OR UPDATE OF reference ON orders
+    FOR EACH ROW EXECUTE FUNCTION orders_unique_reference()
+"""
+
+
+def months(start, end):
+    """Yields the first day of every month from ``start`` up to and
+    including the month of ``end``.
+
+    :param start: A date or datetime.
+    :param end: A date or datetime.
+    """
+    month = datetime(start.year, start.month, 1)
+    while month <= end:
+        yield month
+        month = next_month(month)
+
+def next_month(month):
+    """The first day of the month following ``month``.
+    """
+    if month.month == 12:
+        return datetime(month.year + 1, 1, 1)
+    return datetime(month.year, month.month + 1, 1)
+
+def partition_name(month, table="orders"):
+    """Name of the partition holding ``month``, e.g. 'orders_y2020m01'.
+    """
+    return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+def is_partitioned(bind, table="orders"):
+    """True if ``table`` is a partitioned table.
+
+    :param bind: Engine or connection.
+    :param table: Table name.
+    """
+    statement = ("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+                 "JOIN pg_class c ON c.oid = p.partrelid "
+                 "WHERE c.relname = %(table)s)")
+    return bind.execute(statement, {"table": table}).scalar()
+
+def create_partitions(bind, start, end, table="orders"):
+    """Create the monthly partitions of ``table`` between ``start``
+    and ``end`` that do not exist yet.
+
+    :param bind: Engine or connection.
+    :param start: First month to create.
+    :param end: Last month to create.
+    :param table: Partitioned table name.
+    """
+    for month in months(start, end):
+        bind.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(month, table)} "
+            f"PARTITION OF {table} FOR VALUES "
+            f"FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')"
+        )
+
+def _secondary_indexes(bind, table):
+    """``CREATE INDEX`` statements of the non-unique indexes of
+    ``table``, so that they can be replayed on a new table.
+    """
+    statement = ("SELECT indexdef FROM pg_indexes "
+                 "WHERE schemaname = current_schema() "
+                 "AND tablename = %(table)s "
+                 "AND indexdef NOT LIKE 'CREATE UNIQUE%%'")
+    return [row[0] for row in bind.execute(statement, {"table": table})]
+
+def partition_orders(bind, months_ahead=12):
+    """Convert ``orders`` into a table partitioned by month of
+    ``created`` and move the existing rows into it.
+
+    Partitions are created for every month from the oldest order up to
+    ``months_ahead`` months from now. This takes an exclusive lock on
+    ``orders`` for the duration of the copy and should be run in a
+    maintenance window, usually through the ``partitioning`` Alembic
+    branch.
+
+    :param bind: Engine or connection, ideally inside a transaction.
+    :param months_ahead: Number of future months to create partitions
+        for.
+    """
+    if is_partitioned(bind):
+        return
+
+    indexes = _secondary_indexes(bind, "orders")
+    oldest = bind.execute("SELECT min(created) FROM orders").scalar()
+
+    now = datetime.utcnow()
+    end = datetime(now.year, now.month, 1)
+    for _ in range(months_ahead):
+        end = next_month(end)
+
+    bind.execute("ALTER TABLE orders RENAME TO orders_heap")
+    bind.execute(
+        "CREATE TABLE orders (LIKE orders_heap INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (created)"
+    )
+    bind.execute("ALTER SEQUENCE orders_id_seq OWNED BY orders.id")
+    create_partitions(bind, oldest or now, end)
+    bind.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF orders DEFAULT")
+
+    bind.execute("INSERT INTO orders SELECT * FROM orders_heap")
+    # Also drops the foreign keys of `returns` and the association table
+    bind.execute("DROP TABLE orders_heap CASCADE")
+
+    bind.execute(
+        "ALTER TABLE orders "
+        "ADD CONSTRAINT orders_pkey PRIMARY KEY (id, created), "
+        "ADD CONSTRAINT orders_reference_key UNIQUE (reference, created), "
+        "ADD CONSTRAINT orders_user_id_fkey FOREIGN KEY (user_id) "
+        "REFERENCES users (id) ON UPDATE CASCADE ON DELETE CASCADE"
+    )
+    for index in indexes:
+        bind.execute(index)
+
+    bind.execute(CASCADE_FUNCTION)
+    bind.execute(CASCADE_TRIGGER)
+
+    bind.execute(REFERENCES_TABLE)
+    bind.execute("INSERT INTO order_references SELECT reference FROM orders")
+    bind.execute(REFERENCES_FUNCTION)
+    bind.execute(REFERENCES_TRIGGER)
+
+def unpartition_orders(bind):
+    """Inverse of :func:`~nest.engines.psql.partitioning.partition_orders`.
+    Moves all rows back into a single heap table and restores the
+    original keys.
+
+    :param bind: Engine or connection, ideally inside a transaction.
+    """
+    if not(is_partitioned(bind)):
+        return
+
+    indexes = _secondary_indexes(bind, "orders")
+
+    bind.execute("ALTER TABLE orders RENAME TO orders_partitioned")
+    bind.execute(
+        "CREATE TABLE orders (LIKE orders_partitioned INCLUDING DEFAULTS)"
+    )
+    bind.execute("ALTER SEQUENCE orders_id_seq OWNED BY orders.id")
+    bind.execute("INSERT INTO orders SELECT * FROM orders_partitioned")
+    # Also drops every partition and the triggers
+    bind.execute("DROP TABLE orders_partitioned CASCADE")
+    bind.execute("DROP FUNCTION IF EXISTS orders_delete_cascade()")
+    bind.execute("DROP FUNCTION IF EXISTS orders_unique_reference()")
+    bind.execute("DROP TABLE IF EXISTS order_references")
+
+    bind.execute(
+        "ALTER TABLE orders "
+        "ADD CONSTRAINT orders_pkey PRIMARY KEY (id), "
+        "ADD CONSTRAINT orders_reference_key UNIQUE (reference), "
+        "ADD CONSTRAINT orders_user_id_fkey FOREIGN KEY (user_id) "
+        "REFERENCES users (id) ON UPDATE CASCADE ON DELETE CASCADE"
+    )
+    for index in indexes:
+        bind.execute(index)
+
+    for table in ["order_product_associations", "returns"]:
+        bind.execute(
+            f"ALTER TABLE {table} "
+            f"ADD CONSTRAINT {table}_order_id_fkey FOREIGN KEY (order_id) "
+            f"REFERENCES orders (id) ON UPDATE CASCADE ON DELETE CASCADE"
+        )
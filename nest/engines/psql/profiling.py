@@ -0,0 +1,216 @@
+"""Statement profiling for :class:`~nest.engines.psql.PostgreSQLEngine`.
+
+A :class:`~nest.engines.psql.profiling.QueryProfiler` listens to the
+cursor events of an engine and aggregates every executed statement by
+its fingerprint, i.e. the statement with all parameters and literals
+replaced by ``?``::
+
+    with engine.profile() as profiler:
+        sync(engine.session())
+    print(profiler.report())
+
+Statements that repeat many times within one unit of work (by default,
+one transaction) are flagged as likely N+1 patterns, such as resolving
+each recipient of each order with its own query.
+
+Profilers double as query budgets in tests::
+
+    with engine.profile(budget=3):
+        session.query(Order).all()
+"""
+import logging
+import re
+from collections import Counter, namedtuple
+from threading import Lock
+from time import perf_counter
+
+PARAMETER = re.compile(r"%\(\w+\)s|%s|\$\d+")
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+Statistic = namedtuple(
+    "Statistic",
+    ["fingerprint", "count", "total", "max", "per_unit"]
+)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a profiled block executes more statements than its
+    budget allows.
+    """
+
+
+def fingerprint(statement):
+    """Normalize ``statement`` so that executions differing only in
+    their parameters, literals or ``IN`` list lengths compare equal.
+
+    :param statement: SQL statement as sent to the cursor.
+    """
+    statement = PARAMETER.sub("?", statement)
+    statement = STRING.sub("?", statement)
+    statement = NUMBER.sub("?", statement)
+    statement = LIST.sub("(?)", statement)
+    return WHITESPACE.sub(" ", statement).strip()
+
+class QueryProfiler(object):
+    """Counts and times the statements executed through an engine.
+
+    :param engine: A :class:`~nest.engines.psql.PostgreSQLEngine`.
+    :param budget: Maximum number of statements allowed while
+        profiling. Exceeding it raises
+        :class:`~nest.engines.psql.profiling.QueryBudgetExceeded` when
+        the profiler stops.
+    :param threshold: Number of executions of one fingerprint within a
+        unit of work from which it is reported as an N+1 pattern.
+
+    :var count: Total number of statements executed.
+    :var duration: Total time spent in the database, in seconds.
+    :var repeated: Dict of fingerprints flagged as N+1 patterns to the
+        most executions seen within one unit of work.
+    """
+    def __init__(self, engine, budget=None, threshold=10):
+        self.engine = engine
+        self.budget = budget
+        self.threshold = threshold
+        self.error_logger = logging.getLogger("nest")
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard everything recorded so far.
+        """
+        with self.lock:
+            self.count = 0
+            self.duration = 0.0
+            self.counts = Counter()
+            self.totals = Counter()
+            self.maxima = {}
+            self.unit = Counter()
+            self.repeated = {}
+
+    def start(self):
+        """Start listening to the engine's cursor and transaction
+        events.
+        """
+        self.engine.add_listener("before_cursor_execute", self._before)
+        self.engine.add_listener("after_cursor_execute", self._after)
+        self.engine.add_listener("commit", self._end_unit)
+        self.engine.add_listener("rollback", self._end_unit)
+        return self
+
+    def stop(self):
+        """Stop listening. Raises
+        :class:`~nest.engines.psql.profiling.QueryBudgetExceeded` if a
+        budget was set and exceeded.
+        """
+        self.engine.remove_listener("before_cursor_execute", self._before)
+        self.engine.remove_listener("after_cursor_execute", self._after)
+        self.engine.remove_listener("commit", self._end_unit)
+        self.engine.remove_listener("rollback", self._end_unit)
+
+        if self.budget is not None and self.count > self.budget:
+            raise QueryBudgetExceeded(
+                f"Executed {self.count} statements, budget is "
+                f"{self.budget}:\n{self.report()}"
+            )
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            # Don't mask an exception raised by the profiled block
+            self.budget = None
+        self.stop()
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault("nest.profiling.start", []).\
+            append(perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        starts = conn.info.get("nest.profiling.start")
+        if not(starts):
+            return
+
+        elapsed = perf_counter() - starts.pop()
+        key = fingerprint(statement)
+        with self.lock:
+            self.count += 1
+            self.duration += elapsed
+            self.counts[key] += 1
+            self.totals[key] += elapsed
+            self.maxima[key] = max(self.maxima.get(key, 0.0), elapsed)
+
+            self.unit[key] += 1
+            executions = self.unit[key]
+            if executions >= self.threshold:
+                if key not in self.repeated:
+                    self.error_logger.warning(
+                        f"Possible N+1 query, executed {executions} times "
+                        f"in one unit of work: {key}"
+                    )
+                self.repeated[key] = max(
+                    self.repeated.get(key, 0),
+                    executions
+                )
+
+    def _end_unit(self, conn=None):
+        with self.lock:
+            self.unit = Counter()
+
+    def end_unit(self):
+        """Mark the end of a unit of work, e.g. one processed event,
+        for N+1 detection. Transaction commits and rollbacks do this
+        implicitly.
+        """
+        self._end_unit()
+
+    def top(self, n=10, by="total"):
+        """The ``n`` most expensive fingerprints.
+
+        :param n: Number of statistics to return.
+        :param by: Sort key, ``'total'`` (time), ``'count'`` or
+            ``'max'``.
+        """
+        with self.lock:
+            stats = []
+            for key, count in self.counts.items():
+                stats.append(Statistic(
+                    fingerprint=key,
+                    count=count,
+                    total=self.totals[key],
+                    max=self.maxima[key],
+                    per_unit=self.repeated.get(key, 0)
+                ))
+        stats.sort(key=lambda stat: getattr(stat, by), reverse=True)
+        return stats[:n]
+
+    def report(self, n=10, by="total"):
+        """A human readable report of the ``n`` most expensive
+        fingerprints. N+1 suspects are marked with ``[N+1]``.
+
+        :param n: Number of fingerprints to include.
+        :param by: Sort key, see
+            :meth:`~nest.engines.psql.profiling.QueryProfiler.top`.
+        """
+        lines = [
+            f"{self.count} statements in {self.duration * 1000:.1f} ms, "
+            f"{len(self.counts)} distinct"
+        ]
+        for stat in self.top(n, by):
+            flag = " [N+1]" if stat.per_unit else ""
+            lines.append(
+                f"{stat.count:>8} x {stat.total * 1000:>10.1f} ms "
+                f"(max {stat.max * 1000:.1f} ms){flag}  {stat.fingerprint}"
+            )
+        return "\n".join(lines)
+
+    def log(self, n=10, by="total"):
+        """Log :meth:`~nest.engines.psql.profiling.QueryProfiler.report`
+        to the ``nest`` logger, e.g. at the end of a sync.
+        """
+        self.error_logger.info(self.report(n, by))
@@ -0,0 +1,227 @@
+"""Daily sales rollups per product.
+
+Revenue statistics are kept in
+:class:`~nest.engines.psql.models.ProductSales` so that dashboards do
+not have to scan every order. The rollups are updated incrementally
+as orders and returns are flushed::
+
+    engine = PostgreSQLEngine()
+    rollups.track(engine.session_factory)
+
+    rollups.summary(session, date(2020, 1, 1), date(2020, 1, 31))
+
+Data that was written without tracking can be (re)aggregated from
+scratch with :func:`~nest.engines.psql.rollups.rebuild`.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy import Date, Float, and_, cast, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.event import contains, listen, remove
+
+from nest.engines.psql.models import (
+    Order,
+    OrderProductAssociation,
+    Product,
+    ProductSales,
+    Return
+)
+
+COUNTERS = [
+    "orders",
+    "gifts",
+    "total",
+    "discount",
+    "coupons",
+    "returns",
+    "returned"
+]
+
+
+def _price(value):
+    # Event payloads carry floats while loaded models carry decimals
+    return Decimal(str(value or 0))
+
+def _upsert(bind, deltas):
+    """Add ``deltas``, a dict of ``(day, product_id)`` to counter
+    increments, onto the rollup table in one statement.
+    """
+    if len(deltas) == 0:
+        return
+
+    rows = []
+    for (day, product_id), counters in deltas.items():
+        rows.append(dict(counters, day=day, product_id=product_id))
+
+    table = ProductSales.__table__
+    statement = insert(table).values(rows)
+    increments = {}
+    for key in COUNTERS:
+        increments[key] = table.c[key] + statement.excluded[key]
+
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.day, table.c.product_id],
+        set_=increments
+    )
+    bind.execute(statement)
+
+def record(bind, orders=[], returns=[]):
+    """Add newly persisted orders and returns to the rollups.
+
+    Orders must have been flushed (their products need ids) and
+    returns must belong to an order.
+
+    :param bind: Session, engine or connection.
+    :param orders: :class:`~nest.engines.psql.models.Order` objects.
+    :param returns: :class:`~nest.engines.psql.models.Return` objects,
+        or anything else with an ``order`` and an ``amount``.
+    """
+    deltas = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+
+    for order in orders:
+        day = order.created.date()
+        for product in order.products:
+            counters = deltas[(day, product.id)]
+            counters["orders"] += 1
+            counters["gifts"] += int(bool(order.gift))
+            counters["total"] += _price(order.total)
+            counters["discount"] += _price(order.discount)
+            counters["coupons"] += int(bool(order.coupons))
+
+    for ret in returns:
+        order = ret.order
+        if order is None:
+            continue
+
+        day = order.created.date()
+        for product in order.products:
+            counters = deltas[(day, product.id)]
+            counters["returns"] += 1
+            counters["returned"] += _price(ret.amount)
+
+    _upsert(bind, deltas)
+
+def _after_flush(session, context):
+    orders, returns = [], []
+    for obj in session.new:
+        if isinstance(obj, Order):
+            orders.append(obj)
+        elif isinstance(obj, Return):
+            returns.append(obj)
+
+    if len(orders) > 0 or len(returns) > 0:
+        record(session, orders, returns)
+
+def track(target):
+    """Update the rollups whenever ``target`` flushes new orders or
+    returns. The update runs in the same transaction as the flush.
+
+    :param target: A ``Session``, ``sessionmaker`` or
+        ``scoped_session``.
+    """
+    if not(contains(target, "after_flush", _after_flush)):
+        listen(target, "after_flush", _after_flush)
+
+def tracking(session):
+    """True if the rollups are updated when ``session`` flushes, be it
+    tracked itself or through its ``sessionmaker``.
+
+    :param session: A ``Session``.
+    """
+    return _after_flush in list(session.dispatch.after_flush)
+
+def untrack(target):
+    """Stop updating the rollups for ``target``.
+
+    :param target: A ``Session``, ``sessionmaker`` or
+        ``scoped_session``.
+    """
+    if contains(target, "after_flush", _after_flush):
+        remove(target, "after_flush", _after_flush)
+
+def rebuild(bind, begin=None, end=None):
+    """Recompute the rollups from the ``orders`` and ``returns``
+    tables.
+
+    :param bind: Session, engine or connection.
+    :param begin: First day to rebuild. Defaults to the beginning.
+    :param end: Last day to rebuild. Defaults to the end.
+    """
+    day = cast(Order.created, Date)
+    association = OrderProductAssociation
+
+    returns = select([
+        Return.order_id,
+        func.count().label("count"),
+        func.sum(Return.amount).label("amount")
+    ]).group_by(Return.order_id).alias("order_returns")
+
+    query = select([
+        day,
+        association.product_id,
+        func.count(),
+        func.count().filter(Order.gift),
+        func.sum(Order.total),
+        func.sum(Order.discount),
+        func.count().filter(func.cardinality(Order.coupons) > 0),
+        func.coalesce(func.sum(returns.c.count), 0),
+        func.coalesce(func.sum(returns.c.amount), 0),
+    ]).select_from(
+        Order.__table__.\
+            join(association, association.order_id == Order.id).\
+            outerjoin(returns, returns.c.order_id == Order.id)
+    ).group_by(day, association.product_id)
+
+    delete = ProductSales.__table__.delete()
+    if begin:
+        query = query.where(day >= begin)
+        delete = delete.where(ProductSales.day >= begin)
+    if end:
+        query = query.where(day <= end)
+        delete = delete.where(ProductSales.day <= end)
+
+    columns = ["day", "product_id"] + COUNTERS
+    bind.execute(delete)
+    bind.execute(insert(ProductSales.__table__).from_select(columns, query))
+
+def daily(session, begin, end, product=None):
+    """Rollup rows between two days, inclusive, ordered by day.
+
+    :param session: Database session.
+    :param begin: First day.
+    :param end: Last day.
+    :param product: Only rows of this
+        :class:`~nest.engines.psql.models.Product`, if given.
+    """
+    query = session.query(ProductSales).\
+                filter(and_(ProductSales.day >= begin,
+                            ProductSales.day <= end))
+    if product is not None:
+        query = query.filter(ProductSales.product_id == product.id)
+    return query.order_by(ProductSales.day, ProductSales.product_id).all()
+
+def summary(session, begin, end):
+    """Per-product sums between two days, inclusive. Each row has the
+    product name, all :class:`~nest.engines.psql.models.ProductSales`
+    counters and a ``gift_ratio``.
+
+    :param session: Database session.
+    :param begin: First day.
+    :param end: Last day.
+    """
+    columns = [Product.name]
+    for key in COUNTERS:
+        columns.append(func.sum(getattr(ProductSales, key)).label(key))
+
+    gift_ratio = cast(func.sum(ProductSales.gifts), Float) / \
+                 func.nullif(func.sum(ProductSales.orders), 0)
+    columns.append(gift_ratio.label("gift_ratio"))
+
+    query = session.query(*columns).\
+                join(ProductSales.product).\
+                filter(and_(ProductSales.day >= begin,
+                            ProductSales.day <= end)).\
+                group_by(Product.name).\
+                order_by(Product.name)
+    return query.all()
@@ -1,2 +1,8 @@
-from nest.engines.redis.locking import LockFactory
-from nest.engines.redis.engine import RedisEngine
\ No newline at end of file
+from nest.types import lazy_attributes
+
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    "EventStream": "nest.engines.redis.streams",
+    "LockFactory": "nest.engines.redis.locking",
+    "RedisEngine": "nest.engines.redis.engine",
+    "StreamConsumer": "nest.engines.redis.streams",
+})
@@ -0,0 +1,310 @@
+"""A durable event queue on a Redis stream, decoupling intake from
+persistence.
+
+Producers (a poller, or the webhook receiver in
+:mod:`nest.apis.fastspring.webhooks`) append raw event dicts to an
+:class:`~nest.engines.redis.streams.EventStream`. Writer processes read
+them in batches as members of a consumer group, hand each batch to a
+handler such as :class:`~nest.apis.fastspring.ingest.Writer` and
+acknowledge it once it was committed::
+
+    stream = EventStream(RedisEngine())
+    receiver = WebhookReceiver(stream.add)
+
+    # In each writer process
+    StreamConsumer(stream, Writer(PostgreSQLEngine())).run()
+
+Entries of a batch that failed, or of a writer that died, stay pending
+and are claimed again by any consumer once they have been idle for
+``idle`` milliseconds. Entries that keep failing are moved to a dead
+letter list after ``max_deliveries`` attempts, payload included, and
+can be put back on the stream once whatever broke them is fixed::
+
+    stream.requeue()
+"""
+import json
+import logging
+import os
+import socket
+from threading import Event
+
+from redis.exceptions import ResponseError
+
+from nest.metrics import increment, timer
+
+
+class EventStream(object):
+    """A Redis stream of JSON encoded events, read by one consumer
+    group.
+
+    :param redis: A :class:`~nest.engines.redis.RedisEngine`.
+    :param name: Stream key.
+    :param group: Consumer group name.
+    :param consumer: Name of this consumer within the group. Defaults
+        to the host name and process id.
+    :param maxlen: Approximate maximum stream length; older entries
+        are trimmed. Unbounded by default.
+    :param dead_letters: Key of the list entries are moved to when they
+        are given up on. Defaults to the stream key with a ``:dead``
+        suffix.
+    """
+    def __init__(self, redis, name="nest:events", group="writers",
+                 consumer=None, maxlen=None, dead_letters=None):
+        self.redis = redis
+        self.name = name
+        self.dead_letters = dead_letters or f"{name}:dead"
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.maxlen = maxlen
+        self.logger = logging.getLogger("nest")
+        self._group_created = False
+
+    def create_group(self):
+        """Create the stream and consumer group if they do not exist.
+        A new group starts at the beginning of the stream.
+        """
+        if self._group_created:
+            return
+        try:
+            self.redis.xgroup_create(self.name, self.group, id="0",
+                                     mkstream=True)
+        except (ResponseError) as ex:
+            if not(str(ex).startswith("BUSYGROUP")):
+                raise
+        self._group_created = True
+
+    def add(self, events):
+        """Append raw events to the stream. Returns their entry ids.
+
+        :param events: List of event dicts.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for event in events:
+            pipeline.xadd(
+                self.name,
+                {"event": json.dumps(event)},
+                maxlen=self.maxlen,
+                approximate=True
+            )
+        ids = pipeline.execute()
+        increment("streams.added", len(ids))
+        return ids
+
+    def read(self, count=100, block=1000):
+        """Read up to ``count`` new entries for this consumer, waiting
+        up to ``block`` milliseconds for the first one. Returns a list
+        of ``(id, event)`` tuples.
+
+        :param count: Maximum number of entries.
+        :param block: Milliseconds to wait, or ``None`` to return right
+            away.
+        """
+        self.create_group()
+        res = self.redis.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.name: ">"},
+            count=count,
+            block=block
+        )
+        return [self.decode(entry) for _, entries in res for entry in entries]
+
+    def ack(self, ids):
+        """Acknowledge entries, removing them from the pending list.
+
+        :param ids: Entry ids.
+        """
+        if ids:
+            self.redis.xack(self.name, self.group, *ids)
+            increment("streams.acked", len(ids))
+
+    def reclaim(self, idle=60000, count=100, max_deliveries=5):
+        """Claim entries that other (or dead) consumers have left
+        pending for more than ``idle`` milliseconds. Returns a list of
+        ``(id, event)`` tuples.
+
+        Entries already delivered ``max_deliveries`` times are moved to
+        the dead letter list instead (see
+        :meth:`~nest.engines.redis.streams.EventStream.bury`). Entries
+        that were trimmed from the stream are acknowledged.
+
+        :param idle: Minimum idle time, in milliseconds.
+        :param count: Maximum number of entries to look at.
+        :param max_deliveries: Deliveries after which an entry is
+            given up on.
+        """
+        self.create_group()
+        pending = self.redis.xpending_range(
+            self.name,
+            self.group,
+            "-",
+            "+",
+            count
+        )
+
+        ids, dead = [], []
+        for info in pending:
+            if info["time_since_delivered"] < idle:
+                continue
+            if info["times_delivered"] >= max_deliveries:
+                dead.append(info["message_id"])
+            else:
+                ids.append(info["message_id"])
+
+        if dead:
+            self.logger.error(
+                f"Giving up on events delivered {max_deliveries} times: "
+                f"{dead}"
+            )
+            self.bury(dead)
+
+        if not(ids):
+            return []
+
+        claimed = self.redis.xclaim(
+            self.name,
+            self.group,
+            self.consumer,
+            idle,
+            ids
+        )
+        entries = [self.decode(entry) for entry in claimed if entry[1]]
+
+        # Trimmed entries can not be claimed, only acknowledged
+        found = {id for id, _ in entries}
+        self.ack([id for id in ids if id not in found])
+
+        increment("streams.reclaimed", len(entries))
+        return entries
+
+    def bury(self, ids):
+        """Move entries to the dead letter list and acknowledge them, in
+        one transaction. Each letter is a JSON object with the entry's
+        ``id`` and ``event``. Returns the number of entries moved.
+
+        :param ids: Entry ids.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipeline.xrange(self.name, id, id)
+        entries = [self.decode(entry) for found in pipeline.execute()
+                   for entry in found]
+
+        pipeline = self.redis.pipeline(transaction=True)
+        for id, event in entries:
+            if isinstance(id, bytes):
+                id = id.decode()
+            pipeline.rpush(
+                self.dead_letters,
+                json.dumps({"id": id, "event": event})
+            )
+        pipeline.xack(self.name, self.group, *ids)
+        pipeline.execute()
+
+        increment("streams.dead_letters", len(entries))
+        return len(entries)
+
+    def buried(self, count=100):
+        """The oldest dead letters, as ``(id, event)`` tuples.
+
+        :param count: Maximum number of letters.
+        """
+        letters = [
+            json.loads(letter)
+            for letter in self.redis.lrange(self.dead_letters, 0, count - 1)
+        ]
+        return [(letter["id"], letter["event"]) for letter in letters]
+
+    def requeue(self, count=100):
+        """Move the oldest dead letters back onto the stream, as new
+        entries. Returns their new entry ids.
+
+        :param count: Maximum number of letters.
+        """
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.lrange(self.dead_letters, 0, count - 1)
+        pipeline.ltrim(self.dead_letters, count, -1)
+        letters, _ = pipeline.execute()
+        if not(letters):
+            return []
+        return self.add([json.loads(letter)["event"] for letter in letters])
+
+    def pending(self):
+        """Number of entries read but not acknowledged yet.
+        """
+        self.create_group()
+        return self.redis.xpending(self.name, self.group)["pending"]
+
+    @classmethod
+    def decode(cls, entry):
+        """Turn a raw stream entry into an ``(id, event)`` tuple.
+        """
+        id, fields = entry
+        return id, json.loads(fields[b"event"])
+
+    def __len__(self):
+        return self.redis.xlen(self.name)
+
+class StreamConsumer(object):
+    """Reads batches from an
+    :class:`~nest.engines.redis.streams.EventStream`, passes the events
+    to ``handler`` and acknowledges them if it returns without error.
+
+    :param stream: The stream to consume.
+    :param handler: Called with each list of raw event dicts.
+    :param batch_size: Maximum number of events per batch.
+    :param block: Milliseconds to wait for new entries per read.
+    :param idle: Milliseconds after which pending entries are
+        reclaimed.
+    :param max_deliveries: Deliveries after which an entry is given up
+        on.
+    """
+    def __init__(self, stream, handler, batch_size=100, block=1000,
+                 idle=60000, max_deliveries=5):
+        self.stream = stream
+        self.handler = handler
+        self.batch_size = batch_size
+        self.block = block
+        self.idle = idle
+        self.max_deliveries = max_deliveries
+        self.logger = logging.getLogger("nest")
+        self._stopped = Event()
+
+    def run_once(self):
+        """Handle one batch, reclaimed entries first. Returns the number
+        of events acknowledged.
+        """
+        entries = self.stream.reclaim(
+            idle=self.idle,
+            count=self.batch_size,
+            max_deliveries=self.max_deliveries
+        )
+        if not(entries):
+            entries = self.stream.read(count=self.batch_size, block=self.block)
+        if not(entries):
+            return 0
+
+        ids = [id for id, _ in entries]
+        try:
+            with timer("streams.batch"):
+                self.handler([event for _, event in entries])
+        except Exception as ex:
+            # Left pending, to be reclaimed once idle
+            self.logger.error(f"Could not handle {len(ids)} events: {ex}")
+            increment("streams.failed", len(ids))
+            return 0
+
+        self.stream.ack(ids)
+        return len(ids)
+
+    def run(self):
+        """Handle batches until :meth:`stop` is called.
+        """
+        self._stopped.clear()
+        while not(self._stopped.is_set()):
+            self.run_once()
+
+    def stop(self):
+        """Stop :meth:`run` after the current batch.
+        """
+        self._stopped.set()
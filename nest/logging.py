@@ -1,9 +1,148 @@
+import atexit
+import gzip
+import json
 import logging
+import os
+import shutil
+from datetime import datetime
 from logging.config import dictConfig
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler
+)
+from queue import Full, Queue
 
 from colorlog import ColoredFormatter, StreamHandler
 
 
+class BoundedQueueHandler(QueueHandler):
+    """A ``QueueHandler`` for a bounded queue.
+
+    When the queue is full, records are either dropped (and counted)
+    or the logging thread blocks until there is room again.
+
+    :param queue: A bounded ``Queue``.
+    :param policy: Either ``'drop'`` or ``'block'``.
+    """
+    POLICIES = ["drop", "block"]
+
+    def __init__(self, queue, policy="drop"):
+        super().__init__(queue)
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy: '{policy}'")
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The queue never leaves this process, so there is no need to
+        # copy and fully format records like ``QueueHandler`` does;
+        # only merge the arguments now, before they can change
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.policy == "block":
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except (Full):
+            self.dropped += 1
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line.
+
+    Besides the time, level, logger name and message, any of
+    :class:`~nest.logging.JSONFormatter.FIELDS` passed as ``extra`` are
+    included.
+    """
+    FIELDS = ["event", "type", "reference", "duration", "outcome"]
+
+    def format(self, record):
+        entry = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BufferedFlushMixin(object):
+    """Only flushes the underlying stream every ``capacity`` records,
+    or right away for errors. Rollovers and ``close()`` always write
+    out whatever is buffered.
+    """
+    def init_buffer(self, capacity):
+        self.capacity = capacity
+        self.unflushed = 0
+        self.forced = False
+
+    def emit(self, record):
+        self.forced = record.levelno >= logging.ERROR
+        super().emit(record)
+
+    def flush(self):
+        self.unflushed += 1
+        if self.forced or self.unflushed >= self.capacity:
+            super().flush()
+            self.unflushed = 0
+
+    def close(self):
+        self.forced = True
+        super().close()
+
+
+class BufferedRotatingFileHandler(BufferedFlushMixin, RotatingFileHandler):
+    """A ``RotatingFileHandler`` with buffered writes.
+    """
+    def __init__(self, filename, capacity=1, **kwargs):
+        self.init_buffer(capacity)
+        super().__init__(filename, **kwargs)
+
+
+class BufferedTimedRotatingFileHandler(BufferedFlushMixin,
+                                       TimedRotatingFileHandler):
+    """A ``TimedRotatingFileHandler`` with buffered writes.
+    """
+    def __init__(self, filename, capacity=1, **kwargs):
+        self.init_buffer(capacity)
+        super().__init__(filename, **kwargs)
+
+
+def gzip_namer(name):
+    """Rotated file namer that accounts for gzip compression.
+    """
+    return name + ".gz"
+
+def gzip_rotator(source, dest):
+    """Rotator that gzips the rotated-out file.
+    """
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+class BackgroundListener(QueueListener):
+    """A ``QueueListener`` that waits for room in a full queue when
+    stopping instead of raising ``Full``.
+    """
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
 class Logger(object):
     LOG_LEVELS = {
         "critical": logging.CRITICAL,
@@ -18,12 +157,19 @@ class Logger(object):
                  r"%(reset)s%(message)s")
     datefmt = r"[%Y-%m-%d %H:%M:%S %z]"
 
+    TRANSACTION_FIELDS = JSONFormatter.FIELDS
+
+    CONFIG_PREFIXES = ("errlog", "translog", "transactionlog", "logQueue")
+
     def __init__(self, cfg):
         self.error_logger = logging.getLogger("nest")
         self.transcation_logger = logging.getLogger("nest.transaction")
-        self.init(self.error_logger, self.transcation_logger)
+        self.listener = None
+        self.queue_handler = None
+        self.handlers = []
         self.cfg = cfg
         self.setup(self.cfg)
+        atexit.register(self.stop)
 
     @classmethod
     def init(cls, *args):
@@ -32,9 +178,28 @@ class Logger(object):
             logger.handlers = []
 
     def setup(self, cfg=None):
+        """(Re)configure both loggers from a config.
+
+        If ``logQueue`` is enabled, records are put on a bounded queue
+        and formatted and written by a background thread, so logging
+        calls never wait on I/O. ``logQueuePolicy`` decides whether
+        records are dropped or the caller blocks when the queue is
+        full.
+
+        Transactions share the colored stderr output unless
+        ``transactionlogFile`` is set or ``transactionlogFormat`` is
+        ``'json'``; see
+        :meth:`~nest.logging.Logger.transaction_handler`.
+
+        :param cfg: A :class:`~nest.config.Config`. Defaults to the
+            last one given.
+        """
         if cfg:
             self.cfg = cfg
 
+        self.stop()
+        self.init(self.error_logger, self.transcation_logger)
+
         self.errorlogLevel = self.LOG_LEVELS.get(
                 self.cfg.errlogLevel.lower(), 
                 logging.INFO
@@ -49,8 +214,118 @@ class Logger(object):
         handler = StreamHandler()
         formatter = ColoredFormatter(self.error_fmt, self.datefmt)
         handler.setFormatter(formatter)
-        self.error_logger.addHandler(handler)
-        self.transcation_logger.addHandler(handler)
+        self.handlers = [handler]
+
+        transaction_handler = self.transaction_handler(self.cfg)
+        if transaction_handler:
+            handler.addFilter(
+                lambda record: record.name != self.transcation_logger.name
+            )
+            transaction_handler.addFilter(
+                logging.Filter(self.transcation_logger.name)
+            )
+            self.handlers.append(transaction_handler)
+
+        if self.cfg.logQueue:
+            queue = Queue(maxsize=self.cfg.logQueueSize)
+            # Built first, so that a bad policy raises before the
+            # listener's thread is started
+            self.queue_handler = BoundedQueueHandler(
+                queue,
+                self.cfg.logQueuePolicy
+            )
+            self.listener = BackgroundListener(queue, *self.handlers)
+            self.listener.start()
+            handlers = [self.queue_handler]
+        else:
+            handlers = self.handlers
+
+        for handler in handlers:
+            self.error_logger.addHandler(handler)
+            self.transcation_logger.addHandler(handler)
+
+    def reconfigure(self, cfg, changes):
+        """:meth:`~nest.config.Config.subscribe` callback that calls
+        :meth:`~nest.logging.Logger.setup` again if any logging option
+        changed.
+
+        :param cfg: The :class:`~nest.config.Config`.
+        :param changes: Changed values.
+        """
+        for key in changes:
+            if key.startswith(self.CONFIG_PREFIXES):
+                self.setup(cfg)
+                return
+
+    @classmethod
+    def transaction_handler(cls, cfg):
+        """A dedicated handler for the transaction log, or ``None`` if
+        transactions go to stderr with everything else.
+
+        ``transactionlogFormat = json`` writes one JSON object per
+        transaction (see :class:`~nest.logging.JSONFormatter`).
+        ``transactionlogFile`` writes to a file instead of stderr,
+        rotated every ``transactionlogMaxBytes`` bytes or at
+        ``transactionlogWhen`` (e.g. ``'midnight'``), keeping
+        ``transactionlogBackupCount`` old files which are gzipped if
+        ``transactionlogCompress`` is set. File writes are flushed every
+        ``transactionlogBuffer`` records.
+
+        :param cfg: A :class:`~nest.config.Config`.
+        """
+        if cfg.transactionlogFormat == "json":
+            formatter = JSONFormatter()
+        elif cfg.transactionlogFile:
+            formatter = logging.Formatter(
+                "%(asctime)s [%(process)d] [%(levelname)s] %(message)s",
+                cls.datefmt
+            )
+        else:
+            return None
+
+        if not(cfg.transactionlogFile):
+            handler = logging.StreamHandler()
+        elif cfg.transactionlogWhen:
+            handler = BufferedTimedRotatingFileHandler(
+                cfg.transactionlogFile,
+                capacity=cfg.transactionlogBuffer,
+                when=cfg.transactionlogWhen,
+                backupCount=cfg.transactionlogBackupCount,
+                utc=True
+            )
+        else:
+            handler = BufferedRotatingFileHandler(
+                cfg.transactionlogFile,
+                capacity=cfg.transactionlogBuffer,
+                maxBytes=cfg.transactionlogMaxBytes,
+                backupCount=cfg.transactionlogBackupCount
+            )
+
+        if cfg.transactionlogFile and cfg.transactionlogCompress:
+            handler.namer = gzip_namer
+            handler.rotator = gzip_rotator
+
+        handler.setFormatter(formatter)
+        return handler
+
+    def stop(self):
+        """Stop the background thread, if any, after it has written
+        all queued records, and close any log files.
+        """
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+
+        for handler in self.handlers:
+            handler.close()
+
+    @property
+    def dropped(self):
+        """Number of records dropped because the queue was full.
+        """
+        if self.queue_handler:
+            return self.queue_handler.dropped
+        return 0
 
     def critical(self, msg, *args, **kwargs):
         self.error_logger.critical(msg, *args, **kwargs)
@@ -76,6 +351,21 @@ class Logger(object):
         self.error_logger.log(level, messsage, *args, **kwargs)
 
     def transaction(self, level, messsage, *args, **kwargs):
+        """Log to the transaction logger.
+
+        Any of :attr:`~nest.logging.Logger.TRANSACTION_FIELDS` given as
+        keyword arguments (``event``, ``type``, ``reference``,
+        ``duration`` and ``outcome``) are attached to the record and
+        become keys of the JSON transaction log.
+        """
         if isinstance(level, str):
             level = self.LOG_LEVELS.get(level.lower(), logging.INFO)
+
+        fields = {}
+        for field in self.TRANSACTION_FIELDS:
+            if field in kwargs:
+                fields[field] = kwargs.pop(field)
+        if fields:
+            kwargs["extra"] = dict(kwargs.get("extra", {}), **fields)
+
         self.transcation_logger.log(level, messsage, *args, **kwargs)
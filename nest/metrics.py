@@ -0,0 +1,275 @@
+import json
+import os
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import perf_counter
+
+from nest.types import Singleton
+
+
+class Histogram(object):
+    """Bucketed distribution of observed values.
+
+    :param buckets: Sorted upper bounds of the buckets. Values above the
+        last bound are counted in an implicit ``+Inf`` bucket.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Yields ``(upper bound, count of values <= bound)`` pairs,
+        ending with ``('+Inf', count)``.
+        """
+        total = 0
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            yield bound, total
+
+
+class Timer(object):
+    """Context manager that observes its duration into a histogram.
+    """
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, perf_counter() - self.start)
+
+
+class NullTimer(object):
+    """Stand-in for :class:`~nest.metrics.Timer` while metrics are
+    disabled.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics(object, metaclass=Singleton):
+    """In-process registry of timers and counters.
+
+    Hot paths of nest are wrapped in timers (see
+    :meth:`~nest.metrics.Metrics.timer`). These cost a single attribute
+    check until metrics are enabled, usually through
+    :meth:`~nest.metrics.Metrics.configure`::
+
+        metrics = Metrics()
+        metrics.configure(Config())
+
+        with metrics.timer("sync"):
+            ...
+
+        metrics.export()
+
+    Durations are in seconds. Metric names are dotted, e.g.
+    ``'fastspring.request'``, and exported as
+    ``nest_fastspring_request_seconds``.
+    """
+    BUCKETS = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+    )
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.format = "prometheus"
+        self.lock = Lock()
+        self.reset()
+
+    def configure(self, cfg):
+        """Enable or disable metrics and set the export target from a
+        :class:`~nest.config.Config`.
+        """
+        self.enabled = cfg.metrics
+        self.path = cfg.metricsFile
+        self.format = cfg.metricsFormat
+
+    def reset(self):
+        """Forget everything recorded so far.
+        """
+        with self.lock:
+            self.counters = defaultdict(int)
+            self.histograms = {}
+
+    def increment(self, name, value=1):
+        """Add ``value`` to a counter.
+        """
+        if not(self.enabled):
+            return
+
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        """Record a duration in a histogram.
+        """
+        if not(self.enabled):
+            return
+
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(self.BUCKETS)
+                self.histograms[name] = histogram
+            histogram.observe(seconds)
+
+    def timer(self, name):
+        """A context manager timing its body into the ``name``
+        histogram.
+        """
+        if not(self.enabled):
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def timed(self, name):
+        """Decorator timing every call of the decorated function into
+        the ``name`` histogram.
+        """
+        def wrapper(fn):
+            @wraps(fn)
+            def wrapped(*args, **kwargs):
+                if not(self.enabled):
+                    return fn(*args, **kwargs)
+                with Timer(self, name):
+                    return fn(*args, **kwargs)
+            return wrapped
+        return wrapper
+
+    def snapshot(self):
+        """A JSON-serializable dict of all counters and histograms.
+        """
+        with self.lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(histogram.cumulative()),
+                }
+            return {
+                "counters": dict(self.counters),
+                "histograms": histograms,
+            }
+
+    @classmethod
+    def metric_name(cls, name, suffix):
+        return "nest_" + name.replace(".", "_").replace("-", "_") + suffix
+
+    def to_prometheus(self):
+        """All counters and histograms in the Prometheus text
+        exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = self.metric_name(name, "_total")
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            metric = self.metric_name(name, "_seconds")
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{metric}_sum {histogram['sum']}")
+            lines.append(f"{metric}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=None, format=None):
+        """Write all metrics to a file, atomically, so that it can be
+        picked up by e.g. the node exporter's textfile collector.
+
+        :param path: Output file. Defaults to the configured path.
+        :param format: ``'prometheus'`` or ``'json'``. Defaults to the
+            configured format.
+        """
+        path = path or self.path
+        format = format or self.format
+        if not(path):
+            return
+
+        if format == "json":
+            content = json.dumps(self.snapshot(), indent=4)
+        else:
+            content = self.to_prometheus()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        with NamedTemporaryFile("w", dir=directory, delete=False) as file:
+            file.write(content)
+        os.replace(file.name, path)
+
+
+# Avoids going through `Singleton.__call__` on every hot-path call
+_metrics = Metrics()
+
+def timer(name):
+    """Shortcut for :meth:`~nest.metrics.Metrics.timer`.
+    """
+    return _metrics.timer(name)
+
+def timed(name):
+    """Shortcut for :meth:`~nest.metrics.Metrics.timed`.
+    """
+    return _metrics.timed(name)
+
+def increment(name, value=1):
+    """Shortcut for :meth:`~nest.metrics.Metrics.increment`.
+    """
+    _metrics.increment(name, value)
+
+def _start(name):
+    def callback(session, *args):
+        if _metrics.enabled:
+            session.info[name] = perf_counter()
+    return callback
+
+def _stop(name):
+    def callback(session, *args):
+        start = session.info.pop(name, None)
+        if start is not None:
+            _metrics.observe(name, perf_counter() - start)
+    return callback
+
+SESSION_EVENTS = [
+    ("before_flush", _start("session.flush")),
+    ("after_flush_postexec", _stop("session.flush")),
+    ("before_commit", _start("session.commit")),
+    ("after_commit", _stop("session.commit")),
+]
+
+def instrument(target):
+    """Time the flushes and commits of ``target`` into the
+    ``session.flush`` and ``session.commit`` histograms.
+
+    :param target: A ``Session``, ``sessionmaker`` or
+        ``scoped_session``.
+    """
+    from sqlalchemy.event import contains, listen
+
+    for event, callback in SESSION_EVENTS:
+        if not(contains(target, event, callback)):
+            listen(target, event, callback)
@@ -1,3 +1,7 @@
+import sys
+from importlib import import_module
+
+
 class Singleton(type):
     """A metaclass that allows a constructed object to be made only 
     *once*. Each subsequent construction call will return the original 
@@ -11,3 +15,52 @@ class Singleton(type):
         if cls._instance is None:
             cls._instance = super().__call__(*args, **kwargs)
         return cls._instance
+
+class LazyModule(object):
+    """Stand-in for a module that is only imported when one of its
+    attributes is first accessed.
+
+    ::
+
+        models = LazyModule("nest.engines.psql.models")
+        models.User # Imports SQLAlchemy and the models here
+
+    :param name: Absolute module name.
+    """
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+
+    def __getattr__(self, attr):
+        return getattr(import_module(self._name), attr)
+
+    def __repr__(self):
+        return f"<LazyModule '{self._name}'>"
+
+def lazy_attributes(package, attributes):
+    """Module-level ``__getattr__`` and ``__dir__`` functions that
+    import the attributes of ``package`` from their submodules on first
+    access, so that importing the package itself stays cheap::
+
+        __getattr__, __dir__ = lazy_attributes(__name__, {
+            "PostgreSQLEngine": "nest.engines.psql",
+        })
+
+    :param package: ``__name__`` of the package.
+    :param attributes: Dict of attribute names to the modules they are
+        imported from.
+    """
+    namespace = sys.modules[package].__dict__
+
+    def __getattr__(name):
+        if name not in attributes:
+            raise AttributeError(
+                f"module '{package}' has no attribute '{name}'"
+            )
+        value = getattr(import_module(attributes[name]), name)
+        namespace[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(namespace) | set(attributes))
+
+    return __getattr__, __dir__
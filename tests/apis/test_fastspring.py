@@ -1,11 +1,20 @@
+import asyncio
 from base64 import b64encode, urlsafe_b64encode
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import json
 from os import path, urandom, environ
-from urllib.parse import urlencode, urljoin
+from threading import Event, Lock
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit
 
 import pytest
+from requests import HTTPError, Response
+from requests.adapters import BaseAdapter
 
-from nest.apis.fastspring import FastSpring
+from nest.apis.fastspring import FastSpring, IncompleteCatalog, catalog
+from nest.apis.utils import Cursor
+from nest.apis.fastspring.ingest import Writer, coalesce
+from nest.apis.fastspring.webhooks import WebhookReceiver, sign
 from nest.apis.fastspring.events import (
     EventParser, 
     Order, 
@@ -15,6 +24,14 @@ from nest.apis.fastspring.events import (
     WebhookEvent
 )
 from nest.engines.psql import PostgreSQLEngine
+from nest.engines.psql import rollups
+from nest.engines.psql.models import (
+    DeadLetter,
+    Order as OrderModel,
+    Product,
+    Return as ReturnModel,
+    User
+)
 
 SkipIfNoAuth = pytest.mark.skipif(
     not(environ.get("FS_AUTH_USER") and environ.get("FS_AUTH_PASS")), 
@@ -52,6 +69,182 @@ def database(engine):
 def session():
     yield FastSpring()
 
+class CatalogAdapter(BaseAdapter):
+    """Serves ``/products`` like FastSpring does. Chunks starting with
+    an id in ``failures`` fail with a 502 that many times.
+    """
+    def __init__(self, products, failures={}):
+        super().__init__()
+        self.products = {p["product"]: p for p in products}
+        self.failures = dict(failures)
+        self.requests = []
+        self.lock = Lock()
+
+    def send(self, request, **kwargs):
+        path = urlsplit(request.url).path
+        ids = [id for id in path.split("/", 2)[2].split(",") if id]
+
+        response = Response()
+        response.request, response.url = request, request.url
+        response.status_code = 200
+        with self.lock:
+            self.requests.append(ids)
+            if ids and self.failures.get(ids[0], 0) > 0:
+                self.failures[ids[0]] -= 1
+                response.status_code = 502
+
+        if not(ids):
+            body = {"action": "products.getall", "result": "success",
+                    "products": list(self.products)}
+        else:
+            body = {"products": [
+                self.products.get(id, {"product": id, "result": "error"})
+                for id in ids
+            ]}
+        response._content = json.dumps(body).encode()
+        return response
+
+    def close(self):
+        pass
+
+def catalog_products(count):
+    products = []
+    for i in range(count):
+        products.append({"product": f"p{i}", "result": "success",
+                         "pricing": {"price": {"USD": i}}})
+        products.append({"product": f"p{i}-upgrade", "parent": f"p{i}",
+                         "result": "success"})
+    return products
+
+def test_fastspring_get_products_chunked():
+    session = FastSpring()
+    adapter = CatalogAdapter(catalog_products(10))
+    session.mount("https://", adapter)
+
+    products = session.get_products(chunk_size=3, workers=3)
+    # The id listing plus 7 chunks of at most 3 ids
+    assert(len(adapter.requests) == 8)
+    assert(max(len(ids) for ids in adapter.requests) == 3)
+    assert(len(products) == 10)
+    assert(products["p4"]["price"] == 4)
+    assert(sorted(products["p4"]["aliases"]) == ["p4", "p4-upgrade"])
+
+    adapter.requests = []
+    assert(session.get_products(chunk_size=1000) == products)
+    assert(len(adapter.requests) == 2)
+
+    adapter.requests = []
+    products = session.get_products(filter=["p1", "p2", "foo"])
+    assert(adapter.requests == [["p1", "p2", "foo"]])
+    assert(list(products) == ["p1", "p2"])
+
+def test_fastspring_get_products_retry():
+    session = FastSpring()
+    adapter = CatalogAdapter(catalog_products(10), failures={"p3": 2})
+    session.mount("https://", adapter)
+
+    products = session.get_products(chunk_size=6, backoff=0)
+    assert(len(products) == 10)
+    assert(len(adapter.requests) == 1 + 4 + 2)
+
+    # Chunks that keep failing make the whole catalog incomplete
+    adapter.failures = {"p3": 3}
+    with pytest.raises(IncompleteCatalog) as info:
+        session.get_products(chunk_size=6, backoff=0)
+    assert(info.value.failed == [
+        "p3", "p3-upgrade", "p4", "p4-upgrade", "p5", "p5-upgrade"
+    ])
+    assert(sorted(info.value.products) == [
+        "p0", "p1", "p2", "p6", "p7", "p8", "p9"
+    ])
+
+class OrdersAdapter(BaseAdapter):
+    """Serves ``/orders`` in pages of ``size``. Pages in ``failures``
+    fail with a 502 that many times.
+    """
+    def __init__(self, count, size=10, failures={}):
+        super().__init__()
+        self.orders = [{"id": f"o{i}"} for i in range(count)]
+        self.size = size
+        self.failures = dict(failures)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        query = dict(parse_qsl(urlsplit(request.url).query))
+        page = int(query.get("page", 1))
+        self.requests.append(page)
+
+        response = Response()
+        response.request, response.url = request, request.url
+        response.status_code = 200
+        if self.failures.get(page, 0) > 0:
+            self.failures[page] -= 1
+            response.status_code = 502
+
+        start = (page - 1) * self.size
+        more = start + self.size < len(self.orders)
+        response._content = json.dumps({
+            "orders": self.orders[start:start + self.size],
+            "nextPage": page + 1 if more else None,
+        }).encode()
+        return response
+
+    def close(self):
+        pass
+
+def test_fastspring_get_orders_retry():
+    session = FastSpring()
+    adapter = OrdersAdapter(25, failures={2: 2})
+    session.mount("https://", adapter)
+
+    cursor = Cursor()
+    orders = list(session.get_orders(cursor=cursor, backoff=0))
+    assert(len(orders) == 25)
+    assert(adapter.requests == [1, 2, 2, 2, 3])
+    assert(cursor.done and cursor.error is None)
+
+def test_fastspring_get_orders_resume():
+    session = FastSpring()
+    adapter = OrdersAdapter(25, failures={3: 3})
+    session.mount("https://", adapter)
+
+    # Retries run out on the last page: the listing stops, logged by
+    # protect(), and the cursor is left on that page
+    cursor = Cursor()
+    orders = list(session.get_orders(cursor=cursor, backoff=0))
+    assert(len(orders) == 20)
+    assert(not(cursor.done))
+    assert(cursor.error.response.status_code == 502)
+    assert(cursor.position == {"page": 3})
+
+    cursor = Cursor.loads(cursor.dumps())
+    orders += list(session.get_orders(cursor=cursor, backoff=0))
+    assert([order["id"] for order in orders] == [f"o{i}" for i in range(25)])
+    assert(cursor.done)
+
+    # A finished cursor yields nothing
+    adapter.requests = []
+    assert(list(session.get_orders(cursor=cursor)) == [])
+    assert(adapter.requests == [])
+
+def test_fastspring_get_orders_no_cursor():
+    session = FastSpring()
+    session.mount("https://", OrdersAdapter(25, failures={3: 3}))
+
+    # Without a cursor to resume from, running out of retries raises
+    # instead of cutting the listing short
+    orders = []
+    with pytest.raises(HTTPError):
+        for order in session.get_orders(backoff=0):
+            orders.append(order)
+    assert(len(orders) == 20)
+
+def test_fastspring_prefix():
+    assert(FastSpring().prefix == "https://api.fastspring.com")
+
+    session = FastSpring(prefix="http://localhost:8080")
+    assert(session.prefix == "http://localhost:8080")
+
 @SkipIfNoAuth
 def test_session_hooks(session):
     counter = 0
@@ -216,4 +409,438 @@ def test_event_parser(session, database):
     generator = session.get_events("processed", params={"days":1})
     for event in EventParser(generator, session=database):
         if event.type in type_map.keys():
-            assert(isinstance(event, type_map.get(event.type)))
\ No newline at end of file
+            assert(isinstance(event, type_map.get(event.type)))
+
+@SkipIfNoPsql
+def test_catalog_sync(database):
+    class Session(object):
+        def __init__(self, products):
+            self.products = products
+
+        def get_products(self, *args, **kwargs):
+            return self.products
+
+    database.add_all([
+        Product(name="foo", aliases=["foo", "foo-upgrade"], price=10),
+        Product(name="bar", aliases=["bar"], price=20),
+        Product(name="baz", aliases=["baz"], price=30),
+    ])
+    database.commit()
+
+    products = {
+        "foo": {"price": 10.0, "aliases": ["foo-upgrade", "foo"]},
+        "bar": {"price": 25.5, "aliases": ["bar", "bar-upgrade"]},
+        "qux": {"price": 5, "aliases": ["qux"]},
+    }
+    changes = catalog.sync(database, Session(products))
+    assert(list(changes.inserted) == ["qux"])
+    assert(list(changes.repriced) == ["bar"])
+    assert(list(changes.realiased) == ["bar"])
+    assert(changes.missing == ["baz"])
+
+    database.expire_all()
+    bar = database.query(Product).filter_by(name="bar").one()
+    assert(bar.price == Decimal("25.50"))
+    assert(bar.aliases == ["bar", "bar-upgrade"])
+    qux = database.query(Product).filter_by(name="qux").one()
+    assert(qux.aliases == ["qux"] and qux.current and qux.version == 1)
+    assert(database.query(Product).count() == 4)
+
+    changes = catalog.diff(database, products)
+    assert(not(changes.changed))
+
+    changes = catalog.sync(database, Session({}))
+    assert(not(changes.changed) and changes.missing == [])
+
+@SkipIfNoPsql
+def test_catalog_sync_incomplete(database):
+    database.add_all([
+        Product(name="p1", aliases=["p1", "p1-upgrade"], price=1),
+        Product(name="p4", aliases=["p4", "p4-upgrade"], price=4),
+    ])
+    database.commit()
+
+    # The chunk with p4 fails while the one with its alias does not
+    products = catalog_products(6)
+    products.insert(9, products.pop(8))
+    session = FastSpring()
+    adapter = CatalogAdapter(products, failures={"p4": 3})
+    session.mount("https://", adapter)
+
+    with pytest.raises(IncompleteCatalog):
+        catalog.sync(database, session, chunk_size=3, backoff=0)
+    database.rollback()
+
+    # Nothing was repriced or realiased
+    p4 = database.query(Product).filter_by(name="p4").one()
+    assert(p4.price == Decimal("4.00"))
+    assert(p4.aliases == ["p4", "p4-upgrade"])
+    assert(database.query(Product).count() == 2)
+
+    # Neither is a catalog with aliases of an unknown product
+    class Session(object):
+        def get_products(self, *args, **kwargs):
+            return {"p4": {"aliases": ["p4-upgrade"]}}
+
+    with pytest.raises(IncompleteCatalog):
+        catalog.sync(database, Session())
+
+async def deliver(receiver, events, secret="secret", signature=None):
+    """POST ``events`` to ``receiver`` and return the response status.
+    """
+    body = json.dumps({"events": events}).encode()
+    signature = signature or sign(secret, body)
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", receiver.port)
+    writer.write(
+        f"POST / HTTP/1.1\r\nContent-Length: {len(body)}\r\n"
+        f"X-FS-Signature: {signature}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+def subscription_event(id, email, active=True, created=1577836800000):
+    type = "subscription.activated" if active else "subscription.deactivated"
+    return {
+        "id": id,
+        "type": type,
+        "live": False,
+        "processed": False,
+        "created": created,
+        "data": {
+            "active": active,
+            "account": {"language": "en", "country": "US"},
+            "contact": {"email": email, "first": "Jane", "last": "Doe"},
+        },
+    }
+
+def test_webhook_signature(monkeypatch):
+    body = b'{"events": []}'
+    receiver = WebhookReceiver(lambda batch: None, secret="secret")
+    assert(receiver.verify(body, sign("secret", body)))
+    assert(not(receiver.verify(body, sign("other", body))))
+    assert(not(receiver.verify(body, None)))
+    assert(WebhookReceiver(None, secret=False).verify(body, None))
+
+    # Refused unless unsigned deliveries are asked for
+    with pytest.raises(ValueError):
+        WebhookReceiver(None, secret="")
+    monkeypatch.delenv("FASTSPRING_WEBHOOK_SECRET", raising=False)
+    with pytest.raises(ValueError):
+        WebhookReceiver(None)
+
+def test_webhook_receiver():
+    batches = []
+    receiver = WebhookReceiver(
+        batches.append,
+        secret="secret",
+        port=0,
+        batch_size=3,
+        linger=0.05
+    )
+
+    async def run():
+        async with receiver:
+            events = [{"id": str(i)} for i in range(5)]
+            assert(await deliver(receiver, events) == 202)
+            assert(await deliver(receiver, [{"id": "x"}], signature="x") == 401)
+            assert(await deliver(receiver, [{"id": "5"}]) == 202)
+
+    asyncio.run(run())
+    assert([len(batch) for batch in batches] == [3, 3])
+    assert([e["id"] for b in batches for e in b] == [str(i) for i in range(6)])
+
+def test_webhook_receiver_backpressure():
+    release, batches = Event(), []
+    def handler(batch):
+        release.wait(5)
+        batches.append(batch)
+
+    receiver = WebhookReceiver(
+        handler,
+        secret="secret",
+        port=0,
+        buffer_size=4,
+        batch_size=2,
+        linger=0,
+        timeout=0.1
+    )
+
+    async def run():
+        async with receiver:
+            # The first batch is taken by the blocked handler, then the
+            # buffer fills up and deliveries that do not fit are refused
+            assert(await deliver(receiver, [{"id": "0"}, {"id": "1"}]) == 202)
+            await asyncio.sleep(0.05)
+            events = [{"id": str(i)} for i in range(2, 6)]
+            assert(await deliver(receiver, events) == 202)
+            assert(await deliver(receiver, [{"id": "6"}]) == 503)
+            assert(receiver.pending == 4)
+
+            # Too large to ever fit
+            events = [{"id": str(i)} for i in range(5)]
+            assert(await deliver(receiver, events) == 413)
+            release.set()
+
+    asyncio.run(run())
+    assert([e["id"] for b in batches for e in b] == [str(i) for i in range(6)])
+
+def test_webhook_receiver_retries():
+    failures, batches, buried = {"0": 2, "3": 5}, [], []
+    def handler(batch):
+        if failures.get(batch[0]["id"], 0) > 0:
+            failures[batch[0]["id"]] -= 1
+            raise RuntimeError("database is down")
+        batches.append(batch)
+
+    receiver = WebhookReceiver(
+        handler,
+        secret="secret",
+        port=0,
+        batch_size=3,
+        linger=0.05,
+        backoff=0,
+        fallback=buried.append
+    )
+
+    async def run():
+        async with receiver:
+            events = [{"id": str(i)} for i in range(6)]
+            assert(await deliver(receiver, events) == 202)
+
+    asyncio.run(run())
+    # The first batch goes through on its third attempt, the second one
+    # keeps failing and is handed to the fallback instead of dropped
+    assert(batches == [[{"id": "0"}, {"id": "1"}, {"id": "2"}]])
+    assert(buried == [[{"id": "3"}, {"id": "4"}, {"id": "5"}]])
+    assert(failures == {"0": 0, "3": 2})
+
+@SkipIfNoPsql
+def test_webhook_writer(engine, database):
+    receiver = WebhookReceiver(Writer(engine), secret="secret", port=0)
+
+    async def run():
+        async with receiver:
+            events = [
+                subscription_event("1", "jane@example.com"),
+                subscription_event("2", "john@example.com"),
+                {"id": "3", "type": "unknown.type", "data": {}},
+            ]
+            assert(await deliver(receiver, events) == 202)
+
+    asyncio.run(run())
+    users = database.query(User).order_by(User.email).all()
+    assert([user.email for user in users] == [
+        "jane@example.com", "john@example.com"
+    ])
+    assert(all(user.subscribed for user in users))
+
+@SkipIfNoPsql
+def test_writer_dead_letters(engine, database):
+    writer = Writer(engine)
+    events = [
+        subscription_event("1", "jane@example.com"),
+        subscription_event("2", None),
+        subscription_event("3", "john@example.com"),
+    ]
+    assert(writer(events) == 2)
+    assert(database.query(User).count() == 2)
+
+    letter = database.query(DeadLetter).one()
+    assert(letter.event_id == "2" and letter.type == "subscription.activated")
+    assert(letter.payload == events[1] and letter.attempts == 1)
+    assert("IntegrityError" in letter.error)
+
+    # Still broken
+    assert(writer.replay() == 0)
+    database.expire_all()
+    assert(database.query(DeadLetter).one().attempts == 2)
+
+    letter = database.query(DeadLetter).one()
+    letter.payload = subscription_event("2", "jim@example.com")
+    database.commit()
+    assert(writer.replay() == 1)
+    assert(database.query(DeadLetter).count() == 0)
+    assert(database.query(User).count() == 3)
+
+def test_coalesce_subscriptions():
+    events = list(EventParser([
+        subscription_event("1", "jane@example.com", True, 3000),
+        subscription_event("2", "jane@example.com", False, 5000),
+        subscription_event("3", "jane@example.com", True, 4000),
+        subscription_event("4", "john@example.com", False, 1000),
+        subscription_event("5", "john@example.com", True, 1000),
+        subscription_event("6", None),
+        {"id": "7", "type": "order.completed", "data": {}},
+    ]))
+    latest = coalesce(events)
+    assert({email: event.id for email, event in latest.items()} == {
+        "jane@example.com": "2",
+        "john@example.com": "5",
+    })
+
+def test_subscription_activated_user():
+    event = next(iter(EventParser([
+        subscription_event("1", "jane@example.com")
+    ])))
+    assert(isinstance(event, SubscriptionActivated))
+
+    # The user is built once and returned again on every access
+    user = event.user
+    assert(user.email == "jane@example.com")
+    assert(user.subscribed)
+    assert(event.user is user)
+
+@SkipIfNoPsql
+def test_writer_subscriptions(engine, database):
+    database.add(User(email="john@example.com", first="John", last="Doe"))
+    database.commit()
+
+    writer = Writer(engine)
+    events = [
+        subscription_event("1", "jane@example.com", True, 3000),
+        subscription_event("2", "jane@example.com", False, 5000),
+        subscription_event("3", "jane@example.com", True, 4000),
+        subscription_event("4", "john@example.com", True, 1000),
+    ]
+    with engine.profile() as profiler:
+        assert(writer(events) == 4)
+
+    # An insert for jane and an update for john, no lookups
+    statements = [stat.fingerprint for stat in profiler.top(n=10)]
+    assert(not(any(s.startswith("SELECT") for s in statements)))
+
+    database.expire_all()
+    users = {user.email: user for user in database.query(User)}
+    assert(not(users["jane@example.com"].subscribed))
+    assert(users["jane@example.com"].first == "Jane")
+    assert(users["john@example.com"].subscribed)
+    assert(users["john@example.com"].first == "John")
+
+def return_event(id, reference, original, amount):
+    return {
+        "id": id,
+        "type": "return.created",
+        "live": False,
+        "processed": False,
+        "created": 1577836800000,
+        "data": {
+            "reference": reference,
+            "original": {"reference": original},
+            "totalReturnInPayoutCurrency": amount,
+        },
+    }
+
+@SkipIfNoPsql
+def test_writer_returns(engine, database):
+    rollups.track(engine.session_factory)
+
+    product = Product(name="foo", aliases=["foo"])
+    orders = [
+        OrderModel(reference=f"O{i}", created=datetime(2020, 1, 1), total=100)
+        for i in range(3)
+    ]
+    for order in orders:
+        order.products.append(product)
+    database.add_all(orders)
+    database.commit()
+
+    events = [
+        return_event("1", "R1", "O0", 100),
+        return_event("2", "R2", "O1", 30),
+        return_event("3", "R3", "O1", 20),
+        return_event("4", "R4", "unknown", 10),
+    ]
+    with engine.profile() as profiler:
+        assert(Writer(engine)(events) == 3)
+
+    # One query for the orders, one insert for the returns
+    counts = {stat.fingerprint: stat.count for stat in profiler.top(n=10)}
+    assert(sum(n for s, n in counts.items() if "orders.reference" in s) == 1)
+    assert(sum(n for s, n in counts.items() if "INTO returns" in s) == 1)
+
+    database.expire_all()
+    returns = database.query(ReturnModel).order_by(ReturnModel.reference)
+    assert([(r.reference, r.order.reference) for r in returns] == [
+        ("R1", "O0"), ("R2", "O1"), ("R3", "O1")
+    ])
+    assert(orders[0].returned and not(orders[1].returned))
+
+    row = rollups.daily(database, date(2020, 1, 1), date(2020, 1, 1))[0]
+    assert(row.returns == 3 and row.returned == Decimal("150.00"))
+
+    rollups.untrack(engine.session_factory)
+
+def order_event(id, reference, customer, recipient=None):
+    customer = {"email": customer, "first": "Jane", "last": "Doe"}
+    recipient = dict(customer, email=recipient) if recipient else customer
+    return {
+        "id": id,
+        "type": "order.completed",
+        "live": False,
+        "processed": False,
+        "created": 1577836800000,
+        "data": {
+            "reference": reference,
+            "customer": customer,
+            "recipients": [{"recipient": recipient}],
+            "items": [{"product": "foo", "driver": {"path": "foo"}}],
+            "totalInPayoutCurrency": 10,
+        },
+    }
+
+@SkipIfNoPsql
+def test_writer_orders(engine, database):
+    database.add_all([
+        User(email="jane@example.com", first="Jane", last="Doe"),
+        Product(name="foo", aliases=["foo"]),
+    ])
+    database.commit()
+
+    events = [
+        order_event("1", "O1", "jane@example.com"),
+        order_event("2", "O2", "jane@example.com", "john@example.com"),
+        order_event("3", "O3", "jim@example.com"),
+    ]
+    with engine.profile() as profiler:
+        assert(Writer(engine)(events) == 3)
+
+    # Users are upserted at once rather than looked up per order
+    counts = {stat.fingerprint: stat.count for stat in profiler.top(n=20)}
+    assert(sum(n for s, n in counts.items() if "FROM users" in s) == 0)
+    assert(sum(n for s, n in counts.items() if "INTO users" in s) == 1)
+
+    database.expire_all()
+    orders = {o.reference: o for o in database.query(OrderModel)}
+    assert(orders["O1"].user.email == "jane@example.com")
+    assert(orders["O2"].user.email == "john@example.com")
+    assert(orders["O3"].user.email == "jim@example.com")
+    assert(not(orders["O1"].gift) and orders["O2"].gift)
+    assert([p.name for p in orders["O1"].products] == ["foo"])
+    assert(database.query(User).count() == 3)
+
+@SkipIfNoPsql
+def test_writer_email_case(engine, database):
+    database.add_all([
+        User(email="jane@example.com", first="Jane", last="Doe"),
+        Product(name="foo", aliases=["foo"]),
+    ])
+    database.commit()
+
+    events = [
+        order_event("1", "O1", "Jane@Example.com"),
+        subscription_event("2", "JANE@example.com", True, 1000),
+        subscription_event("3", "jim@example.com", True, 1000),
+        subscription_event("4", "Jim@Example.com", False, 2000),
+    ]
+    assert(Writer(engine)(events) == 4)
+
+    database.expire_all()
+    users = database.query(User).order_by(User.normalized_email).all()
+    assert([(u.email, u.subscribed) for u in users] == [
+        ("jane@example.com", True), ("Jim@Example.com", False)
+    ])
+    order = database.query(OrderModel).one()
+    assert(order.user.email == "jane@example.com" and not(order.gift))
@@ -1,11 +1,27 @@
 from base64 import b64encode, urlsafe_b64encode
+from datetime import datetime, timedelta
 from hashlib import sha1
-from os import environ, urandom
+from os import environ, path, urandom
 from random import choice
+import json
+from urllib.parse import parse_qsl, urlsplit
 
 import pytest
+from requests import Response
+from requests.adapters import BaseAdapter
 
 from nest.apis.mailchimp import Mailchimp
+from nest.apis.mailchimp.audience import Audience
+from nest.apis.mailchimp.sync import sync_members
+from nest.apis.utils import Cursor
+from nest.engines.psql import PostgreSQLEngine
+from nest.engines.psql.models import (
+    MailchimpMember,
+    MailchimpSync,
+    Order,
+    Product,
+    User
+)
 
 SkipIfNoAuth = pytest.mark.skipif(
     not(
@@ -15,6 +31,11 @@ SkipIfNoAuth = pytest.mark.skipif(
     reason="You must have Mailchimp API credentials to run these tests."
 )
 
+SkipIfNoPsql = pytest.mark.skipif(
+    not(path.exists("/usr/lib/postgresql/12/bin/pg_ctl")), 
+    reason="You must have PostgreSQL 12 in order to run these tests."
+)
+
 def random_str(length=16, safe=True):
     rv, bits = b"", urandom(length)
     if safe:
@@ -30,6 +51,340 @@ def session():
     session.default_list = environ.get("DEFAULT_MAILCHIMP_LIST")
     yield session
 
+@pytest.fixture()
+def database(postgresql):
+    connection_info = {
+        "port": postgresql.info.port,
+        "database": postgresql.info.dbname
+    }
+    session = PostgreSQLEngine(connection_info=connection_info).session()
+    yield session
+    session.close()
+
+def test_mailchimp_md5():
+    digest = Mailchimp.md5("jane@example.com")
+    assert(digest == "9e26471d35a78862c17e467d87cddedf")
+    assert(Mailchimp.md5("Jane@Example.COM") == digest)
+    assert(Mailchimp.md5(b"JANE@example.com") == digest)
+
+def test_mailchimp_prefix():
+    assert(Mailchimp().prefix == "https://us14.api.mailchimp.com/3.0/")
+
+    session = Mailchimp(prefix="http://localhost:8080/3.0/")
+    assert(session.prefix == "http://localhost:8080/3.0/")
+
+class MembersAdapter(BaseAdapter):
+    """Serves list members by ``offset``, and no lists. The first ``failures``
+    requests fail with a 503, the following one returns invalid JSON
+    if ``garbage`` is set.
+    """
+    def __init__(self, count, failures=0, garbage=False):
+        super().__init__()
+        self.members = [{"id": str(i)} for i in range(count)]
+        self.failures = failures
+        self.garbage = garbage
+        self.offsets = []
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        response = Response()
+        response.request, response.url = request, request.url
+        response.status_code = 200
+        if url.path.endswith("/lists"):
+            response._content = b'{"lists": []}'
+            return response
+
+        query = dict(parse_qsl(url.query))
+        offset = int(query.get("offset", 0))
+        self.offsets.append(offset)
+
+        response._content = json.dumps({
+            "members": self.members[offset:offset + 10],
+            "total_items": len(self.members),
+        }).encode()
+
+        if self.failures > 0:
+            self.failures -= 1
+            response.status_code = 503
+        elif self.garbage:
+            self.garbage = False
+            response._content = b"{"
+        return response
+
+    def close(self):
+        pass
+
+def test_mailchimp_get_members_resume():
+    session = Mailchimp()
+    adapter = MembersAdapter(25, failures=1)
+    session.mount("https://", adapter)
+
+    members = list(session.get_members(list="abc", backoff=0))
+    assert(len(members) == 25)
+    assert(adapter.offsets == [0, 0, 10, 20])
+
+    # Invalid JSON is not retried, but the listing can be resumed
+    cursor = Cursor({"offset": 10})
+    adapter.garbage = True
+    assert(list(session.get_members(list="abc", cursor=cursor)) == [])
+    assert(not(cursor.done) and cursor.position == {"offset": 10})
+
+    members = list(session.get_members(list="abc", cursor=cursor))
+    assert([member["id"] for member in members] == [
+        str(i) for i in range(10, 25)
+    ])
+    assert(cursor.done)
+
+class ListAdapter(BaseAdapter):
+    """Serves the members of a single list named "Customers", by
+    ``offset`` and ``count``, and filtered by ``since_last_changed``
+    like Mailchimp does. Bulk updates are recorded in ``updates``, and
+    tag updates in ``tagged`` by segment id.
+    """
+    def __init__(self, members, segments={}):
+        super().__init__()
+        self.members = members
+        self.segments = dict(segments)
+        self.queries = []
+        self.updates = []
+        self.tagged = {}
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        response = Response()
+        response.request, response.url = request, request.url
+        response.status_code = 200
+        if url.path.endswith("/lists"):
+            response._content = json.dumps({
+                "lists": [{"name": "Customers", "id": "abc"}]
+            }).encode()
+            return response
+        if "/segments" in url.path:
+            return self.segment(request, url, response)
+        if request.method == "POST":
+            body = json.loads(request.body)
+            self.updates.append(body["members"])
+            response._content = json.dumps({
+                "total_updated": len(body["members"]),
+                "errors": [],
+            }).encode()
+            return response
+
+        query = dict(parse_qsl(url.query))
+        self.queries.append(query)
+        members = self.members
+        if "since_last_changed" in query:
+            since = datetime.fromisoformat(query["since_last_changed"])
+            members = [
+                member for member in members
+                if datetime.fromisoformat(member["last_changed"]) > since
+            ]
+
+        offset, count = int(query.get("offset", 0)), int(query["count"])
+        response._content = json.dumps({
+            "members": members[offset:offset + count],
+            "total_items": len(members),
+        }).encode()
+        return response
+
+    def segment(self, request, url, response):
+        if request.method == "GET":
+            segments = [
+                {"id": id, "name": name}
+                for name, id in self.segments.items()
+            ]
+            body = {"segments": segments, "total_items": len(segments)}
+        elif url.path.endswith("/segments"):
+            name = json.loads(request.body)["name"]
+            self.segments[name] = len(self.segments) + 1
+            body = {"id": self.segments[name], "name": name}
+        else:
+            id = int(url.path.rsplit("/", 1)[1])
+            data = json.loads(request.body)
+            self.tagged.setdefault(id, []).append(
+                (data["members_to_add"], data["members_to_remove"])
+            )
+            body = {
+                "total_added": len(data["members_to_add"]),
+                "total_removed": len(data["members_to_remove"]),
+                "errors": [],
+            }
+        response._content = json.dumps(body).encode()
+        return response
+
+    def close(self):
+        pass
+
+def list_member(i, changed, status="subscribed", tags=[], fields={}):
+    email = f"user{i}@example.com"
+    return {
+        "id": Mailchimp.md5(email),
+        "email_address": email,
+        "status": status,
+        "merge_fields": dict({"FNAME": f"User {i}"}, **fields),
+        "tags": [{"id": j, "name": tag} for j, tag in enumerate(tags)],
+        "last_changed": changed.isoformat() + "+00:00",
+    }
+
+@SkipIfNoPsql
+def test_mailchimp_sync_members(database):
+    long_ago = datetime.utcnow() - timedelta(days=30)
+    members = [list_member(i, long_ago) for i in range(25)]
+    adapter = ListAdapter(members)
+    mailchimp = Mailchimp()
+    mailchimp.default_list = "Customers"
+    mailchimp.mount("https://", adapter)
+
+    synced = sync_members(database, mailchimp, page_size=10)
+    assert(synced == (25, 25, True))
+    assert(len(adapter.queries) == 3)
+    assert("since_last_changed" not in adapter.queries[0])
+
+    state = database.query(MailchimpSync).get("abc")
+    assert(state.members == 25 and state.synced > long_ago)
+
+    # Only the members changed since are requested and rewritten
+    adapter.queries.clear()
+    now = datetime.utcnow()
+    members[3] = list_member(3, now, status="unsubscribed")
+    members[7] = list_member(7, now, tags=["Owns Current"])
+    members.append(list_member(25, now))
+
+    synced = sync_members(database, mailchimp, page_size=10)
+    assert(synced == (3, 3, True))
+    assert(len(adapter.queries) == 1)
+    assert("since_last_changed" in adapter.queries[0])
+
+    mirrored = {
+        member.email: member for member in
+        database.query(MailchimpMember).filter_by(list_id="abc")
+    }
+    assert(len(mirrored) == 26)
+    assert(mirrored["user3@example.com"].status == "unsubscribed")
+    assert(mirrored["user7@example.com"].tags == ["Owns Current"])
+    assert(mirrored["user7@example.com"].id == members[7]["id"])
+    assert(database.query(MailchimpSync).get("abc").members == 26)
+
+    # A full sync sees everything, but leaves unchanged members be
+    synced = sync_members(database, mailchimp, full=True, page_size=10)
+    assert(synced == (26, 0, True))
+
+@SkipIfNoPsql
+def test_mailchimp_audience(database):
+    ozone = Product(name="Ozone 2", set="Ozone", version=2)
+    order = Order(reference="ABC", total=10, products=[ozone])
+    order.user = User(email="User0@Example.com", first="A", last="A",
+                      subscribed=True)
+    database.add_all([
+        order,
+        User(email="user1@example.com", first="B", last="B"),
+        User(email="user2@example.com", first="C", last="C"),
+    ])
+    database.commit()
+
+    changed = datetime.utcnow() - timedelta(days=1)
+    adapter = ListAdapter([
+        # In line with its user
+        list_member(0, changed, fields={
+            "SETS": "Ozone", "MEMBER": "yes", "OZONE_VER": 2
+        }, tags=["Customer"]),
+        # Out of date
+        list_member(1, changed, fields={
+            "SETS": "", "MEMBER": "yes", "OZONE_VER": ""
+        }),
+        # Without a user
+        list_member(3, changed),
+    ])
+    mailchimp = Mailchimp()
+    mailchimp.default_list = "Customers"
+    mailchimp.mount("https://", adapter)
+    sync_members(database, mailchimp)
+
+    audience = Audience(versions={"Ozone": "OZONE_VER"})
+    assert(list(audience.changes(database, "abc")) == [{
+        "email_address": "user1@example.com",
+        "merge_fields": {"SETS": "", "MEMBER": "no", "OZONE_VER": ""},
+    }])
+
+    # Users are not added to the list
+    assert(audience.push(database, mailchimp) == 1)
+    assert(len(adapter.updates) == 1)
+    assert(adapter.updates[0][0]["email_address"] == "user1@example.com")
+
+    # Nor are fields outside of the audience compared
+    assert(list(Audience(sets=None).changes(database, "abc")) == [{
+        "email_address": "user1@example.com",
+        "merge_fields": {"MEMBER": "no"},
+    }])
+
+@SkipIfNoPsql
+def test_mailchimp_audience_tags(database):
+    current = Product(name="Ozone 2", set="Ozone", version=2, price=10)
+    old = Product(name="Ozone 1", set="Ozone", version=1, price=10,
+                  current=False)
+    demo = Product(name="Neutron Demo", set="Neutron", demo=True)
+    owners = {0: [current], 1: [old], 2: [demo]}
+    for i in range(5):
+        user = User(email=f"user{i}@example.com", first="A", last="A")
+        if i in owners:
+            order = Order(reference=str(i), total=10, products=owners[i])
+            order.user = user
+        database.add(user)
+    database.commit()
+
+    changed = datetime.utcnow() - timedelta(days=1)
+    adapter = ListAdapter([
+        list_member(0, changed, tags=["Owns Current Ozone", "Newsletter"]),
+        list_member(1, changed, tags=["Owns Current Ozone"]),
+        list_member(2, changed),
+        list_member(3, changed, tags=["Owns Any Paid"]),
+        list_member(4, changed, tags=["Newsletter"]),
+    ], segments={"Owns Current Ozone": 7, "Owns Any Paid": 8})
+    mailchimp = Mailchimp()
+    mailchimp.default_list = "Customers"
+    mailchimp.mount("https://", adapter)
+    sync_members(database, mailchimp)
+
+    audience = Audience(
+        current={"Ozone": "Owns Current Ozone"},
+        paid="Owns Any Paid",
+        demo="Demo Only"
+    )
+    assert(audience.tag_changes(database, "abc") == {
+        "Owns Current Ozone": ([], ["user1@example.com"]),
+        "Owns Any Paid": (
+            ["user0@example.com", "user1@example.com"],
+            ["user3@example.com"]
+        ),
+        "Demo Only": (["user2@example.com"], []),
+    })
+
+    report = audience.push_tags(database, mailchimp, chunk_size=1)
+    assert(report.members == 4 and report.requests == 4)
+    assert((report.added, report.removed) == (3, 2))
+    assert(report.rate > 0)
+
+    # Missing tags are created, unrelated ones are left alone
+    assert(adapter.segments["Demo Only"] == 3)
+    assert(adapter.tagged == {
+        3: [(["user2@example.com"], [])],
+        7: [([], ["user1@example.com"])],
+        8: [
+            (["user0@example.com"], ["user3@example.com"]),
+            (["user1@example.com"], []),
+        ],
+    })
+
+def test_mailchimp_update_members():
+    adapter = ListAdapter([])
+    mailchimp = Mailchimp()
+    mailchimp.mount("https://", adapter)
+
+    members = [{"email_address": f"user{i}@example.com"} for i in range(5)]
+    assert(mailchimp.update_members(members, list="abc", chunk_size=2) == 5)
+    assert([len(chunk) for chunk in adapter.updates] == [2, 2, 1])
+    assert(mailchimp.update_members([], list="abc") == 0)
+
 @SkipIfNoAuth
 def test_mailchimp_basic(session):
     for list_name, list_id in session.lists.items():
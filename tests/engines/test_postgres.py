@@ -1,16 +1,38 @@
 from base64 import b64encode, urlsafe_b64encode
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal
 from os import urandom, path
 
 import pytest
 from sqlalchemy.dialects.postgresql import psycopg2
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from nest.config import Config
 from nest.engines import PostgreSQLEngine
 from nest.engines.psql.engine import SelfDestructingSession
-from nest.engines.psql.models import Base, Order, Product, Return, User
+from nest.engines.psql.models import (
+    Base,
+    Order,
+    OrderProductAssociation,
+    Product,
+    Return,
+    User
+)
+from nest.engines.psql import rollups
+from nest.engines.psql.bulk import update_from_values, upsert_users
+from nest.engines.psql.entitlements import entitlements
+from nest.engines.psql.pagination import walk
+from nest.engines.psql.profiling import QueryBudgetExceeded, fingerprint
+from nest.engines.psql.partitioning import (
+    create_partitions,
+    is_partitioned,
+    partition_name,
+    partition_orders,
+    unpartition_orders
+)
 from nest.logging import Logger
+from nest.metrics import Metrics
 
 SkipIfNoPsql = pytest.mark.skipif(
     not(path.exists("/usr/lib/postgresql/12/bin/pg_ctl")), 
@@ -246,6 +268,38 @@ def test_user_hybrid_meth_owns_current_in_set(session):
     assert(user.owns_current_in_set(set_name))
     assert(user in query.all())
 
+@SkipIfNoPsql
+def test_user_hybrid_meth_many_orders(session):
+    user = User(
+        email=f"{random_str()}@{random_str()}.com",
+        first=random_str(),
+        last=random_str()
+    )
+
+    # Every expression matches once per order; two orders must not make
+    # them return more than one row
+    set_name = random_str()
+    for _ in range(2):
+        product = Product(
+            name=random_str(),
+            set=set_name,
+            price=10,
+            current=True
+        )
+        order = Order(reference=random_str(), total=10)
+        order.user = user
+        order.products.append(product)
+        session.add(order)
+    session.commit()
+
+    for expression in [
+        User.owns_any_paid,
+        User.owns_any_in_set(set_name),
+        User.owns_current_in_set(set_name)
+    ]:
+        query = session.query(User.id, expression).filter(expression)
+        assert(query.all() == [(user.id, True)])
+
 @SkipIfNoPsql
 def test_user_hybrid_meth_highest_version_in_set(session):
     user = User(
@@ -296,4 +350,442 @@ def test_user_hybrid_meth_highest_version_in_set(session):
         User.highest_version_in_set(set_name) == 1
     )
     assert(user.highest_version_in_set(set_name) == 1)
-    assert(user in query.all())
\ No newline at end of file
+    assert(user in query.all())
+
+def test_engine_lazy_startup():
+    # Nothing listens on port 1; a lazy engine must not find that out
+    # until it is actually used
+    engine = PostgreSQLEngine(
+        connection_info={"host": "127.0.0.1", "port": 1},
+        lazy=True
+    )
+    assert(engine._connected is None)
+    assert(not(engine.connected))
+
+@SkipIfNoPsql
+def test_engine_lazy_schema(postgresql):
+    connection_info = {
+        "port": postgresql.info.port,
+        "database": postgresql.info.dbname
+    }
+    engine = PostgreSQLEngine(connection_info=connection_info, lazy=True)
+    assert(engine._connected is None)
+
+    session = engine.session()
+    session.add(Product(name=random_str()))
+    session.commit()
+    session.close()
+    assert(engine.connected)
+
+    engine = PostgreSQLEngine(
+        connection_info=connection_info,
+        create_schema=False
+    )
+    assert(engine.connected)
+    for table in Base.metadata.sorted_tables:
+        assert(engine.has_table(table.fullname))
+
+@SkipIfNoPsql
+def test_order_keyset_pagination(session):
+    created = datetime(2020, 1, 1)
+    orders = []
+    for i in range(7):
+        # Pairs of orders share a timestamp so the `id` tie-breaker is
+        # exercised
+        orders.append(Order(
+            reference=random_str(),
+            created=created + timedelta(minutes=i // 2),
+            live=(i % 2 == 0)
+        ))
+    session.add_all(orders)
+    session.commit()
+
+    seen, page = [], Order.page(session, limit=3)
+    seen.extend(page.items)
+    while page.cursor:
+        page = Order.page(session, after=page.cursor, limit=3)
+        seen.extend(page.items)
+    assert(seen == orders)
+    assert(list(walk(Order.page, session, limit=2)) == orders)
+
+    live = list(walk(Order.page, session, limit=2, live=True))
+    assert(live == [order for order in orders if order.live])
+
+    ret = Return(reference=random_str(), amount=orders[0].total)
+    ret.order = orders[0]
+    session.add(ret)
+    session.commit()
+    assert(list(walk(Order.page, session, returned=True)) == orders[:1])
+    assert(list(walk(Order.page, session, returned=False)) == orders[1:])
+
+@SkipIfNoPsql
+def test_user_keyset_pagination(session):
+    users = [
+        User(email=f"{random_str()}@{random_str()}.com", first="", last="")
+        for _ in range(5)
+    ]
+    session.add_all(users)
+    session.commit()
+
+    page = User.page(session, limit=2)
+    assert(page.items == users[:2])
+    assert(page.cursor == (users[1].id,))
+    assert(list(walk(User.page, session, after=page.cursor)) == users[2:])
+
+@SkipIfNoPsql
+def test_order_partitioning(engine, session):
+    partition_orders(engine, months_ahead=1)
+    assert(is_partitioned(engine))
+
+    may, june = datetime(2019, 5, 1), datetime(2019, 6, 1)
+    create_partitions(engine, may, june)
+
+    user = User(email=f"{random_str()}@{random_str()}.com", first="", last="")
+    product = Product(name=random_str())
+    order = Order(
+        reference=random_str(),
+        created=datetime(2019, 5, 3),
+        total=10
+    )
+    order.user = user
+    order.products.append(product)
+    ret = Return(reference=random_str(), amount=order.total)
+    ret.order = order
+
+    session.add(ret)
+    session.commit()
+
+    partition = engine.execute(
+        "SELECT tableoid::regclass::text FROM orders WHERE id = %(id)s",
+        {"id": order.id}
+    ).scalar()
+    assert(partition == partition_name(may))
+
+    # References stay unique across partitions
+    duplicate = Order(
+        reference=order.reference,
+        created=datetime(2019, 6, 3),
+        total=10
+    )
+    session.add(duplicate)
+    with pytest.raises(IntegrityError):
+        session.commit()
+    session.rollback()
+
+    query = session.query(Order).filter(Order.returned)
+    assert(order in query.all())
+    assert(product in order.products)
+    assert(order in user.orders)
+
+    # Moving an order to another month keeps its products and returns
+    order.created = datetime(2019, 6, 3)
+    session.commit()
+    partition = engine.execute(
+        "SELECT tableoid::regclass::text FROM orders WHERE id = %(id)s",
+        {"id": order.id}
+    ).scalar()
+    assert(partition == partition_name(june))
+    session.expire_all()
+    assert(product in order.products)
+    assert(session.query(Return).filter_by(order_id=order.id).count() == 1)
+
+    # Stands in for the dropped `ON DELETE CASCADE` foreign keys
+    reference = order.reference
+    session.execute(Order.__table__.delete().where(Order.id == order.id))
+    session.commit()
+    assert(session.query(Return).count() == 0)
+    assert(session.query(OrderProductAssociation).count() == 0)
+
+    # Deleted references can be used again
+    session.add(Order(reference=reference, created=may, total=10))
+    session.commit()
+
+    unpartition_orders(engine)
+    assert(not(is_partitioned(engine)))
+
+@SkipIfNoPsql
+def test_product_sales_rollups(engine):
+    rollups.track(engine.session_factory)
+    session = engine.session()
+
+    day = datetime(2020, 3, 1)
+    p1, p2 = Product(name=random_str()), Product(name=random_str())
+    o1 = Order(reference=random_str(), created=day, total=10, discount=1)
+    o1.products.extend([p1, p2])
+    o2 = Order(
+        reference=random_str(),
+        created=day,
+        total=20.5,
+        gift=True,
+        coupons=["FOO"]
+    )
+    o2.products.append(p1)
+    session.add_all([o1, o2])
+    session.commit()
+
+    ret = Return(reference=random_str(), amount=10)
+    ret.order = o1
+    session.add(ret)
+    session.commit()
+
+    def snapshot():
+        rows = rollups.daily(session, day.date(), day.date())
+        return [
+            tuple(getattr(row, key) for key in ["product_id"] + rollups.COUNTERS)
+            for row in rows
+        ]
+
+    incremental = snapshot()
+    assert(incremental == [
+        (p1.id, 2, 1, Decimal("30.50"), Decimal("1.00"), 1, 1, Decimal("10.00")),
+        (p2.id, 1, 0, Decimal("10.00"), Decimal("1.00"), 0, 1, Decimal("10.00")),
+    ])
+
+    rollups.rebuild(session)
+    session.commit()
+    session.expire_all()
+    assert(snapshot() == incremental)
+
+    summary = {row.name: row for row in rollups.summary(session, day, day)}
+    assert(summary[p1.name].orders == 2)
+    assert(summary[p1.name].gift_ratio == 0.5)
+
+    rollups.untrack(engine.session_factory)
+    session.close()
+
+@SkipIfNoPsql
+def test_order_coupons_and_paths(session):
+    o1 = Order(reference=random_str(), total=10, coupons=["FOO", "BAR"],
+               paths=["ava-ds"])
+    o2 = Order(reference=random_str(), total=5, discount=1, coupons=["FOO"],
+               paths=["ava-mc"])
+    o3 = Order(reference=random_str(), total=7)
+    session.add_all([o1, o2, o3])
+    session.commit()
+
+    query = session.query(Order).filter(Order.has_coupon("FOO"))
+    assert(set(query.all()) == {o1, o2})
+    assert(o1.has_coupon("BAR") and not(o2.has_coupon("BAR")))
+
+    query = session.query(Order).filter(Order.has_path("ava-mc"))
+    assert(query.all() == [o2])
+    assert(not(o3.has_path("ava-mc")))
+
+    usage = Order.coupon_usage(session)
+    assert([row.value for row in usage] == ["FOO", "BAR"])
+    assert(usage[0].orders == 2)
+    assert(usage[0].total == 15)
+    assert(usage[0].discount == 1)
+
+    usage = Order.path_usage(session, end=datetime(2000, 1, 1))
+    assert(usage == [])
+
+@SkipIfNoPsql
+def test_session_metrics(session):
+    metrics = Metrics()
+    metrics.enabled = True
+    metrics.reset()
+    try:
+        session.add(Product(name=random_str()))
+        session.commit()
+        histograms = metrics.snapshot()["histograms"]
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+
+    assert(histograms["session.flush"]["count"] == 1)
+    assert(histograms["session.commit"]["count"] == 1)
+
+def test_profiling_fingerprint():
+    a = fingerprint("SELECT * FROM users WHERE email = %(email_1)s LIMIT 1")
+    b = fingerprint("SELECT *  FROM users\nWHERE email = 'foo' LIMIT 5")
+    assert(a == b == "SELECT * FROM users WHERE email = ? LIMIT ?")
+
+    a = fingerprint("SELECT 1 FROM orders_y2019m05 WHERE id IN (%s, %s)")
+    b = fingerprint("SELECT 1 FROM orders_y2019m05 WHERE id IN (%s)")
+    assert(a == b == "SELECT ? FROM orders_y2019m05 WHERE id IN (?)")
+
+@SkipIfNoPsql
+def test_profiling(engine, session):
+    with engine.profile(threshold=5) as profiler:
+        for i in range(5):
+            session.query(User).filter_by(email=f"{i}@foo.com").first()
+        session.commit()
+
+        session.query(Product).all()
+        session.query(Product).all()
+        session.commit()
+
+    assert(profiler.count == 7)
+    assert(len(profiler.repeated) == 1)
+
+    top = profiler.top(n=1, by="count")[0]
+    assert(top.count == 5 and top.per_unit == 5)
+    assert("[N+1]" in profiler.report())
+
+    # Detached after the block
+    session.query(Product).all()
+    assert(profiler.count == 7)
+
+@SkipIfNoPsql
+def test_profiling_budget(engine, session):
+    with engine.profile(budget=2):
+        session.query(Product).all()
+        session.query(User).all()
+
+    with pytest.raises(QueryBudgetExceeded):
+        with engine.profile(budget=2):
+            for _ in range(3):
+                session.query(Product).all()
+
+@SkipIfNoPsql
+def test_engine_resize_pool(engine):
+    pool = engine.pool
+    assert(pool.size() == 5)
+
+    engine.reconfigure(None, {})
+    assert(engine.pool is pool)
+
+    config = Config()
+    config.parser.read_string(
+        """
+        [nest:postgresql]
+        pool_size=2
+        max_overflow=0
+        """
+    )
+    config.reload()
+    engine.reconfigure(config, {"postgres_pool_options": ({}, {})})
+    assert(engine.pool is not pool)
+    assert(engine.pool.size() == 2)
+    assert(engine.pool.timeout() == pool.timeout())
+
+    with engine.connect(), engine.connect():
+        assert(engine.pool.checkedout() == 2)
+
+@SkipIfNoPsql
+def test_update_from_values(session):
+    session.add_all([
+        User(email="a@example.com", first="A", last="A", subscribed=False),
+        User(email="b@example.com", first="B", last="B", subscribed=True),
+    ])
+    session.commit()
+
+    table = User.__table__
+    rows = [
+        {"email": "a@example.com", "subscribed": True, "first": "Ann"},
+        {"email": "b@example.com", "subscribed": True, "first": "B"},
+        {"email": "c@example.com", "subscribed": True, "first": "C"},
+    ]
+    # Only the first row differs from what is stored
+    assert(update_from_values(session, table, "email", rows) == 1)
+    assert(update_from_values(session, table, "email", rows) == 0)
+    assert(update_from_values(session, table, "email", rows,
+                              only_changed=False) == 2)
+    session.commit()
+
+    a = session.query(User).filter_by(email="a@example.com").one()
+    assert(a.subscribed and a.first == "Ann")
+    assert(session.query(User).count() == 2)
+    assert(update_from_values(session, table, "email", []) == 0)
+
+@SkipIfNoPsql
+def test_upsert_users(session):
+    session.add(User(email="a@example.com", first="A", last="A"))
+    session.commit()
+    a = session.query(User).filter_by(email="a@example.com").one()
+
+    users = upsert_users(session, [
+        {"email": "b@example.com", "first": "B", "last": "B"},
+        {"email": "a@example.com", "first": "Ann", "last": "A"},
+        {"email": "c@example.com"},
+        {"email": "b@example.com", "first": "Bob", "last": "B"},
+        {"email": None},
+    ])
+    session.commit()
+    assert(sorted(users) == ["a@example.com", "b@example.com", "c@example.com"])
+    assert(users["a@example.com"] == a.id)
+
+    session.expire_all()
+    assert(a.first == "A")
+    b = session.query(User).get(users["b@example.com"])
+    assert(b.first == "Bob" and b.country_code == "US")
+    c = session.query(User).get(users["c@example.com"])
+    assert(c.first == "John" and c.last == "Doe")
+
+    # Existing users are only changed when asked to
+    assert(upsert_users(session, [
+        {"email": "a@example.com", "first": "Ann", "last": "A"}
+    ], update=["first"]) == {"a@example.com": a.id})
+    session.commit()
+    session.expire_all()
+    assert(a.first == "Ann")
+    assert(upsert_users(session, []) == {})
+
+@SkipIfNoPsql
+def test_user_email_case(session):
+    session.add(User(email="Jane@Example.com", first="Jane", last="Doe"))
+    session.commit()
+
+    query = session.query(User).\
+        filter(User.normalized_email == User.normalize("JANE@example.COM"))
+    user = query.one()
+    assert(user.email == "Jane@Example.com")
+    assert(user.normalized_email == "jane@example.com")
+
+    users = upsert_users(session, [{"email": "jane@EXAMPLE.com"}])
+    assert(users == {"jane@example.com": user.id})
+    session.commit()
+    session.expire_all()
+    assert(user.email == "Jane@Example.com")
+
+    session.add(User(email="jane@example.com", first="Jane", last="Doe"))
+    with pytest.raises(IntegrityError):
+        session.commit()
+    session.rollback()
+
+@SkipIfNoPsql
+def test_entitlements(session):
+    users = [
+        User(email=f"{random_str()}@example.com", first="A", last="A")
+        for _ in range(4)
+    ]
+    v1 = Product(name=random_str(), set="Ozone", version=1, current=False,
+                 price=10)
+    v2 = Product(name=random_str(), set="Ozone", version=2, price=10)
+    demo = Product(name=random_str(), set="Neutron", version=3, demo=True)
+    trial = Product(name=random_str(), set="Ozone", version=2, demo=True)
+
+    kept = Order(reference=random_str(), total=10, products=[v1, demo])
+    kept.user = users[0]
+    returned = Order(reference=random_str(), total=10, products=[v2])
+    returned.user = users[0]
+    returned.returns.append(Return(reference=random_str(), amount=10))
+    other = Order(reference=random_str(), total=10, products=[v2])
+    other.user = users[1]
+    demos = Order(reference=random_str(), total=0, products=[trial])
+    demos.user = users[2]
+    session.add_all([kept, returned, other, demos, users[3]])
+    session.commit()
+
+    rows = {row.id: row for row in entitlements(session)}
+    assert(rows[users[0].id].versions == {"Ozone": 1})
+    assert(rows[users[1].id].versions == {"Ozone": 2})
+    assert(rows[users[2].id].versions == {})
+    assert(rows[users[3].id].versions == {})
+    assert([rows[user.id].current for user in users] == [
+        [], ["Ozone"], [], []
+    ])
+    assert([rows[user.id].demo for user in users] == [
+        False, False, True, False
+    ])
+
+    # The same as the per user hybrids
+    for user in users:
+        row = rows[user.id]
+        assert(row.paid == bool(session.query(User.owns_any_paid).\
+            filter(User.id == user.id).scalar()))
+        for name in ("Ozone", "Neutron"):
+            assert(row.versions.get(name, 0) == \
+                user.highest_version_in_set(name))
+            assert((name in row.current) == user.owns_current_in_set(name))
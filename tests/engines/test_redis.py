@@ -7,7 +7,12 @@ from pytest_redis.factories import redisdb
 from redis.lock import LockError
 from redlock import RedLockError
 
-from nest.engines.redis import LockFactory, RedisEngine
+from nest.engines.redis import (
+    EventStream,
+    LockFactory,
+    RedisEngine,
+    StreamConsumer
+)
 
 SkipIfNoRedis = pytest.mark.skipif(
     not(path.exists("/usr/bin/redis-server")), 
@@ -87,3 +92,69 @@ def test_lock_factory(lock_factory):
             # Locks only throw RedLockError on enter context
             with lf.create_lock(resource):
                 pass
+
+@SkipIfNoRedis
+def test_event_stream(engine):
+    stream = EventStream(engine, name=random_str(), consumer="a")
+    ids = stream.add([{"id": str(i)} for i in range(5)])
+    assert(len(ids) == 5 and len(stream) == 5)
+
+    entries = stream.read(count=3, block=None)
+    assert([event["id"] for _, event in entries] == ["0", "1", "2"])
+    assert(stream.pending() == 3)
+
+    stream.ack([id for id, _ in entries])
+    assert(stream.pending() == 0)
+    assert(len(stream.read(count=10, block=None)) == 2)
+    assert(stream.read(count=10, block=None) == [])
+
+@SkipIfNoRedis
+def test_stream_consumer_reclaim(engine):
+    name = random_str()
+    stream = EventStream(engine, name=name, consumer="a")
+    stream.add([{"id": str(i)} for i in range(4)])
+
+    def fail(batch):
+        raise ValueError("database is down")
+
+    # A failed batch stays pending, and is not reclaimed before it idles
+    consumer = StreamConsumer(stream, fail, batch_size=2, block=None, idle=50)
+    assert(consumer.run_once() == 0)
+    assert(stream.pending() == 2)
+
+    batches = []
+    other = EventStream(engine, name=name, consumer="b")
+    consumer = StreamConsumer(other, batches.append, block=None, idle=50)
+    assert(consumer.run_once() == 2)
+    assert([event["id"] for event in batches[-1]] == ["2", "3"])
+
+    sleep(0.1)
+    assert(consumer.run_once() == 2)
+    assert([event["id"] for event in batches[-1]] == ["0", "1"])
+    assert(other.pending() == 0)
+
+@SkipIfNoRedis
+def test_stream_consumer_max_deliveries(engine):
+    stream = EventStream(engine, name=random_str())
+    stream.add([{"id": "0"}])
+
+    def fail(batch):
+        raise ValueError("bad event")
+
+    consumer = StreamConsumer(stream, fail, block=None, idle=0,
+                              max_deliveries=3)
+    for _ in range(3):
+        assert(consumer.run_once() == 0)
+        assert(stream.pending() == 1)
+
+    # Given up on after the third delivery, but kept
+    assert(consumer.run_once() == 0)
+    assert(stream.pending() == 0)
+    assert([event for _, event in stream.buried()] == [{"id": "0"}])
+
+    batches = []
+    consumer = StreamConsumer(stream, batches.append, block=None, idle=0)
+    assert(len(stream.requeue()) == 1)
+    assert(stream.buried() == [])
+    assert(consumer.run_once() == 1)
+    assert(batches == [[{"id": "0"}]])
@@ -1,3 +1,5 @@
+import threading
+
 import pytest
 
 from nest.config import Config
@@ -42,6 +44,10 @@ def test_config_nest(config):
     assert(config.errlogLevel == "critical")
     assert(config.translogLevel == "critical")
 
+    assert(config.logQueue is False)
+    assert(config.logQueueSize == 10000)
+    assert(config.logQueuePolicy == "drop")
+
     assert(isinstance(config.fastspring_auth, tuple))
     assert(config.fastspring_auth[0] == "foo")
     assert(config.fastspring_auth[1] == "bar")
@@ -69,4 +75,45 @@ def test_config_redis(config):
         "db": "bar"
     }
     for info in config.redis_node_list:
-        assert(info == redis_node)
\ No newline at end of file
+        assert(info == redis_node)
+
+def test_config_refresh(tmp_path):
+    path = tmp_path / "config.cfg"
+    path.write_text("[nest]\nerrorlogLevel=info\n")
+    config = Config(path)
+
+    changes = []
+    config.subscribe(lambda cfg, diff: changes.append(diff))
+
+    assert(config.refresh() == {})
+    assert(changes == [])
+
+    path.write_text(
+        "[nest]\nerrorlogLevel=debug\n\n"
+        "[nest:postgresql]\npool_size=2\n"
+    )
+    diff = config.refresh()
+    assert(diff["errlogLevel"] == ("info", "debug"))
+    assert(diff["postgres_pool_options"] == ({}, {"pool_size": 2}))
+    assert(changes == [diff])
+    assert(config.errlogLevel == "debug")
+
+    # Unparsable values keep the previous config
+    path.write_text("[nest]\nerrorlogLevel=info\nlogQueueSize=foo\n")
+    assert(config.refresh() == {})
+    assert(config.errlogLevel == "debug")
+
+def test_config_watch(tmp_path):
+    path = tmp_path / "config.cfg"
+    path.write_text("[nest]\nlogQueue=false\n")
+    config = Config(path)
+
+    changed = threading.Event()
+    config.subscribe(lambda cfg, diff: changed.set())
+    config.watch(interval=0.01)
+    try:
+        path.write_text("[nest]\nlogQueue=true\n")
+        assert(changed.wait(5))
+        assert(config.logQueue is True)
+    finally:
+        config.unwatch()
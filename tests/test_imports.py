@@ -0,0 +1,57 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Cumulative import time budgets, in microseconds. Generous on purpose;
+# the heavy dependency checks are what catch regressions
+BUDGETS = {
+    "nest.engines": 50000,
+    "nest.apis": 50000,
+    "nest.apis.mailchimp": 50000,
+    "nest.apis.fastspring.events": 100000,
+    "nest.config": 100000,
+}
+
+HEAVY = ["sqlalchemy", "redis", "redlock", "requests"]
+
+def import_times(statement):
+    """Cumulative import times of every module imported by
+    ``statement`` in a fresh interpreter, from ``-X importtime``.
+    """
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+
+    times = {}
+    for line in res.stderr.splitlines():
+        if not(line.startswith("import time:")):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+@pytest.mark.parametrize("module, budget", BUDGETS.items())
+def test_import_time(module, budget):
+    times = import_times(f"import {module}")
+    assert(times[module] < budget)
+    for name in HEAVY:
+        assert(name not in times)
+
+def test_import_lazy_attributes():
+    times = import_times(
+        "from nest.apis import Mailchimp; from nest.engines import RedisEngine"
+    )
+    assert("requests" in times and "redis" in times)
+    assert("sqlalchemy" not in times)
+
+    times = import_times("from nest.engines import PostgreSQLEngine")
+    assert("sqlalchemy" in times and "redis" not in times)
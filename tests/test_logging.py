@@ -1,3 +1,8 @@
+import gzip
+import json
+import logging
+import threading
+
 import pytest
 
 from nest.logging import Logger
@@ -31,4 +36,152 @@ def test_logger_basic(config, logger):
         logger.error, 
         logger.critical
     ]:
-        fn("")
\ No newline at end of file
+        fn("")
+
+class Collector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.get_ident())
+
+@pytest.fixture()
+def queue_config():
+    config = Config()
+    config.parser.read_string(
+        """
+        [nest]
+        errorlogLevel=debug
+        transactionlogLevel=debug
+        logQueue=true
+        logQueueSize=4
+        logQueuePolicy=block
+        """
+    )
+    config.reload()
+    yield config
+
+def test_logger_queue(queue_config):
+    logger = Logger(queue_config)
+    assert(logger.listener is not None)
+
+    collector = Collector()
+    logger.listener.handlers = (collector,)
+    for i in range(20):
+        logger.info("info %d", i)
+        logger.transaction("info", "transaction %d", i)
+    logger.stop()
+
+    assert(len(collector.records) == 40)
+    assert(collector.records[-1].getMessage() == "transaction 19")
+    assert(threading.get_ident() not in collector.threads)
+    assert(logger.dropped == 0)
+
+def test_logger_queue_drop(queue_config):
+    queue_config.parser.set("nest", "logQueuePolicy", "drop")
+    queue_config.reload()
+    logger = Logger(queue_config)
+
+    entered, release = threading.Event(), threading.Event()
+    class Stall(logging.Handler):
+        def emit(self, record):
+            entered.set()
+            release.wait()
+    logger.listener.handlers = (Stall(),)
+
+    # With the consumer stuck on the first record, the queue fills up
+    # after `logQueueSize` more
+    logger.info("stall")
+    entered.wait()
+    for i in range(10):
+        logger.info("info %d", i)
+    assert(logger.dropped == 6)
+
+    release.set()
+    logger.setup(queue_config)
+    assert(len(logger.error_logger.handlers) == 1)
+    logger.stop()
+
+def test_logger_queue_policy(queue_config):
+    queue_config.parser.set("nest", "logQueuePolicy", "foo")
+    queue_config.reload()
+    threads = threading.active_count()
+    with pytest.raises(ValueError):
+        Logger(queue_config)
+    assert(threading.active_count() == threads)
+
+@pytest.fixture()
+def json_config(tmp_path):
+    config = Config()
+    config.parser.read_string(
+        f"""
+        [nest]
+        errorlogLevel=debug
+        transactionlogLevel=debug
+        transactionlogFormat=json
+        transactionlogFile={tmp_path / "transactions.log"}
+        transactionlogMaxBytes=2048
+        transactionlogBackupCount=2
+        transactionlogCompress=true
+        transactionlogBuffer=10
+        """
+    )
+    config.reload()
+    yield config
+
+def test_logger_json_transactions(json_config, tmp_path):
+    logger = Logger(json_config)
+    logger.info("not a transaction")
+    logger.transaction(
+        "info",
+        "Processed %s",
+        "FOO",
+        event="foo",
+        type="order.completed",
+        reference="FOO-1",
+        duration=0.25,
+        outcome="created"
+    )
+
+    path = tmp_path / "transactions.log"
+    # Buffered; nothing has been written yet
+    assert(path.read_text() == "")
+
+    logger.stop()
+    entries = [json.loads(line) for line in path.read_text().splitlines()]
+    assert(len(entries) == 1)
+    assert(entries[0]["message"] == "Processed FOO")
+    assert(entries[0]["reference"] == "FOO-1")
+    assert(entries[0]["duration"] == 0.25)
+    assert(entries[0]["level"] == "INFO")
+
+def test_logger_json_rotation(json_config, tmp_path):
+    json_config.parser.set("nest", "logQueue", "true")
+    json_config.reload()
+    logger = Logger(json_config)
+    for i in range(100):
+        logger.transaction("info", "Processed", event=str(i))
+    logger.stop()
+
+    rotated = sorted(tmp_path.glob("transactions.log.*"))
+    assert([path.name for path in rotated] == [
+        "transactions.log.1.gz",
+        "transactions.log.2.gz"
+    ])
+    with gzip.open(rotated[0], "rt") as file:
+        for line in file:
+            assert(json.loads(line)["message"] == "Processed")
+
+def test_logger_reconfigure(config):
+    logger = Logger(config)
+    handlers = logger.handlers
+
+    logger.reconfigure(config, {"fastspring_auth": (None, None)})
+    assert(logger.handlers is handlers)
+
+    logger.reconfigure(config, {"errlogLevel": ("info", "critical")})
+    assert(logger.handlers is not handlers)
+    logger.stop()
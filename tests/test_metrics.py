@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from nest.apis.fastspring.events import EventParser
+from nest.config import Config
+from nest.metrics import NULL_TIMER, Metrics, timed
+
+@pytest.fixture()
+def metrics():
+    config = Config()
+    config.parser.read_string(
+        """
+        [nest]
+        metrics=true
+        """
+    )
+    config.reload()
+
+    metrics = Metrics()
+    metrics.configure(config)
+    metrics.reset()
+    yield metrics
+    metrics.enabled = False
+    metrics.reset()
+
+def test_metrics_disabled():
+    metrics = Metrics()
+    assert(metrics.enabled is False)
+    assert(metrics.timer("foo") is NULL_TIMER)
+
+    with metrics.timer("foo"):
+        pass
+    metrics.increment("bar")
+    assert(metrics.snapshot() == {"counters": {}, "histograms": {}})
+
+def test_metrics_timer(metrics):
+    @timed("decorated")
+    def fn(value):
+        return value
+
+    with metrics.timer("foo"):
+        pass
+    metrics.observe("foo", 100)
+    assert(fn(42) == 42)
+    metrics.increment("bar", 3)
+
+    snapshot = metrics.snapshot()
+    assert(snapshot["counters"] == {"bar": 3})
+
+    foo = snapshot["histograms"]["foo"]
+    assert(foo["count"] == 2)
+    assert(foo["sum"] >= 100)
+    assert(foo["buckets"]["30.0"] == 1)
+    assert(foo["buckets"]["+Inf"] == 2)
+    assert(snapshot["histograms"]["decorated"]["count"] == 1)
+
+def test_metrics_export(metrics, tmp_path):
+    metrics.observe("fastspring.request", 0.2)
+    metrics.increment("events.parsed")
+
+    text = metrics.to_prometheus()
+    assert("# TYPE nest_events_parsed_total counter" in text)
+    assert("nest_events_parsed_total 1" in text)
+    assert("# TYPE nest_fastspring_request_seconds histogram" in text)
+    assert('nest_fastspring_request_seconds_bucket{le="0.1"} 0' in text)
+    assert('nest_fastspring_request_seconds_bucket{le="0.25"} 1' in text)
+    assert("nest_fastspring_request_seconds_count 1" in text)
+
+    path = tmp_path / "nest.prom"
+    metrics.export(path)
+    assert(path.read_text() == text)
+
+    path = tmp_path / "nest.json"
+    metrics.export(path, format="json")
+    assert(json.loads(path.read_text()) == metrics.snapshot())
+
+def test_metrics_events(metrics):
+    events = [
+        {"type": "order.completed", "data": {}},
+        {"type": "return.created", "data": {}},
+        {"type": "foo", "data": {}},
+    ]
+    assert(len(list(EventParser(events))) == 3)
+
+    snapshot = metrics.snapshot()
+    assert(snapshot["counters"]["events.parsed"] == 3)
+    assert(snapshot["histograms"]["events.classify"]["count"] == 3)
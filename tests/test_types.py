@@ -1,6 +1,6 @@
 import pytest
 
-from nest.types import Singleton
+from nest.types import LazyModule, Singleton
 
 def test_singleton():
     class Dummy(metaclass=Singleton):
@@ -8,4 +8,11 @@ def test_singleton():
 
     d1, d2 = Dummy(), Dummy()
     assert(id(d1) == id(d2))
-    assert(d1 is d2)
\ No newline at end of file
+    assert(d1 is d2)
+
+def test_lazy_module():
+    module = LazyModule("json")
+    assert(module.dumps([]) == "[]")
+
+    with pytest.raises(AttributeError):
+        module.foo